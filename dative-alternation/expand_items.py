@@ -1,50 +1,42 @@
 import os
 import sys
-import itertools
 
 import pandas as pd
 
-conditions = {
-    'do_theme-short_theme-indefinite_recip-short_recip-indefinite': ['Indef Recipient', 'Indef Theme'],
-    'do_theme-short_theme-definite_recip-short_recip-indefinite': ['Def Recipient', 'Indef Theme'],
-    'do_theme-short_theme-indefinite_recip-short_recip-definite': ['Indef Recipient', 'Def Theme'],
-    'do_theme-short_theme-definite_recip-short_recip-definite': ['Def Recipient', 'Def Theme'],
-    'do_theme-long_theme-indefinite_recip-short_recip-indefinite': ['Indef Recipient', 'Indef Theme', 'Theme Modifier'],
-    'do_theme-long_theme-definite_recip-short_recip-indefinite': ['Def Recipient', 'Indef Theme', 'Theme Modifier'],
-    'do_theme-long_theme-indefinite_recip-short_recip-definite': ['Indef Recipient', 'Def Theme', 'Theme Modifier'],
-    'do_theme-long_theme-definite_recip-short_recip-definite': ['Def Recipient', 'Def Theme','Theme Modifier'], 
-    'do_theme-short_theme-indefinite_recip-long_recip-indefinite': ['Indef Recipient', 'Recipient Modifier', 'Indef Theme'],
-    'do_theme-short_theme-definite_recip-long_recip-indefinite': ['Def Recipient', 'Recipient Modifier', 'Indef Theme'],
-    'do_theme-short_theme-indefinite_recip-long_recip-definite': ['Indef Recipient', 'Recipient Modifier', 'Def Theme'],
-    'do_theme-short_theme-definite_recip-long_recip-definite': ['Def Recipient', 'Recipient Modifier', 'Def Theme'],
-    'do_theme-long_theme-indefinite_recip-long_recip-indefinite': ['Indef Recipient', 'Recipient Modifier', 'Indef Theme', 'Theme Modifier'],
-    'do_theme-long_theme-definite_recip-long_recip-indefinite': ['Def Recipient', 'Recipient Modifier', 'Indef Theme', 'Theme Modifier'],
-    'do_theme-long_theme-indefinite_recip-long_recip-definite': ['Indef Recipient', 'Recipient Modifier', 'Def Theme', 'Theme Modifier'],
-    'do_theme-long_theme-definite_recip-long_recip-definite': ['Def Recipient', 'Recipient Modifier', 'Def Theme', 'Theme Modifier'],
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import item_expansion
+import factorial_design
+from factorial_design import Region
 
-    'po_theme-short_theme-indefinite_recip-short_recip-indefinite': ['Indef Theme', 'To', 'Indef Recipient'],
-    'po_theme-short_theme-definite_recip-short_recip-indefinite': ['Indef Theme', 'To', 'Def Recipient'],
-    'po_theme-short_theme-indefinite_recip-short_recip-definite': ['Def Theme', 'To', 'Indef Recipient'],
-    'po_theme-short_theme-definite_recip-short_recip-definite': ['Def Theme', 'To', 'Def Recipient'],
-    
-    'po_theme-long_theme-indefinite_recip-short_recip-indefinite': ['Indef Theme', 'Theme Modifier', 'To', 'Indef Recipient'],
-    'po_theme-long_theme-definite_recip-short_recip-indefinite': ['Indef Theme', 'Theme Modifier', 'To', 'Def Recipient'],
-    'po_theme-long_theme-indefinite_recip-short_recip-definite': ['Def Theme', 'Theme Modifier', 'To', 'Indef Recipient'],
-    'po_theme-long_theme-definite_recip-short_recip-definite': ['Def Theme','Theme Modifier', 'To', 'Def Recipient'],
-    
-    'po_theme-short_theme-indefinite_recip-long_recip-indefinite': ['Indef Theme', 'To', 'Indef Recipient', 'Recipient Modifier', ],
-    'po_theme-short_theme-definite_recip-long_recip-indefinite': ['Indef Theme', 'To', 'Def Recipient', 'Recipient Modifier', ],
-    'po_theme-short_theme-indefinite_recip-long_recip-definite': ['Def Theme', 'To', 'Indef Recipient', 'Recipient Modifier', ],
-    'po_theme-short_theme-definite_recip-long_recip-definite': ['Def Theme', 'To', 'Def Recipient', 'Recipient Modifier', ],
-    
-    'po_theme-long_theme-indefinite_recip-long_recip-indefinite': ['Indef Theme', 'Theme Modifier', 'To', 'Indef Recipient', 'Recipient Modifier', ],
-    'po_theme-long_theme-definite_recip-long_recip-indefinite': ['Indef Theme', 'Theme Modifier', 'To', 'Def Recipient', 'Recipient Modifier', ],
-    'po_theme-long_theme-indefinite_recip-long_recip-definite': ['Def Theme', 'Theme Modifier', 'To', 'Indef Recipient', 'Recipient Modifier', ],
-    'po_theme-long_theme-definite_recip-long_recip-definite': ['Def Theme', 'Theme Modifier', 'To', 'Def Recipient', 'Recipient Modifier', ],    
-}
-
-for condition in conditions:
-    conditions[condition] = ['Subject', 'Verb'] + conditions[condition]
+# The condition names have the theme and recipient definiteness labels in
+# each other's places: the third part ("theme-...") says whether the
+# recipient is definite, and the fifth ("recip-...") whether the theme is.
+# The analysis reads them that way, so the names are kept as they are.
+design = factorial_design.FactorialDesign(
+    factors=[
+        ('construction', ['do', 'po']),
+        ('theme_length', ['theme-short', 'theme-long']),
+        ('recip_definiteness', ['theme-indefinite', 'theme-definite']),
+        ('recip_length', ['recip-short', 'recip-long']),
+        ('theme_definiteness', ['recip-indefinite', 'recip-definite']),
+    ],
+    vary=['construction', 'recip_length', 'theme_length', 'theme_definiteness', 'recip_definiteness'],
+    regions=[
+        'Subject',
+        'Verb',
+        Region('Indef Recipient', construction='do', recip_definiteness='theme-indefinite'),
+        Region('Def Recipient', construction='do', recip_definiteness='theme-definite'),
+        Region('Recipient Modifier', construction='do', recip_length='recip-long'),
+        Region('Indef Theme', theme_definiteness='recip-indefinite'),
+        Region('Def Theme', theme_definiteness='recip-definite'),
+        Region('Theme Modifier', theme_length='theme-long'),
+        Region('To', construction='po'),
+        Region('Indef Recipient', construction='po', recip_definiteness='theme-indefinite'),
+        Region('Def Recipient', construction='po', recip_definiteness='theme-definite'),
+        Region('Recipient Modifier', construction='po', recip_length='recip-long'),
+    ],
+)
+conditions = design.conditions()
 
 end_condition_included = False
 autocaps = True
@@ -54,37 +46,29 @@ def make_definite(s):
     words[0] = "the"
     return " ".join(words)
 
-def expand_items(df):
+def add_regions(df):
     df['To'] = "to"
     df['Indef Theme'] = df['Theme']
     df['Indef Recipient'] = df['Recipient']
     df['Def Theme'] = df['Indef Theme'].map(make_definite)
     df['Def Recipient'] = df['Indef Recipient'].map(make_definite)
-    output_df = pd.DataFrame(rows(df))
-    output_df.columns = ['sent_index', 'word_index', 'word', 'region', 'condition']
-    return output_df
 
-def rows(df):
-    for condition in conditions:
-        for sent_index, row in df.iterrows():
-            word_index = 0
-            for region in conditions[condition]:
-                for word in row[region].split():
-                    if autocaps and word_index == 0:
-                        word = word.title()
-                    yield sent_index, word_index, word, region, condition
-                    word_index += 1
-            if not end_condition_included:
-                yield sent_index, word_index + 1, ".", "End", condition
-                yield sent_index, word_index + 2, "<eos>", "End", condition
+def expand_items(df):
+    add_regions(df)
+    return item_expansion.expand_items(df, conditions, autocaps, not end_condition_included)
 
-def main(filename:
+def main(filename):
     input_df = pd.read_excel(filename)
-    output_df = expand_items(input_df)
+    add_regions(input_df)
     try:
         os.mkdir("tests")
     except FileExistsError:
         pass
+    # Written a few conditions at a time rather than built whole in memory
+    chunks = factorial_design.stream_items(
+        input_df, design, autocaps=autocaps, add_end_region=not end_condition_included
+    )
+    factorial_design.write_items_tsv(chunks, "tests/items.tsv")
 
 if __name__ == "__main__":
     main(*sys.argv[1:])
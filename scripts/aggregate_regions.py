@@ -0,0 +1,88 @@
+"""Region-level aggregates of scored results.
+
+Collapses the per-token results of run_models into one row per (model,
+sent_index, condition, region) with the summed and mean surprisal, the
+number of tokens and the number of UNK tokens. The keys are factorized
+once into a single group id, and every aggregate is one np.bincount over
+it, so this is cheap enough to redo after every scoring run. run_models
+writes the result next to combined_results as region_results.csv.
+
+contrast() then gives the critical-region differences between paired
+conditions, per model and item.
+
+Usage: python aggregate_regions.py path/to/tests
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import results_store
+
+KEYS = ['model', 'sent_index', 'condition', 'region']
+FILENAME = "region_results.csv"
+
+
+def aggregate(df, keys=KEYS):
+    """ One row per combination of keys present in df, with surprisal_sum,
+    surprisal_mean, n_tokens and n_unk """
+    codes = []
+    uniques = []
+    for key in keys:
+        key_codes, key_uniques = pd.factorize(df[key], sort=True)
+        codes.append(key_codes)
+        uniques.append(key_uniques)
+    shape = tuple(len(u) for u in uniques)
+    flat = np.ravel_multi_index(codes, shape)
+    groups, inverse = np.unique(flat, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    n_tokens = np.bincount(inverse, minlength=len(groups))
+    surprisal_sum = np.bincount(inverse, weights=df['surprisal'].to_numpy(dtype=np.float64), minlength=len(groups))
+    if 'unk' in df:
+        n_unk = np.bincount(inverse, weights=df['unk'].to_numpy(dtype=np.float64), minlength=len(groups))
+    else:
+        n_unk = np.zeros(len(groups))
+
+    result = pd.DataFrame({
+        key: key_uniques.take(key_codes)
+        for key, key_uniques, key_codes in zip(keys, uniques, np.unravel_index(groups, shape))
+    })
+    result['surprisal_sum'] = surprisal_sum
+    result['surprisal_mean'] = surprisal_sum / n_tokens
+    result['n_tokens'] = n_tokens
+    result['n_unk'] = n_unk.astype(np.int64)
+    return result
+
+def contrast(cube, pairs, region, value='surprisal_sum'):
+    """ Difference in value at region between paired conditions.
+
+    pairs is a list of (condition_a, condition_b); the result has one row
+    per model, sent_index and pair, with a - b in `difference`.
+    """
+    at_region = cube[cube['region'] == region]
+    table = at_region.pivot_table(index=['model', 'sent_index'], columns='condition', values=value)
+    dfs = []
+    for a, b in pairs:
+        d = (table[a] - table[b]).rename('difference').reset_index()
+        d['condition_a'] = a
+        d['condition_b'] = b
+        dfs.append(d)
+    return pd.concat(dfs, ignore_index=True)
+
+def read_combined_results(path):
+    """ combined_results from a tests directory, from whichever of the CSV
+    and the columnar file a run of run_models wrote last """
+    npz = os.path.join(path, results_store.FILENAME)
+    csv = os.path.join(path, "combined_results.csv")
+    if os.path.exists(npz) and (not os.path.exists(csv) or os.path.getmtime(npz) >= os.path.getmtime(csv)):
+        return results_store.read_columns(npz, KEYS + ['surprisal', 'unk'])
+    return pd.read_csv(csv)
+
+def main(path):
+    cube = aggregate(read_combined_results(path))
+    cube.to_csv(os.path.join(path, FILENAME), index=False)
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
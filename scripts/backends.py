@@ -0,0 +1,217 @@
+"""Scoring backends that run_models loads and calls in process.
+
+Each model named in the config file is scored by a Backend subclass
+instead of a shell command from run_models.MODELS, so the model is loaded
+once per process and its surprisals come back as arrays, not through an
+output TSV. The config file is JSON, mapping model names to the backend's
+settings; paths may start with ~:
+
+    {
+        "gulordava": {
+            "backend": "gulordava",
+            "python_path": ["~/src/colorlessgreenRNNs/src/language_models"],
+            "checkpoint": "~/src/colorlessgreenRNNs/src/hidden650_batch128_dropout0.2_lr20.0.pt",
+            "data": "~/src/colorlessgreenRNNs/data/lm/English",
+            "prefixtrie": true
+        }
+    }
+
+python_path lists directories to import the scorer's dependencies from
+(colorlessgreenRNNs' language_models, lm_1b's data_utils.py). The file is
+RNN_SOFT_CONSTRAINTS_CONFIG, or models.json next to this script; see
+models.example.json for every backend. From a notebook:
+
+    backend = backends.load("gulordava")
+    for words, surprisals in backend.score(["The man gave a book to the woman . <eos>"]):
+        ...
+"""
+import os
+import sys
+import json
+
+import numpy as np
+
+CONFIG_VAR = "RNN_SOFT_CONSTRAINTS_CONFIG"
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models.json")
+
+BACKENDS = {}
+# Loaded backends, by model name and settings, so that a process loads each
+# model once however many experiments it scores
+_LOADED = {}
+
+
+def register(cls):
+    """ Class decorator adding a Backend to BACKENDS under its name """
+    BACKENDS[cls.name] = cls
+    return cls
+
+
+class Backend(object):
+    """ A language model scored in process.
+
+    Subclasses load the model in load() and return (model_word, surprisal)
+    rows, one per token, from rows(); with candidates, the rows are
+    (model_word, surprisal, distribution) triples as in distributions.py,
+    if has_distributions.
+    """
+    name = None
+    has_distributions = False
+
+    def __init__(self, **config):
+        self.config = config
+
+    def load(self, threads=0):
+        raise NotImplementedError
+
+    def rows(self, sentences, candidates=0):
+        raise NotImplementedError
+
+    def id_to_word(self, word_id):
+        raise NotImplementedError
+
+    def score(self, sentences, candidates=0):
+        """ Yield (model_words, surprisals) arrays for each sentence, plus a
+        list of distributions with candidates """
+        sentences = list(sentences)
+        rows = self.rows(sentences, candidates)
+        lengths = [len(sentence.split()) for sentence in sentences]
+        if len(rows) != sum(lengths):
+            raise ValueError("%s returned %d rows for %d tokens" % (self.name, len(rows), sum(lengths)))
+        start = 0
+        for length in lengths:
+            sentence_rows = rows[start:start + length]
+            start += length
+            words = np.array([row[0] for row in sentence_rows], dtype=object)
+            surprisals = np.array([row[1] for row in sentence_rows], dtype=np.float64)
+            if candidates and self.has_distributions:
+                yield words, surprisals, [row[2] for row in sentence_rows]
+            else:
+                yield words, surprisals
+
+
+@register
+class GoogleBackend(Backend):
+    """ Google's 1-billion-word LSTM, through eval_test_google.py.
+
+    Settings: pbtxt, ckpt, and vocab_file or vocab_index, as for the script's
+    flags; optionally prefix_trie, full_softmax.
+    """
+    name = 'google'
+    has_distributions = True
+
+    def load(self, threads=0):
+        import eval_test_google
+        import vocab_index
+        self.scorer = eval_test_google
+        self.sess, self.t = eval_test_google._LoadModel(self.config['pbtxt'], self.config['ckpt'], threads)
+        if self.config.get('vocab_index'):
+            self.vocab = vocab_index.VocabIndex(self.config['vocab_index'])
+        else:
+            import data_utils
+            self.vocab = data_utils.CharsVocabulary(self.config['vocab_file'], eval_test_google.MAX_WORD_LEN)
+
+    def rows(self, sentences, candidates=0):
+        if self.config.get('prefix_trie'):
+            return self.scorer._ScoreSentsTrie(self.sess, self.t, self.vocab, sentences, candidates)
+        return self.scorer._ScoreSents(
+            self.sess, self.t, self.vocab, sentences,
+            self.config.get('full_softmax', False), candidates)
+
+    def id_to_word(self, word_id):
+        return self.vocab.id_to_word(word_id)
+
+
+@register
+class GulordavaBackend(Backend):
+    """ The Gulordava et al. (2018) LSTM, through evaluate_target_word_test.py.
+
+    Settings: checkpoint and data, or exported, as for the script's flags;
+    optionally cuda, quantize, prefixtrie, batchtokens, shards, temperature.
+    """
+    name = 'gulordava'
+    has_distributions = True
+
+    def load(self, threads=0):
+        import torch
+        import dictionary_corpus
+        import evaluate_target_word_test
+        import exported_model
+        self.scorer = evaluate_target_word_test
+        if threads:
+            torch.set_num_threads(threads)
+        cuda = self.config.get('cuda', False)
+        if self.config.get('exported'):
+            self.model, self.dictionary = exported_model.load(self.config['exported'], cuda)
+        else:
+            self.model = evaluate_target_word_test.load_model(self.config['checkpoint'], cuda)
+            self.dictionary = dictionary_corpus.Dictionary(self.config['data'])
+        if self.config.get('quantize'):
+            self.model = evaluate_target_word_test.quantize(self.model)
+        self.device = torch.device("cuda" if cuda else "cpu")
+
+    def rows(self, sentences, candidates=0):
+        tokenized = [self.scorer.tokenize_sentence(self.dictionary, sentence) for sentence in sentences]
+        return self.scorer.score_sentences(
+            self.model, self.dictionary, tokenized, self.config.get('temperature', 1.0), self.device,
+            self.config.get('prefixtrie', False), self.config.get('batchtokens', 0),
+            self.config.get('shards', 1), candidates)
+
+    def id_to_word(self, word_id):
+        return self.dictionary.idx2word[word_id]
+
+
+@register
+class NgramBackend(Backend):
+    """ The back-off n-gram baseline of ngram_model.py. Settings: lm. """
+    name = 'kenlm'
+
+    def load(self, threads=0):
+        import ngram_model
+        self.model = ngram_model.NgramModel.load(self.config['lm'])
+
+    def rows(self, sentences, candidates=0):
+        return self.model.score_sentences(sentences)
+
+
+def config_filename():
+    return os.environ.get(CONFIG_VAR) or DEFAULT_CONFIG
+
+def expand(value):
+    if isinstance(value, str):
+        return os.path.expanduser(value)
+    if isinstance(value, list):
+        return [expand(v) for v in value]
+    return value
+
+def read_config(filename=None):
+    """ Settings for each model in the config file, with ~ expanded; empty
+    if there is no file """
+    filename = filename or config_filename()
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as infile:
+        config = json.load(infile)
+    return {model: {key: expand(value) for key, value in settings.items()} for model, settings in config.items()}
+
+def create(settings):
+    """ The (unloaded) backend for a model's settings """
+    settings = dict(settings)
+    backend = settings.pop('backend')
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend %r; known backends are %s" % (backend, ", ".join(sorted(BACKENDS))))
+    for directory in reversed(settings.pop('python_path', [])):
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+    return BACKENDS[backend](**settings)
+
+def load(model, settings=None, threads=0):
+    """ The loaded backend for model, from settings or the config file,
+    reusing one this process has loaded already """
+    if settings is None:
+        settings = read_config()[model]
+    key = (model, json.dumps(settings, sort_keys=True))
+    if key not in _LOADED:
+        backend = create(settings)
+        backend.load(threads)
+        _LOADED[key] = backend
+    return _LOADED[key]
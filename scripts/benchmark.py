@@ -0,0 +1,285 @@
+"""Throughput benchmarks of the scoring backends on stand-in models.
+
+Builds tiny random stand-ins for each backend with standin_models.py (their
+vocabulary is the words of the experiments' items), then:
+
+* loads each backend in a fresh process and scores every sentence of the
+  four experiments' tests/items.tsv, recording startup time, tokens/sec,
+  p50/p99 per-token latency (each of a sample of sentences scored on its own)
+  and the process's peak RSS
+* runs run_models.py end to end on a copy of each experiment's items.tsv
+  with all the backends, without the cache, recording the wall time, once
+  with the scorers run as commands and once with them loaded in process
+  (backends.py)
+
+and writes the results as JSON. --compare prints the change from an
+earlier results file.
+
+The Google backend needs lm_1b's directory (for data_utils.py) and
+TensorFlow; the Gulordava backend needs colorlessgreenRNNs'
+src/language_models directory (for model.py, dictionary_corpus.py and
+utils.py). Backends without them are skipped.
+
+Usage:
+    python benchmark.py --lm_1b ~/code/lm_1b/lm_1b --colorlessgreen ~/src/colorlessgreenRNNs/src/language_models --output benchmark.json
+    python benchmark.py --output new.json --compare benchmark.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+
+import backends
+import run_models
+import standin_models
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(SCRIPTS)
+EXPERIMENTS = ['dative-alternation', 'genitive-alternation', 'heavy-np-shift', 'particleshift']
+BACKENDS = ['google', 'gulordava', 'kenlm']
+
+parser = argparse.ArgumentParser(description='Benchmark the scoring backends on stand-in models')
+parser.add_argument('--backends', nargs='+', default=BACKENDS, help='backends to benchmark')
+parser.add_argument('--lm_1b', type=str, default='', help="directory with lm_1b's data_utils.py")
+parser.add_argument('--colorlessgreen', type=str, default='',
+                    help="colorlessgreenRNNs' src/language_models directory")
+parser.add_argument('--vocab_size', type=int, default=10000, help='stand-in vocabulary size')
+parser.add_argument('--latency_sentences', type=int, default=200,
+                    help='sentences scored one at a time for the latency percentiles')
+parser.add_argument('--output', type=str, default='benchmark.json', help='file to write the results to')
+parser.add_argument('--compare', type=str, default='', help='earlier results file to compare against')
+
+
+def experiment_items():
+    return {
+        experiment: pd.read_csv(os.path.join(REPOSITORY, experiment, "tests", "items.tsv"), sep="\t")
+        for experiment in EXPERIMENTS
+    }
+
+def available_backends(backends, args):
+    """ The backends that can run here, and why the others can't """
+    available = []
+    skipped = {}
+    for backend in backends:
+        if backend == 'google' and not args.lm_1b:
+            skipped[backend] = "no --lm_1b directory"
+        elif backend == 'gulordava' and not args.colorlessgreen:
+            skipped[backend] = "no --colorlessgreen directory"
+        else:
+            available.append(backend)
+    if 'google' in available:
+        try:
+            import tensorflow
+        except ImportError:
+            available.remove('google')
+            skipped['google'] = "TensorFlow is not installed"
+    return available, skipped
+
+def make_standins(dirname, backends, items, vocab_size):
+    """ Write a stand-in for each backend under dirname; return the paths
+    each backend's loader and command need """
+    sentences = [sentence for df in items.values() for sentence in run_models.sentences(df['word'])]
+    vocab = standin_models.vocabulary(
+        (word for df in items.values() for word in df['word']), vocab_size)
+    config = {}
+    if 'google' in backends:
+        pbtxt, ckpt, vocab_file = standin_models.make_google(os.path.join(dirname, 'google'), vocab)
+        config['google'] = {'pbtxt': pbtxt, 'ckpt': ckpt, 'vocab_file': vocab_file}
+    if 'gulordava' in backends:
+        checkpoint, data = standin_models.make_gulordava(os.path.join(dirname, 'gulordava'), vocab)
+        config['gulordava'] = {'checkpoint': checkpoint, 'data': data}
+    if 'kenlm' in backends:
+        arpa = standin_models.make_ngram(os.path.join(dirname, 'kenlm'), vocab, sentences)
+        config['kenlm'] = {'lm': arpa}
+    return config
+
+def load_google(config):
+    import data_utils
+    import eval_test_google
+    sess, t = eval_test_google._LoadModel(config['pbtxt'], config['ckpt'])
+    vocab = data_utils.CharsVocabulary(config['vocab_file'], eval_test_google.MAX_WORD_LEN)
+    return lambda sentences: eval_test_google._ScoreSents(sess, t, vocab, sentences)
+
+def load_gulordava(config):
+    import torch
+    import dictionary_corpus
+    import evaluate_target_word_test
+    model = evaluate_target_word_test.load_model(config['checkpoint'], False)
+    dictionary = dictionary_corpus.Dictionary(config['data'])
+    def score(sentences):
+        sentences = [evaluate_target_word_test.tokenize_sentence(dictionary, sentence) for sentence in sentences]
+        return evaluate_target_word_test.score_sentences(model, dictionary, sentences, 1.0, torch.device("cpu"))
+    return score
+
+def load_kenlm(config):
+    import ngram_model
+    return ngram_model.NgramModel.load(config['lm']).score_sentences
+
+LOADERS = {
+    'google': load_google,
+    'gulordava': load_gulordava,
+    'kenlm': load_kenlm,
+}
+
+def measure_backend(backend, config, sentences, latency_sentences):
+    """ Load backend and score sentences; meant to run in a process of its own """
+    start = time.perf_counter()
+    score = LOADERS[backend](config)
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rows = score(sentences)
+    elapsed = time.perf_counter() - start
+
+    rng = np.random.RandomState(0)
+    sample = rng.choice(len(sentences), min(latency_sentences, len(sentences)), replace=False)
+    latencies = []
+    for i in sample:
+        start = time.perf_counter()
+        score([sentences[i]])
+        latencies.append((time.perf_counter() - start) / len(sentences[i].split()))
+
+    return {
+        'startup_seconds': startup,
+        'tokens': len(rows),
+        'tokens_per_second': len(rows) / elapsed,
+        'latency_p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'latency_p99_ms': 1000 * float(np.percentile(latencies, 99)),
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def run_isolated(fn, *args):
+    """ fn(*args) in a freshly spawned process, so that startup and peak RSS
+    are its own """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(fn, *args).result()
+
+def model_commands(config, args):
+    """ run_models.MODELS entries for the stand-ins """
+    python = sys.executable
+    commands = {}
+    if 'google' in config:
+        commands['google'] = [
+            "PYTHONPATH=%s:%s:$PYTHONPATH %s %s/eval_test_google.py --pbtxt %s --ckpt %s --vocab_file %s --output_file {output_path} --input_file {input_path}"
+            % (args.lm_1b, SCRIPTS, python, SCRIPTS, config['google']['pbtxt'], config['google']['ckpt'], config['google']['vocab_file'])
+        ]
+    if 'gulordava' in config:
+        commands['gulordava'] = [
+            "PYTHONPATH=%s:%s:$PYTHONPATH %s %s/evaluate_target_word_test.py --checkpoint %s --data %s --surprisalmode True --prefixfile {input_path} --outf {output_path}"
+            % (args.colorlessgreen, SCRIPTS, python, SCRIPTS, config['gulordava']['checkpoint'], config['gulordava']['data'])
+        ]
+    if 'kenlm' in config:
+        commands['kenlm'] = [
+            "%s %s/ngram_model.py --lm %s --input_file {input_path} --output_file {output_path}"
+            % (python, SCRIPTS, config['kenlm']['lm'])
+        ]
+    return commands
+
+def model_settings(config, args):
+    """ Backends config file entries for the stand-ins """
+    settings = {}
+    if 'google' in config:
+        settings['google'] = dict(config['google'], backend='google', python_path=[os.path.abspath(args.lm_1b)])
+    if 'gulordava' in config:
+        settings['gulordava'] = dict(config['gulordava'], backend='gulordava', python_path=[os.path.abspath(args.colorlessgreen)])
+    if 'kenlm' in config:
+        settings['kenlm'] = dict(config['kenlm'], backend='kenlm')
+    return settings
+
+def time_run_models(dirname, items, commands, settings=None):
+    """ Wall time of run_models.main over each experiment's items, with the
+    models in settings scored in process """
+    run_models.MODELS = commands
+    run_models.DAEMONS = {}
+    if settings:
+        config_file = os.path.join(dirname, "models.json")
+        os.makedirs(dirname, exist_ok=True)
+        with open(config_file, 'w') as outfile:
+            json.dump(settings, outfile)
+        os.environ[backends.CONFIG_VAR] = config_file
+    times = {}
+    try:
+        for experiment, df in items.items():
+            path = os.path.join(dirname, experiment)
+            os.makedirs(path, exist_ok=True)
+            df.to_csv(os.path.join(path, "items.tsv"), sep="\t", index=False)
+            start = time.perf_counter()
+            run_models.main(path, *commands, "--nocache")
+            times[experiment] = time.perf_counter() - start
+    finally:
+        os.environ.pop(backends.CONFIG_VAR, None)
+    times['total'] = sum(times.values())
+    return times
+
+def compare(old, new):
+    """ Print each metric of new next to its value in old """
+    for backend, metrics in sorted(new['backends'].items()):
+        for metric, value in sorted(metrics.items()):
+            before = old.get('backends', {}).get(backend, {}).get(metric)
+            print_change("%s %s" % (backend, metric), before, value)
+    for key in ['run_models', 'run_models_in_process']:
+        for experiment, value in new.get(key, {}).items():
+            print_change("%s %s seconds" % (key, experiment), old.get(key, {}).get(experiment), value)
+
+def print_change(name, before, after):
+    if before:
+        print("%-45s %12.4g -> %12.4g  (%+.1f%%)" % (name, before, after, 100 * (after - before) / before))
+    else:
+        print("%-45s %12s -> %12.4g" % (name, "-", after))
+
+def main(args):
+    for directory in (args.lm_1b, args.colorlessgreen):
+        if directory:
+            sys.path.insert(0, os.path.abspath(os.path.expanduser(directory)))
+    available, skipped = available_backends(args.backends, args)
+    for backend, reason in skipped.items():
+        print("Skipping %s: %s" % (backend, reason), file=sys.stderr)
+
+    items = experiment_items()
+    sentences = [sentence for df in items.values() for sentence in run_models.sentences(df['word'])]
+    workdir = tempfile.mkdtemp(prefix="rnn_soft_constraints-benchmark-")
+    try:
+        config = make_standins(os.path.join(workdir, "models"), available, items, args.vocab_size)
+        results = {
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'settings': {'vocab_size': args.vocab_size, 'latency_sentences': args.latency_sentences},
+            'skipped': skipped,
+            'backends': {},
+        }
+        for backend in available:
+            print("Benchmarking %s" % backend, file=sys.stderr)
+            results['backends'][backend] = run_isolated(
+                measure_backend, backend, config[backend], sentences, args.latency_sentences)
+        results['run_models'] = time_run_models(
+            os.path.join(workdir, "experiments"), items, model_commands(config, args))
+        results['run_models_in_process'] = time_run_models(
+            os.path.join(workdir, "experiments-in-process"), items, model_commands(config, args),
+            model_settings(config, args))
+    finally:
+        shutil.rmtree(workdir)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(json.load(infile), results)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main(parser.parse_args())
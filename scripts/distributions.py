@@ -0,0 +1,93 @@
+"""Entropy and top candidates of the next-word distribution, per token.
+
+With --candidates K, the scorers compute these from the softmax they
+already have for the surprisals, and write them to a sidecar next to the
+surprisal TSV (output.tsv -> output.tsv.distributions.npz), with one row
+per TSV line:
+* entropy: entropy of the model's distribution over the token at that
+  position, in bits; NaN where the TSV has a dummy surprisal of 0
+* candidates: the K most likely words there, as indices into words, or -1
+  where there is no distribution
+* candidate_surprisals: their surprisals in bits, as float16
+
+run_models --distributions joins them to the results with columns()
+(entropy, plus the candidates and their surprisals as space-separated
+strings).
+
+    write(sidecar_filename("gulordava_output.tsv"), distributions, vocab.id_to_word)
+    df = columns(sidecar_filename("gulordava_output.tsv"))
+"""
+import numpy as np
+import pandas as pd
+
+SUFFIX = ".distributions.npz"
+
+
+def sidecar_filename(output_filename):
+    return output_filename + SUFFIX
+
+def summarize(surprisals, k):
+    """ Entropy and the k best candidates of each row of a [n, vocab]
+    array of surprisals in bits, as numpy arrays """
+    surprisals = np.asarray(surprisals, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        # words with probability 0 have infinite surprisal and add nothing
+        entropy = np.nansum(np.exp2(-surprisals) * surprisals, axis=-1)
+    k = min(k, surprisals.shape[-1])
+    ids = np.argpartition(surprisals, k - 1, axis=-1)[..., :k]
+    candidate_surprisals = np.take_along_axis(surprisals, ids, axis=-1)
+    order = np.argsort(candidate_surprisals, axis=-1, kind='stable')
+    return (entropy, np.take_along_axis(ids, order, axis=-1),
+            np.take_along_axis(candidate_surprisals, order, axis=-1))
+
+def encode(distributions, id_to_word):
+    """ The sidecar arrays for one row per element of distributions: None,
+    or a triple of entropy, candidate ids and candidate surprisals """
+    present = [d for d in distributions if d is not None]
+    k = len(present[0][1]) if present else 0
+    entropy = np.full(len(distributions), np.nan, dtype=np.float32)
+    ids = np.full((len(distributions), k), -1, dtype=np.int64)
+    candidate_surprisals = np.full((len(distributions), k), np.nan, dtype=np.float16)
+    for i, d in enumerate(distributions):
+        if d is not None:
+            entropy[i] = d[0]
+            ids[i] = d[1]
+            candidate_surprisals[i] = d[2]
+    # store only the words that occur, with candidates indexing them
+    vocab_ids, candidates = np.unique(ids, return_inverse=True)
+    candidates = candidates.reshape(ids.shape)
+    words = [id_to_word(int(i)) for i in vocab_ids if i >= 0]
+    if len(vocab_ids) and vocab_ids[0] < 0:
+        candidates = candidates - 1
+    return {
+        'entropy': entropy,
+        'candidates': candidates.astype(np.int32),
+        'candidate_surprisals': candidate_surprisals,
+        'words': np.array(words, dtype=str),
+    }
+
+def write(filename, distributions, id_to_word):
+    """ Write the sidecar for distributions (see encode) to filename """
+    np.savez_compressed(filename, **encode(distributions, id_to_word))
+
+def read(filename):
+    """ The arrays of a sidecar, as a dict """
+    with np.load(filename) as data:
+        return {name: data[name] for name in data.files}
+
+def columns(filename):
+    """ A sidecar as DataFrame columns, one row per TSV line """
+    return frame(read(filename))
+
+def frame(data):
+    """ Sidecar arrays as DataFrame columns """
+    words = np.append(data['words'], '')
+    candidate_words = words[data['candidates']]
+    return pd.DataFrame({
+        'entropy': data['entropy'].astype(np.float64),
+        'candidates': [" ".join(w for w in row if w) for row in candidate_words],
+        'candidate_surprisals': [
+            " ".join("%.3f" % s for s in row if not np.isnan(s))
+            for row in data['candidate_surprisals'].astype(np.float64)
+        ],
+    })
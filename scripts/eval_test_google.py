@@ -7,6 +7,11 @@ import tensorflow as tf
 
 from google.protobuf import text_format
 import data_utils
+import distributions
+import instrumentation
+import prefix_trie
+import scoring_daemon
+import vocab_index
 
 FLAGS = tf.flags.FLAGS
 # General flags.
@@ -16,124 +21,485 @@ tf.flags.DEFINE_string('pbtxt', '',
 tf.flags.DEFINE_string('ckpt', '',
                        'Checkpoint directory used to fill model values.')
 tf.flags.DEFINE_string('vocab_file', '', 'Vocabulary file.')
+tf.flags.DEFINE_string('vocab_index', '',
+                       'Directory written by vocab_index.py; memory-mapped '
+                       'in place of reading vocab_file.')
 tf.flags.DEFINE_string('output_file', '',
                        'File to dump results.')
 tf.flags.DEFINE_string('input_file', '',
                         'file of sentences to be evaluated')
+tf.flags.DEFINE_integer('num_threads', 0,
+                        'Threads for TensorFlow intra- and inter-op '
+                        'parallelism; 0 lets TensorFlow decide.')
+tf.flags.DEFINE_string('serve', '',
+                       'Unix socket path or host:port; if given, keep the '
+                       'model loaded and score sentences sent to it there '
+                       'instead of reading input_file.')
 
 # For saving demo resources, use batch size 1 and step 1.
 BATCH_SIZE = 1
 NUM_TIMESTEPS = 1
 MAX_WORD_LEN = 50
 
+tf.flags.DEFINE_boolean('full_softmax', False,
+                        'Fetch the full softmax at every step and read the '
+                        'target out of it in Python, instead of fetching only '
+                        'the target log-probabilities. Much slower.')
+tf.flags.DEFINE_boolean('prefix_trie', False,
+                        'Run prefixes shared between sentences through the '
+                        'model once, saving and restoring the LSTM state at '
+                        'branch points. Scores one sentence row at a time.')
+tf.flags.DEFINE_integer('candidates', 0,
+                        'Also write the entropy and this many most likely '
+                        'words at each position to a sidecar next to '
+                        'output_file (see distributions.py).')
+tf.flags.DEFINE_boolean('compile_graph', False,
+                        'Write the pbtxt graph, with the scoring tensors '
+                        'added, as a binary GraphDef next to it and exit. '
+                        'Later runs load that instead of parsing the text.')
 
-def _LoadModel(gd_file, ckpt_file):
-  """Load the model from GraphDef and Checkpoint.
+
+# Tensors every graph provides, by key in the tensors dict and graph name
+_GRAPH_TENSORS = [
+    ('states_init', 'states_init'),
+    ('lstm/lstm_0/control_dependency', 'lstm/lstm_0/control_dependency:0'),
+    ('lstm/lstm_1/control_dependency', 'lstm/lstm_1/control_dependency:0'),
+    ('softmax_out', 'softmax_out:0'),
+    ('class_ids_out', 'class_ids_out:0'),
+    ('class_weights_out', 'class_weights_out:0'),
+    ('log_perplexity_out', 'log_perplexity_out:0'),
+    ('inputs_in', 'inputs_in:0'),
+    ('targets_in', 'targets_in:0'),
+    ('target_weights_in', 'target_weights_in:0'),
+    ('char_inputs_in', 'char_inputs_in:0'),
+    ('all_embs', 'all_embs_out:0'),
+    ('softmax_weights', 'Reshape_3:0'),
+    ('global_step', 'global_step:0'),
+]
+
+# Tensors added for scoring; a compiled graph has them already
+_SCORING_TENSORS = [
+    ('target_log_probs_out', 'target_log_probs_out:0'),
+    ('next_ids_in', 'next_ids_in:0'),
+    ('next_log_probs_out', 'next_log_probs_out:0'),
+    ('entropy_out', 'entropy_out:0'),
+    ('top_k_in', 'top_k_in:0'),
+    ('top_log_probs_out', 'top_log_probs_out:0'),
+    ('top_ids_out', 'top_ids_out:0'),
+    ('state_assign', 'state_assign'),
+]
+
+
+def _CompiledGraphFile(gd_file):
+  """Where --compile_graph writes the binary form of gd_file."""
+  return os.path.splitext(gd_file)[0] + '.pb'
+
+
+def _ReadGraphDef(gd_file, use_compiled=True):
+  """Read a GraphDef, from its compiled binary form if there is a current one.
 
   Args:
     gd_file: GraphDef proto text file.
+    use_compiled: whether to look for the compiled form at all.
+
+  Returns:
+    The GraphDef and whether it is compiled, i.e. has the scoring tensors.
+  """
+  gd = tf.GraphDef()
+  compiled_file = _CompiledGraphFile(gd_file)
+  if (use_compiled and os.path.exists(compiled_file) and
+      os.path.getmtime(compiled_file) >= os.path.getmtime(gd_file)):
+    sys.stderr.write('Recovering compiled graph %s\n' % compiled_file)
+    with tf.gfile.FastGFile(compiled_file, 'rb') as f:
+      gd.ParseFromString(f.read())
+    nodes = set(node.name for node in gd.node)
+    if all(name.split(':')[0] in nodes for _, name in _SCORING_TENSORS):
+      return gd, True
+    sys.stderr.write('%s lacks some scoring tensors; rerun --compile_graph\n'
+                     % compiled_file)
+    gd = tf.GraphDef()
+  sys.stderr.write('Recovering graph.\n')
+  with tf.gfile.FastGFile(gd_file, 'r') as f:
+    text_format.Merge(f.read(), gd)
+  return gd, False
+
+
+def _StateVariables(states_init):
+  """Find the LSTM state variables through the assignments states_init runs."""
+  state_vars = []
+  ops = [states_init]
+  while ops:
+    op = ops.pop()
+    if op.type == 'Assign':
+      state_vars.append(op.inputs[0])
+    else:
+      ops.extend(op.control_inputs)
+      ops.extend(i.op for i in op.inputs)
+  return sorted(state_vars, key=lambda v: v.name)
+
+
+def _AddScoringOps(t):
+  """Add the tensors in _SCORING_TENSORS, and the state placeholders, to t."""
+  # Probability of each fed target only, so that scoring copies one float
+  # per position out of the session instead of the whole softmax.
+  flat_targets = tf.reshape(t['targets_in'], [-1])
+  positions = tf.range(tf.shape(flat_targets)[0])
+  t['target_log_probs_out'] = tf.log(tf.gather_nd(
+      t['softmax_out'], tf.stack([positions, flat_targets], axis=1)),
+      name='target_log_probs_out')
+
+  # Log-probabilities of a list of candidate next words at a single step
+  t['next_ids_in'] = tf.placeholder(tf.int32, [None], name='next_ids_in')
+  t['next_log_probs_out'] = tf.log(tf.gather(
+      tf.reshape(t['softmax_out'], [-1]), t['next_ids_in']),
+      name='next_log_probs_out')
+
+  # Entropy (nats) and the top_k_in most likely words of each row of the
+  # softmax, for --candidates; words with probability 0 add nothing
+  t['entropy_out'] = tf.negative(tf.reduce_sum(
+      t['softmax_out'] * tf.log(tf.maximum(t['softmax_out'], 1e-30)), axis=1),
+      name='entropy_out')
+  t['top_k_in'] = tf.placeholder(tf.int32, [], name='top_k_in')
+  top = tf.nn.top_k(t['softmax_out'], t['top_k_in'])
+  t['top_log_probs_out'] = tf.log(top.values, name='top_log_probs_out')
+  t['top_ids_out'] = tf.identity(top.indices, name='top_ids_out')
+
+  # The lstm_0/lstm_1 state lives in variables; read them to save a state
+  # and assign to them to resume from it.
+  t['state_values_in'] = [
+      tf.placeholder(v.dtype.base_dtype, v.get_shape(),
+                     name='state_values_in_%d' % i)
+      for i, v in enumerate(t['state_vars'])]
+  t['state_assign'] = tf.group(*[
+      tf.assign(v, value)
+      for v, value in zip(t['state_vars'], t['state_values_in'])],
+      name='state_assign')
+
+
+def _ImportGraph(gd, compiled):
+  """Import gd into the default graph and return the tensors dict."""
+  tensors = _GRAPH_TENSORS + (_SCORING_TENSORS if compiled else [])
+  t = dict(zip(
+      [key for key, _ in tensors],
+      tf.import_graph_def(gd, {}, [name for _, name in tensors], name='')))
+  t['state_vars'] = _StateVariables(t['states_init'])
+  if compiled:
+    graph = tf.get_default_graph()
+    t['state_values_in'] = [
+        graph.get_tensor_by_name('state_values_in_%d:0' % i)
+        for i in range(len(t['state_vars']))]
+  else:
+    _AddScoringOps(t)
+  return t
+
+
+def _CompileGraph(gd_file):
+  """Write gd_file as a binary GraphDef with the scoring tensors added.
+
+  The weights stay in the checkpoint: they would push the GraphDef past
+  protobuf's 2GB limit, and the LSTM state has to stay in variables.
+  """
+  with tf.Graph().as_default() as graph:
+    gd, _ = _ReadGraphDef(gd_file, use_compiled=False)
+    _ImportGraph(gd, False)
+    compiled_file = _CompiledGraphFile(gd_file)
+    sys.stderr.write('Writing compiled graph %s\n' % compiled_file)
+    tf.train.write_graph(graph.as_graph_def(), os.path.dirname(compiled_file),
+                         os.path.basename(compiled_file), as_text=False)
+
+
+def _LoadModel(gd_file, ckpt_file, num_threads=0):
+  """Load the model from GraphDef and Checkpoint.
+
+  Args:
+    gd_file: GraphDef proto text file; its compiled form is used instead if
+      --compile_graph has written one since it last changed.
     ckpt_file: TensorFlow Checkpoint file.
+    num_threads: cap on TensorFlow's thread pools, or 0 for its default.
 
   Returns:
     TensorFlow session and tensors dict.
   """
   with tf.Graph().as_default():
-    sys.stderr.write('Recovering graph.\n')
-    with tf.gfile.FastGFile(gd_file, 'r') as f:
-      s = f.read()
-      gd = tf.GraphDef()
-      text_format.Merge(s, gd)
-
-    tf.logging.info('Recovering Graph %s', gd_file)
-    t = {}
-    [t['states_init'], t['lstm/lstm_0/control_dependency'],
-     t['lstm/lstm_1/control_dependency'], t['softmax_out'], t['class_ids_out'],
-     t['class_weights_out'], t['log_perplexity_out'], t['inputs_in'],
-     t['targets_in'], t['target_weights_in'], t['char_inputs_in'],
-     t['all_embs'], t['softmax_weights'], t['global_step']
-    ] = tf.import_graph_def(gd, {}, ['states_init',
-                                     'lstm/lstm_0/control_dependency:0',
-                                     'lstm/lstm_1/control_dependency:0',
-                                     'softmax_out:0',
-                                     'class_ids_out:0',
-                                     'class_weights_out:0',
-                                     'log_perplexity_out:0',
-                                     'inputs_in:0',
-                                     'targets_in:0',
-                                     'target_weights_in:0',
-                                     'char_inputs_in:0',
-                                     'all_embs_out:0',
-                                     'Reshape_3:0',
-                                     'global_step:0'], name='')
+    with instrumentation.stage('graph_load', compiled=False) as stage:
+      gd, compiled = _ReadGraphDef(gd_file)
+      tf.logging.info('Recovering Graph %s', gd_file)
+      t = _ImportGraph(gd, compiled)
+      stage.set(compiled=compiled)
 
     sys.stderr.write('Recovering checkpoint %s\n' % ckpt_file)
-    sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
-    sess.run('save/restore_all', {'save/Const:0': ckpt_file})
-    sess.run(t['states_init'])
+    with instrumentation.stage('checkpoint_load'):
+      sess = tf.Session(config=tf.ConfigProto(
+          allow_soft_placement=True,
+          intra_op_parallelism_threads=num_threads,
+          inter_op_parallelism_threads=num_threads))
+      sess.run('save/restore_all', {'save/Const:0': ckpt_file})
+      sess.run(t['states_init'])
 
   return sess, t
 
 
-def _EvalTestSents(input_file, vocab, output_file):
-    targets = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
-    weights = np.ones([BATCH_SIZE, NUM_TIMESTEPS], np.float32)
+def _LoadVocab():
+  if FLAGS.vocab_index:
+    return vocab_index.VocabIndex(FLAGS.vocab_index)
+  return data_utils.CharsVocabulary(FLAGS.vocab_file, MAX_WORD_LEN)
 
-    # Load the model with the given pbtxt file and the checkpoint files
-    sess, t = _LoadModel(FLAGS.pbtxt, FLAGS.ckpt)
 
-    # Read intput file
-    with open(input_file) as f:
-        sents = f.readlines()
+def _LookupSents(vocab, sent_words):
+  """Word ids and char ids of every word, one array of each per sentence."""
+  if not sent_words:
+    return [], []
+  words = [w for words in sent_words for w in words]
+  if isinstance(vocab, vocab_index.VocabIndex):
+    ids, char_ids = vocab.lookup(words)
+  else:
+    ids = np.array([vocab.word_to_id(w) for w in words], np.int32)
+    char_ids = np.array([vocab.word_to_char_ids(w) for w in words],
+                        np.int32).reshape([len(words), vocab.max_word_length])
+  splits = np.cumsum([len(words) for words in sent_words])[:-1]
+  return np.split(ids, splits), np.split(char_ids, splits)
+
+
+def _Rows(vocab, sent_ids, surprisals, sent_distributions=None):
+    """(word, surprisal) rows for every token of every sentence.
 
+    The first word and the final <eos> get a dummy surprisal of 0. With
+    sent_distributions, the rows are (word, surprisal, distribution) triples,
+    with no distribution for those two.
+    """
     result = []
+    for i, (ids, sent_surprisals) in enumerate(zip(sent_ids, surprisals)):
+        dists = (sent_distributions[i] if sent_distributions is not None
+                 else [None] * len(sent_surprisals))
+        rows = [(vocab.id_to_word(ids[0]), 0.0, None)]
+        for n, (surprisal, dist) in enumerate(zip(sent_surprisals, dists)):
+            rows.append((vocab.id_to_word(ids[n+1]), surprisal, dist))
+        rows.append(("<eos>", 0.0, None))
+        if sent_distributions is None:
+            rows = [row[:2] for row in rows]
+        result.extend(rows)
+    return result
 
-    for j in range(len(sents)):
 
-        # Just so we know where things stand
-        #if (j%10 == 0):
-          #print(j/len(sents))
+def _ScoreSents(sess, t, vocab, sents, full_softmax=False, candidates=0):
+    """Score sentences with a loaded model.
 
-        inputs = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
-        char_ids_inputs = np.zeros( [BATCH_SIZE, NUM_TIMESTEPS, vocab.max_word_length], np.int32)
-        
-        sent = [vocab.word_to_id(w) for w in sents[j].split()]
-        sent_char_ids = [vocab.word_to_char_ids(w) for w in sents[j].split()]
+    The released graph takes one word of one sentence per session call, so
+    each sentence is fed a word at a time from a freshly reset LSTM state.
 
-        samples = sent[:]
-        char_ids_samples = sent_char_ids[:]
+    Args:
+      sess: TensorFlow session from _LoadModel.
+      t: tensors dict from _LoadModel.
+      vocab: CharsVocabulary or VocabIndex.
+      sents: list of sentence strings, each ending in <eos>.
+      full_softmax: fetch the whole softmax and pick out the targets in
+        Python, rather than fetching only the targets' log-probabilities.
+      candidates: if nonzero, also fetch the entropy and this many most
+        likely words at each position.
 
-        # Total sentence surprisal
-        total_surprisal = 0
+    Returns:
+      List of (word, surprisal) pairs, one per token, in input order, or of
+      (word, surprisal, distribution) triples with candidates (see _Rows).
+    """
+    with instrumentation.stage('tokenization', tokens=0) as stage:
+      sent_ids, sent_char_ids = _LookupSents(vocab, [s.split() for s in sents])
+      stage.set(tokens=sum(len(ids) for ids in sent_ids))
+
+    # The model is fed every word but the last two and predicts the next one;
+    # the final <eos> gets a dummy surprisal like the first word.
+    num_steps = [max(len(ids) - 2, 0) for ids in sent_ids]
+    surprisals = [np.zeros(n, np.float32) for n in num_steps]
+    if candidates:
+      entropies = [np.zeros(n, np.float32) for n in num_steps]
+      top_ids = [np.zeros([n, candidates], np.int64) for n in num_steps]
+      top_surprisals = [np.zeros([n, candidates], np.float32) for n in num_steps]
+
+    inputs = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
+    char_ids_inputs = np.zeros(
+        [BATCH_SIZE, NUM_TIMESTEPS, vocab.max_word_length], np.int32)
+    targets = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
+    weights = np.ones([BATCH_SIZE, NUM_TIMESTEPS], np.float32)
 
-        # First word in the sentence has a dummy surprisal of 0
-        result.append(vocab.id_to_word(sent[0]) + "\t0.00")
+    # The softmax is part of the graph, so forward includes it unless
+    # full_softmax fetches it whole
+    forward = instrumentation.Stage('forward', profile=True)
+    softmax = instrumentation.Stage('softmax', profile=True)
+    progress = instrumentation.Progress(sum(num_steps), 'tokens', 'forward')
+    for j, ids in enumerate(sent_ids):
         sess.run(t['states_init'])
+        for n in range(num_steps[j]):
+            inputs[0, 0] = ids[n]
+            char_ids_inputs[0, 0, :] = sent_char_ids[j][n]
+            targets[0, 0] = ids[n + 1]
+            feed_dict = {t['char_inputs_in']: char_ids_inputs,
+                         t['inputs_in']: inputs,
+                         t['targets_in']: targets,
+                         t['target_weights_in']: weights}
+            if full_softmax:
+                with forward:
+                    softmax_out = sess.run(t['softmax_out'], feed_dict=feed_dict)
+                with softmax:
+                    log_probs = np.log(softmax_out[0, ids[n + 1]])
+                    if candidates:
+                        entropy, word_ids, top = distributions.summarize(
+                            -np.log2(softmax_out), candidates)
+            elif candidates:
+                feed_dict[t['top_k_in']] = candidates
+                with forward:
+                    log_probs, entropy, word_ids, top_log_probs = sess.run(
+                        [t['target_log_probs_out'], t['entropy_out'],
+                         t['top_ids_out'], t['top_log_probs_out']],
+                        feed_dict=feed_dict)
+                entropy = entropy / np.log(2)
+                top = -1 * top_log_probs / np.log(2)
+            else:
+                with forward:
+                    log_probs = sess.run(t['target_log_probs_out'],
+                                         feed_dict=feed_dict)
+            surprisals[j][n] = -1 * np.reshape(log_probs, -1)[0] / np.log(2)
+            if candidates:
+                entropies[j][n] = entropy[0]
+                top_ids[j][n] = word_ids[0]
+                top_surprisals[j][n] = top[0]
+            progress.update()
+    forward.emit(tokens=sum(num_steps))
+    if full_softmax:
+        softmax.emit(tokens=sum(num_steps))
 
-        for n in range(len(sents[j].split(" "))-2):
-            inputs[0, 0] = samples[0]
-            char_ids_inputs[0, 0, :] = char_ids_samples[0]
-            samples = samples[1:]
-            char_ids_samples = char_ids_samples[1:]
-            softmax = sess.run(t['softmax_out'],
-                                 feed_dict={t['char_inputs_in']: char_ids_inputs,
-                                            t['inputs_in']: inputs,
-                                            t['targets_in']: targets,
-                                            t['target_weights_in']: weights})
+    if not candidates:
+        return _Rows(vocab, sent_ids, surprisals)
+    return _Rows(vocab, sent_ids, surprisals, [
+        list(zip(*arrays)) for arrays in zip(entropies, top_ids, top_surprisals)])
 
-            surprisal = -1 * np.log2(softmax[0][sent[n+1]])
-            total_surprisal += surprisal
-            result.append(vocab.id_to_word(sent[n+1])+"\t"+str(surprisal))
 
-        # Add EOS token and total sentence surprisal to result
-        result.append("<eos>\t0.0")
+def _ScoreSentsTrie(sess, t, vocab, sents, candidates=0):
+    """Score sentences, running each shared prefix through the model once.
+
+    Works on the released graph with batch size 1 and step 1. The LSTM state
+    after a prefix is read out of the session and assigned back before each
+    branch that continues it. The trie is over the words themselves, not
+    their ids: the model reads each word's characters too, so two different
+    out-of-vocabulary words are different inputs.
+
+    Args:
+      sess: TensorFlow session from _LoadModel.
+      t: tensors dict from _LoadModel.
+      vocab: CharsVocabulary or VocabIndex.
+      sents: list of sentence strings, each ending in <eos>.
+      candidates: as for _ScoreSents.
+
+    Returns:
+      The rows of _ScoreSents.
+    """
+    inputs = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
+    char_ids_inputs = np.zeros(
+        [BATCH_SIZE, NUM_TIMESTEPS, vocab.max_word_length], np.int32)
+    targets = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
+    weights = np.ones([BATCH_SIZE, NUM_TIMESTEPS], np.float32)
+    word_ids = {}
+    char_ids = {}
+    loaded = [None]
+    # forward includes the softmax, which is part of the graph
+    forward = instrumentation.Stage('forward', profile=True)
+    state = instrumentation.Stage('state_restore')
+
+    def step(state_values, word, next_words):
+      if loaded[0] is not state_values:
+        with state:
+          sess.run(t['state_assign'],
+                   feed_dict=dict(zip(t['state_values_in'], state_values)))
+      inputs[0, 0] = word_ids[word]
+      char_ids_inputs[0, 0, :] = char_ids[word]
+      feed_dict = {t['char_inputs_in']: char_ids_inputs,
+                   t['inputs_in']: inputs,
+                   t['targets_in']: targets,
+                   t['target_weights_in']: weights,
+                   t['next_ids_in']: [word_ids[w] for w in next_words]}
+      with forward:
+        if candidates:
+          feed_dict[t['top_k_in']] = candidates
+          log_probs, entropy, ids, top_log_probs = sess.run(
+              [t['next_log_probs_out'], t['entropy_out'], t['top_ids_out'],
+               t['top_log_probs_out']], feed_dict=feed_dict)
+        else:
+          log_probs = sess.run(t['next_log_probs_out'], feed_dict=feed_dict)
+        loaded[0] = sess.run(t['state_vars'])
+      progress.update()
+      if candidates:
+        return loaded[0], log_probs / np.log(2), (
+            entropy[0] / np.log(2), ids[0], -1 * top_log_probs[0] / np.log(2))
+      return loaded[0], log_probs / np.log(2)
+
+    with instrumentation.stage('tokenization') as stage:
+      sent_words = [s.split() for s in sents]
+      sent_ids, sent_char_ids = _LookupSents(vocab, sent_words)
+      for words, ids, word_char_ids in zip(sent_words, sent_ids, sent_char_ids):
+        for word, word_id, word_chars in zip(words, ids.tolist(), word_char_ids):
+          word_ids[word] = word_id
+          char_ids[word] = word_chars
+      sent_ids = [ids.tolist() for ids in sent_ids]
+      stage.set(tokens=sum(len(ids) for ids in sent_ids))
+
+    sess.run(t['states_init'])
+    initial_state = sess.run(t['state_vars'])
+    # Like _ScoreSents, the final <eos> is not predicted
+    progress = instrumentation.Progress(
+        prefix_trie.count_steps([words[:-1] for words in sent_words]), 'steps', 'forward')
+    surprisals = prefix_trie.trie_surprisals(
+        [words[:-1] for words in sent_words], initial_state, step, bool(candidates))
+    forward.emit(tokens=sum(len(ids) for ids in sent_ids))
+    state.emit()
+
+    if not candidates:
+        return _Rows(vocab, sent_ids, surprisals)
+    return _Rows(vocab, sent_ids,
+                 [[surprisal for surprisal, _ in pairs] for pairs in surprisals],
+                 [[dist for _, dist in pairs] for pairs in surprisals])
+
+
+def _Scorer(sess, t, vocab, candidates=0):
+  if FLAGS.prefix_trie:
+    return lambda sents: _ScoreSentsTrie(sess, t, vocab, sents, candidates)
+  return lambda sents: _ScoreSents(sess, t, vocab, sents, FLAGS.full_softmax,
+                                   candidates)
+
+
+def _EvalTestSents(input_file, vocab, output_file):
+    # Load the model with the given pbtxt file and the checkpoint files
+    sess, t = _LoadModel(FLAGS.pbtxt, FLAGS.ckpt, FLAGS.num_threads)
+
+    # Read intput file
+    with open(input_file) as f:
+        sents = f.readlines()
+
+    result = _Scorer(sess, t, vocab, FLAGS.candidates)(sents)
 
     # Write result to output file
-    with open(output_file, 'w') as f:
-      f.writelines([x + "\n" for x in result])
-            
+    with instrumentation.stage('output', tokens=len(result)):
+      with open(output_file, 'w') as f:
+        f.writelines(["%s\t%s\n" % row[:2] for row in result])
+      if FLAGS.candidates:
+        distributions.write(distributions.sidecar_filename(output_file),
+                            [row[2] for row in result], vocab.id_to_word)
+
+
+def _ServeSents(address, vocab):
+  # Keep the session resident and score whatever the daemon is sent
+  sess, t = _LoadModel(FLAGS.pbtxt, FLAGS.ckpt, FLAGS.num_threads)
+  identity = scoring_daemon.fingerprint(
+      [FLAGS.pbtxt, FLAGS.ckpt, FLAGS.vocab_index or FLAGS.vocab_file])
+  scoring_daemon.serve(address, _Scorer(sess, t, vocab), identity)
+
 def main(unused_argv):
-  vocab = data_utils.CharsVocabulary(FLAGS.vocab_file, MAX_WORD_LEN)
-  _EvalTestSents(FLAGS.input_file, vocab, FLAGS.output_file)
+  if FLAGS.compile_graph:
+    _CompileGraph(FLAGS.pbtxt)
+    return
+  with instrumentation.stage('vocab_load'):
+    vocab = _LoadVocab()
+  if FLAGS.serve:
+    _ServeSents(FLAGS.serve, vocab)
+  else:
+    _EvalTestSents(FLAGS.input_file, vocab, FLAGS.output_file)
 
 if __name__ == '__main__':
   tf.app.run()
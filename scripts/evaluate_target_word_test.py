@@ -6,15 +6,25 @@
 #
 
 import argparse
+import functools
+import inspect
+import math
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 import dictionary_corpus
+import distributions
+import exported_model
+import instrumentation
 from utils import repackage_hidden, batchify, get_batch
 import numpy as np
 
+import prefix_trie
+import scoring_daemon
+import sharding
+
 parser = argparse.ArgumentParser(description='Mask-based evaluation: extracts softmax vectors for specified words')
 
 parser.add_argument('--data', type=str,
@@ -29,118 +39,423 @@ parser.add_argument('--sentences', type=int, default='-1',
                     help='number of sentences to generate from prefix')
 parser.add_argument('--temperature', type=float, default=1.0,
                     help='temperature - higher will increase diversity')
+parser.add_argument('--topk', type=int, default=0,
+                    help='in generation mode, sample only from the k most likely words (0 for all)')
+parser.add_argument('--topp', type=float, default=1.0,
+                    help='in generation mode, sample only from the most likely words with this much probability')
+parser.add_argument('--samplebatch', type=int, default=256,
+                    help='in generation mode, number of continuations sampled in parallel')
+parser.add_argument('--maxlength', type=int, default=100,
+                    help='in generation mode, cut continuations off after this many words')
+parser.add_argument('--eachline', action='store_true',
+                    help='in generation mode, sample --sentences continuations of each line of --prefixfile')
 parser.add_argument('--outf', type=str, default='generated.txt',
                     help='output file for generated text')
 parser.add_argument('--prefixfile', type=str, default='',
                     help='File with sentence prefix from which to generate continuations')
 parser.add_argument('--surprisalmode', type=bool, default=False,
                     help='Run in surprisal mode; specify sentence with --prefixfile')
+parser.add_argument('--prefixtrie', action='store_true',
+                    help='In surprisal mode, run shared sentence prefixes through the model only once')
+parser.add_argument('--batchtokens', type=int, default=0,
+                    help='In surprisal mode, score length-bucketed batches of sentences up to this many padded tokens at once')
+parser.add_argument('--candidates', type=int, default=0,
+                    help='In surprisal mode, also write the entropy and this many most likely words at each position to a sidecar next to --outf (see distributions.py)')
+parser.add_argument('--shards', type=int, default=1,
+                    help='In surprisal mode, score the sentences in this many forked processes sharing the loaded model')
+parser.add_argument('--quantize', action='store_true',
+                    help='On CPU, run the LSTM and the decoder with dynamic int8 quantization (see quantization_report.py)')
+parser.add_argument('--export', type=str, default='',
+                    help='write the model and dictionary to this directory for --exported, and exit')
+parser.add_argument('--exported', type=str, default='',
+                    help='directory written by --export; memory-mapped in place of --checkpoint and --data')
+parser.add_argument('--serve', type=str, default='',
+                    help='Unix socket path or host:port; keep the model loaded and score sentences sent there')
 
 
-args = parser.parse_args()
-
+def load_model(checkpoint, cuda):
+    # the checkpoint is a whole pickled model, which newer torch refuses
+    # to load by default
+    kwds = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    with open(checkpoint, 'rb') as f:
+        print("Loading the model")
+        if cuda:
+            model = torch.load(f, **kwds)
+        else:
+            # to convert model trained on cuda to cpu model
+            model = torch.load(f, map_location = lambda storage, loc: storage, **kwds)
+    model.eval()
 
-# Set the random seed manually for reproducibility.
-torch.manual_seed(args.seed)
-if torch.cuda.is_available():
-    if not args.cuda:
-        print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+    if cuda:
+        model.cuda()
     else:
-        torch.cuda.manual_seed(args.seed)
+        model.cpu()
+    return model
 
-with open(args.checkpoint, 'rb') as f:
-    print("Loading the model")
-    if args.cuda:
-        model = torch.load(f)
-    else:
-        # to convert model trained on cuda to cpu model
-        model = torch.load(f, map_location = lambda storage, loc: storage)
-model.eval()
-
-if args.cuda:
-    model.cuda()
-else:
-    model.cpu()
-
-print("#####HERE###")
-    
-eval_batch_size = 1
-seq_len = 20
-
-dictionary = dictionary_corpus.Dictionary(args.data)
-vocab_size = len(dictionary)
-print("Vocab size", vocab_size)
-print("TESTING")
-
-# assuming the mask file contains one number per line indicating the index of the target word
-index_col = 0
-
-
-###
-prefix = dictionary_corpus.tokenize(dictionary,args.prefixfile)
-#print(prefix.shape)
-#for w in prefix:
-#    print(dictionary.idx2word[w.item()])
-# try auto-generate
-if not args.surprisalmode:
-    # print(type(prefix))
-    # print(prefix.shape)
-    # print(prefix)
-    hidden = model.init_hidden(1)
-    ntokens = dictionary.__len__()
-    device = torch.device("cuda" if args.cuda else "cpu")
-    input = torch.randint(ntokens, (1, 1), dtype=torch.long).to(device)
-    with open(args.outf, 'w') as outf:
-        for i in range(args.sentences):
-            for word in prefix:
-                #print(word)
-                #print(word.item())
-                outf.write(dictionary.idx2word[word.item()] + " ")
-                input.fill_(word.item())
-                output, hidden = model(input,hidden)
-            generated_word = None
-            while generated_word != "<eos>":
-                word_weights = output.squeeze().div(args.temperature).exp().cpu()
-                word_idx = torch.multinomial(word_weights, 1)[0]
-                input.fill_(word_idx)
-                generated_word = dictionary.idx2word[word_idx]
-                outf.write(generated_word + " ")
-                output, hidden = model(input, hidden)
-            outf.write("\n")
-
-
-if args.surprisalmode:
+
+def quantize(model):
+    """ Copy of model with int8 weights in the LSTM and decoder; activations
+    are quantized on the fly, per batch """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def tokenize_sentence(dictionary, sentence):
+    # same mapping as dictionary_corpus.tokenize, for a string instead of a file
+    if isinstance(dictionary, exported_model.MappedDictionary):
+        return dictionary.tokenize(sentence.split())
+    unk = dictionary.word2idx["<unk>"]
+    return torch.LongTensor([dictionary.word2idx.get(w, unk) for w in sentence.split()])
+
+
+def tokenize_file(dictionary, path):
+    if isinstance(dictionary, exported_model.MappedDictionary):
+        with open(path, encoding="utf8") as f:
+            return dictionary.tokenize(f.read().split())
+    return dictionary_corpus.tokenize(dictionary, path)
+
+
+def split_sentences(prefix, eosidx):
     sentences = []
     thesentence = []
-    eosidx = dictionary.word2idx["<eos>"]
     for w in prefix:
         thesentence.append(w)
         if w == eosidx:
-            sentences.append(thesentence)
+            sentences.append(torch.stack(thesentence))
             thesentence = []
-    print(sentences)
-    ntokens = dictionary.__len__()
+    return sentences
+
+
+def repeat_hidden(hidden, n):
+    """ n copies of a batch-of-one LSTM state """
+    if isinstance(hidden, tuple):
+        return tuple(repeat_hidden(h, n) for h in hidden)
+    return hidden.repeat(1, n, 1)
+
+
+def cat_hidden(hidden, other):
+    if isinstance(hidden, tuple):
+        return tuple(cat_hidden(h, o) for h, o in zip(hidden, other))
+    return torch.cat([hidden, other], 1)
+
+
+def select_hidden(hidden, index):
+    if isinstance(hidden, tuple):
+        return tuple(select_hidden(h, index) for h in hidden)
+    return hidden.index_select(1, index)
+
+
+def filter_logits(logits, top_k=0, top_p=1.0):
+    """ logits with every word outside the top_k, and outside the smallest
+    set of most likely words with probability top_p, set to -inf """
+    if top_k > 0:
+        kth = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1)[0][..., -1:]
+        logits = logits.masked_fill(logits < kth, -float('inf'))
+    if top_p < 1.0:
+        sorted_logits, order = torch.sort(logits, dim=-1, descending=True)
+        probs = F.softmax(sorted_logits, dim=-1)
+        # drop a word once the more likely words before it reach top_p;
+        # the most likely word always stays
+        drop = probs.cumsum(dim=-1) - probs >= top_p
+        logits = logits.masked_fill(torch.zeros_like(drop).scatter(-1, order, drop), -float('inf'))
+    return logits
+
+
+def sample_continuations(model, prefix, nsamples, temperature, device, eosidx,
+                         batchsize=256, top_k=0, top_p=1.0, maxlength=100):
+    """ Yield nsamples continuations of prefix (word indices, up to and
+    including <eos>, or maxlength words), sampled batchsize at a time.
+
+    The prefix is run through the model once; every sample starts from a
+    copy of its state. A row is retired as soon as it samples <eos>, and a
+    new sample takes its place, so the batch stays full. Continuations come
+    out in the order they finish.
+    """
+    with torch.no_grad():
+        output, prefix_hidden = model(prefix.view(-1, 1).to(device), model.init_hidden(1))
+        prefix_logits = output[-1]
+        # the state of the rows being sampled; row r has lengths[r] words so far
+        logits = prefix_logits[:0]
+        hidden = repeat_hidden(prefix_hidden, 0)
+        words = torch.zeros(maxlength, 0, dtype=torch.long, device=device)
+        lengths = torch.zeros(0, dtype=torch.long, device=device)
+        started = 0
+        while started < nsamples or len(lengths):
+            new = min(batchsize - len(lengths), nsamples - started)
+            if new > 0:
+                logits = torch.cat([logits, prefix_logits.expand(new, -1)])
+                hidden = cat_hidden(hidden, repeat_hidden(prefix_hidden, new))
+                words = torch.cat([words, words.new_zeros(maxlength, new)], 1)
+                lengths = torch.cat([lengths, lengths.new_zeros(new)])
+                started += new
+            probs = F.softmax(filter_logits(logits.div(temperature), top_k, top_p), dim=-1)
+            word = torch.multinomial(probs, 1).squeeze(1)
+            words[lengths, torch.arange(len(lengths), device=device)] = word
+            lengths += 1
+            done = (word == eosidx) | (lengths >= maxlength)
+            if done.any():
+                finished = done.nonzero().squeeze(1)
+                for row, length in zip(words[:, finished].t().tolist(), lengths[finished].tolist()):
+                    yield row[:length]
+                keep = (~done).nonzero().squeeze(1)
+                word, words, lengths = word[keep], words[:, keep], lengths[keep]
+                hidden = select_hidden(hidden, keep)
+                if not len(lengths):
+                    logits = logits[:0]
+                    continue
+            output, hidden = model(word.view(1, -1), hidden)
+            logits = output[0]
+
+
+def generate(model, dictionary, prefixes, outf, nsentences, temperature, device,
+             batchsize=256, top_k=0, top_p=1.0, maxlength=100):
+    """ Write nsentences sampled continuations of each prefix to outf, one
+    per line after the prefix, as they finish """
+    eosidx = dictionary.word2idx["<eos>"]
+    progress = instrumentation.Progress(nsentences * len(prefixes), 'samples', 'sampling')
+    with instrumentation.stage('sampling') as stage:
+        tokens = 0
+        for prefix in prefixes:
+            prefix_text = "".join(dictionary.idx2word[w] + " " for w in prefix.tolist())
+            for continuation in sample_continuations(model, prefix, nsentences, temperature, device, eosidx,
+                                                     batchsize, top_k, top_p, maxlength):
+                outf.write(prefix_text + "".join(dictionary.idx2word[w] + " " for w in continuation) + "\n")
+                tokens += len(continuation)
+                progress.update()
+            outf.flush()
+        stage.set(tokens=tokens)
+
+
+def surprisals(output, temperature):
+    """ Surprisal in bits of every word in the vocabulary given a model output """
+    return -F.log_softmax(output.div(temperature), dim=-1) / math.log(2)
+
+
+def summarize(word_surprisals, candidates):
+    """ Entropy (bits) and the best candidates with their surprisals, on the
+    CPU, at each position of a [..., vocab] tensor of surprisals """
+    # words with probability 0 add nothing, rather than 0 * inf
+    entropy = (torch.exp2(-word_surprisals) * word_surprisals).nan_to_num(0.0, 0.0, 0.0).sum(-1)
+    candidate_surprisals, ids = torch.topk(word_surprisals, candidates, dim=-1, largest=False)
+    return entropy.cpu().numpy(), ids.cpu().numpy(), candidate_surprisals.cpu().numpy()
+
+
+def length_batches(sentences, batchtokens):
+    """ Group sentence indices by length into batches of at most batchtokens
+    padded tokens (but at least one sentence each) """
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    batch = []
+    for i in order:
+        # sorted by length, so sentence i is the longest in the batch so far
+        if batch and (len(batch) + 1) * len(sentences[i]) > batchtokens:
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def batch_surprisals(model, sentences, temperature, device, forward=None, softmax=None, candidates=0):
+    """ Surprisals of words 1..n of each sentence, run as one [T, B] batch.
+
+    Sentences are padded at the end, so padding never feeds into the real
+    positions; padded positions are masked out of the result. The model
+    call and the normalization are timed in the instrumentation stages
+    forward and softmax, if given. With candidates, also returns the
+    (entropy, candidate ids, candidate surprisals) at each of those
+    positions.
+    """
+    forward = forward or instrumentation.Stage('forward')
+    softmax = softmax or instrumentation.Stage('softmax')
+    lengths = torch.tensor([len(sentence) for sentence in sentences])
+    input = torch.zeros(lengths.max().item(), len(sentences), dtype=torch.long)
+    for b, sentence in enumerate(sentences):
+        input[:len(sentence), b] = sentence
+    input = input.to(device)
+    with forward:
+        output, hidden = model(input, model.init_hidden(len(sentences)))
+    with softmax:
+        targets = input[1:]
+        all_surprisals = surprisals(output[:-1], temperature)
+        word_surprisals = all_surprisals.gather(2, targets.unsqueeze(2)).squeeze(2)
+        mask = torch.arange(1, input.size(0)).unsqueeze(1) < lengths.unsqueeze(0)
+        word_surprisals = word_surprisals.cpu().masked_fill(~mask, 0.0)
+        result = [word_surprisals[:length - 1, b].tolist() for b, length in enumerate(lengths.tolist())]
+        if not candidates:
+            return result
+        entropy, ids, candidate_surprisals = summarize(all_surprisals, candidates)
+    return result, [
+        [(entropy[i, b], ids[i, b], candidate_surprisals[i, b]) for i in range(length - 1)]
+        for b, length in enumerate(lengths.tolist())
+    ]
+
+
+def sentence_rows(dictionary, sentences, sentence_surprisals, sentence_distributions=None):
+    """ (word, surprisal) rows, or (word, surprisal, distribution) rows with
+    distributions, for every token; the first word of each sentence has a
+    dummy surprisal of 0 and no distribution """
+    for i, (sentence, word_surprisals) in enumerate(zip(sentences, sentence_surprisals)):
+        words = [dictionary.idx2word[int(w)] for w in sentence]
+        if sentence_distributions is None:
+            yield words[0], 0.0
+            for word, word_surprisal in zip(words[1:], word_surprisals):
+                yield word, word_surprisal
+        else:
+            yield words[0], 0.0, None
+            for word, word_surprisal, distribution in zip(words[1:], word_surprisals, sentence_distributions[i]):
+                yield word, word_surprisal, distribution
+
+
+def batched_sentence_surprisals(model, dictionary, sentences, temperature, device, batchtokens=0, candidates=0):
+    """ Yield (word, surprisal) for each token of each sentence of word indices.
+
+    Sentences are bucketed by length into batches of about batchtokens
+    padded tokens (one sentence per batch when batchtokens is 0), and each
+    batch goes through the model in one call. The surprisal of each next
+    word is read off the log-softmax with one indexing op. Rows come out in
+    the original sentence order. With candidates, rows also carry the
+    distribution at each position (see sentence_rows).
+    """
+    sentence_surprisals = [None] * len(sentences)
+    sentence_distributions = [None] * len(sentences) if candidates else None
+    forward = instrumentation.Stage('forward', profile=True)
+    softmax = instrumentation.Stage('softmax', profile=True)
+    progress = instrumentation.Progress(len(sentences), 'sentences', 'forward')
+    for batch in length_batches(sentences, batchtokens):
+        batch_sentences = [sentences[i] for i in batch]
+        result = batch_surprisals(model, batch_sentences, temperature, device, forward, softmax, candidates)
+        if candidates:
+            result, batch_distributions = result
+            for i, word_distributions in zip(batch, batch_distributions):
+                sentence_distributions[i] = word_distributions
+        for i, word_surprisals in zip(batch, result):
+            sentence_surprisals[i] = word_surprisals
+        progress.update(len(batch))
+    tokens = sum(len(sentence) for sentence in sentences)
+    forward.emit(tokens=tokens)
+    softmax.emit(tokens=tokens)
+    return sentence_rows(dictionary, sentences, sentence_surprisals, sentence_distributions)
+
+
+def trie_sentence_surprisals(model, dictionary, sentences, temperature, device, candidates=0):
+    """ Same rows as batched_sentence_surprisals, but each shared
+    prefix is run through the model once and its hidden state reused """
+    forward = instrumentation.Stage('forward', profile=True)
+    softmax = instrumentation.Stage('softmax', profile=True)
+
+    def step(hidden, word, next_words):
+        input = torch.full((1, 1), word, dtype=torch.long, device=device)
+        with forward:
+            output, hidden = model(input, hidden)
+        with softmax:
+            word_surprisals = surprisals(output.view(-1), temperature)
+            log_probs = (-word_surprisals[next_words]).tolist()
+            distribution = summarize(word_surprisals, candidates) if candidates else None
+        progress.update()
+        return (hidden, log_probs, distribution) if candidates else (hidden, log_probs)
+
+    sentences = [[w.item() for w in sentence] for sentence in sentences]
+    progress = instrumentation.Progress(prefix_trie.count_steps(sentences), 'steps', 'forward')
+    sentence_surprisals = prefix_trie.trie_surprisals(sentences, model.init_hidden(1), step, bool(candidates))
+    tokens = sum(len(sentence) for sentence in sentences)
+    forward.emit(tokens=tokens)
+    softmax.emit(tokens=tokens)
+    if not candidates:
+        return sentence_rows(dictionary, sentences, sentence_surprisals)
+    return sentence_rows(
+        dictionary, sentences,
+        [[surprisal for surprisal, _ in pairs] for pairs in sentence_surprisals],
+        [[distribution for _, distribution in pairs] for pairs in sentence_surprisals],
+    )
+
+
+def score_sentences(model, dictionary, sentences, temperature, device, prefixtrie=False, batchtokens=0, shards=1, candidates=0):
+    if shards > 1:
+        # one thread per worker, so the shards don't fight over the cores
+        score = functools.partial(score_sentences, model, dictionary,
+                                  temperature=temperature, device=device,
+                                  prefixtrie=prefixtrie, batchtokens=batchtokens, candidates=candidates)
+        return sharding.score_sharded(score, sentences, shards, functools.partial(torch.set_num_threads, 1))
+    with torch.no_grad():
+        if prefixtrie:
+            return list(trie_sentence_surprisals(model, dictionary, sentences, temperature, device, candidates))
+        else:
+            return list(batched_sentence_surprisals(model, dictionary, sentences, temperature, device, batchtokens, candidates))
+
+
+def main(args):
+    # Set the random seed manually for reproducibility.
+    torch.manual_seed(args.seed)
+    if torch.cuda.is_available():
+        if not args.cuda:
+            print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+        else:
+            torch.cuda.manual_seed(args.seed)
+
+    if args.exported:
+        with instrumentation.stage('model_load'):
+            model, dictionary = exported_model.load(args.exported, args.cuda)
+    else:
+        with instrumentation.stage('model_load'):
+            model = load_model(args.checkpoint, args.cuda)
+
+        print("#####HERE###")
+
+        with instrumentation.stage('vocab_load'):
+            dictionary = dictionary_corpus.Dictionary(args.data)
+    if args.export:
+        exported_model.export(model, dictionary, args.export)
+        return
+    if args.quantize:
+        if args.cuda:
+            raise ValueError("--quantize is for CPU inference only")
+        model = quantize(model)
+    vocab_size = len(dictionary)
+    print("Vocab size", vocab_size)
+    print("TESTING")
+
     device = torch.device("cuda" if args.cuda else "cpu")
-    with open(args.outf, 'w') as outf:
-        for sentence in sentences:
-            torch.manual_seed(args.seed)
-            hidden = model.init_hidden(1)
-            input = torch.randint(ntokens, (1, 1), dtype=torch.long).to(device)
-            totalsurprisal = 0.0
-            firstword = sentence[0]
-            input.fill_(firstword.item())
-            outf.write(dictionary.idx2word[firstword.item()] + "\t0.00\n")
-            output, hidden = model(input,hidden)        
-            word_weights = output.squeeze().div(args.temperature).exp().cpu()
-            word_surprisals = -1*torch.log2(word_weights/sum(word_weights))
-            for word in sentence[1:len(prefix)]:
-                  word_surprisal = word_surprisals[word].item()
-                  outf.write(dictionary.idx2word[word.item()] + "\t" + str(word_surprisal) + "\n")
-                  input.fill_(word.item())
-                  output, hidden = model(input, hidden)
-                  word_weights = output.squeeze().div(args.temperature).exp().cpu()
-                  word_surprisals = -1*torch.log2(word_weights/sum(word_weights))
 
+    if args.serve:
+        def score(sents):
+            with instrumentation.stage('tokenization') as stage:
+                sentences = [tokenize_sentence(dictionary, sent) for sent in sents]
+                stage.set(tokens=sum(len(sentence) for sentence in sentences))
+            return score_sentences(model, dictionary, sentences, args.temperature, device, args.prefixtrie, args.batchtokens, args.shards)
+        files = [args.exported] if args.exported else [args.checkpoint, args.data]
+        identity = scoring_daemon.fingerprint(files, quantize=args.quantize, temperature=args.temperature)
+        scoring_daemon.serve(args.serve, score, identity)
+        return
+
+    ###
+    with instrumentation.stage('tokenization') as stage:
+        prefix = tokenize_file(dictionary, args.prefixfile)
+        stage.set(tokens=len(prefix))
+    #print(prefix.shape)
+    #for w in prefix:
+    #    print(dictionary.idx2word[w.item()])
+    # try auto-generate
+    if not args.surprisalmode:
+        if args.eachline:
+            with open(args.prefixfile, encoding="utf8") as f:
+                prefixes = [tokenize_sentence(dictionary, line) for line in f if line.split()]
+        else:
+            prefixes = [prefix]
+        with open(args.outf, 'w') as outf:
+            generate(model, dictionary, prefixes, outf, args.sentences, args.temperature, device,
+                     args.samplebatch, args.topk, args.topp, args.maxlength)
 
+    if args.surprisalmode:
+        sentences = split_sentences(prefix, dictionary.word2idx["<eos>"])
+        print(sentences)
+        rows = score_sentences(model, dictionary, sentences, args.temperature, device, args.prefixtrie, args.batchtokens, args.shards, args.candidates)
+        with instrumentation.stage('output', tokens=len(rows)):
+            with open(args.outf, 'w') as outf:
+                for row in rows:
+                    outf.write(row[0] + "\t" + str(row[1]) + "\n")
+            if args.candidates:
+                distributions.write(distributions.sidecar_filename(args.outf), [row[2] for row in rows],
+                                    dictionary.idx2word.__getitem__)
 
 
+if __name__ == '__main__':
+    main(parser.parse_args())
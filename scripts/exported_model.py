@@ -0,0 +1,119 @@
+"""Exported Gulordava model: weights-only state dict and binary vocabulary.
+
+evaluate_target_word_test.py otherwise unpickles the whole model and rebuilds
+dictionary_corpus.Dictionary from the text vocabulary at every start.
+export() writes, once, a directory with
+
+* model.json: the RNNModel constructor arguments
+* state_dict.pt: the weights, saved with torch.save
+* words.npy, ids.npy, ranks.npy: the vocabulary, as in vocab_index.py
+
+and load() memory-maps all of it. The weights are loaded with mmap=True and
+assigned into a model built on the meta device, so nothing is copied: the
+pages come from the file cache, and every scorer process on a host shares
+them.
+
+Usage, from colorlessgreenRNNs/src with this file, model.py and vocab_index.py
+next to the scorer:
+    python language_models/evaluate_target_word_test.py --checkpoint hidden650_batch128_dropout0.2_lr20.0.pt --data ../data/lm/English --export hidden650.export
+    python language_models/evaluate_target_word_test.py --exported hidden650.export --surprisalmode True --prefixfile input.txt --outf output.tsv
+"""
+import os
+import json
+
+import torch
+
+import vocab_index
+
+CONFIG = "model.json"
+WEIGHTS = "state_dict.pt"
+UNK = "<unk>"
+
+
+class WordIndex(object):
+    """ Read-only word -> index mapping over a vocab_index.WordTable, for
+    code written against Dictionary.word2idx """
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, word):
+        ids, found = self.table.word_ids([word], -1)
+        if not found[0]:
+            raise KeyError(word)
+        return int(ids[0])
+
+    def get(self, word, default=None):
+        ids, found = self.table.word_ids([word], -1)
+        return int(ids[0]) if found[0] else default
+
+    def __contains__(self, word):
+        return bool(self.table.word_ids([word], -1)[1][0])
+
+    def __len__(self):
+        return self.table.size
+
+
+class IndexWords(object):
+    """ Read-only index -> word sequence, for Dictionary.idx2word """
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, idx):
+        return self.table.id_to_word(idx)
+
+    def __len__(self):
+        return self.table.size
+
+
+class MappedDictionary(object):
+    """ Stands in for dictionary_corpus.Dictionary, memory-mapped from an
+    export directory """
+    def __init__(self, dirname):
+        self.table = vocab_index.WordTable(dirname)
+        self.word2idx = WordIndex(self.table)
+        self.idx2word = IndexWords(self.table)
+        self.unk = self.word2idx[UNK]
+
+    def __len__(self):
+        return self.table.size
+
+    def tokenize(self, words):
+        """ Indices of a list of words, with <unk> for unknown words """
+        return torch.from_numpy(self.table.word_ids(words, self.unk)[0].astype('int64'))
+
+
+def model_config(model):
+    """ The RNNModel constructor arguments of a loaded model """
+    return {
+        'rnn_type': model.rnn_type,
+        'ntoken': model.encoder.num_embeddings,
+        'ninp': model.encoder.embedding_dim,
+        'nhid': model.nhid,
+        'nlayers': model.nlayers,
+        'tie_weights': model.decoder.weight is model.encoder.weight,
+    }
+
+def export(model, dictionary, dirname):
+    """ Write model and dictionary to dirname """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(os.path.join(dirname, CONFIG), 'w') as outfile:
+        json.dump(model_config(model), outfile)
+    state_dict = {name: tensor.cpu().contiguous() for name, tensor in model.state_dict().items()}
+    torch.save(state_dict, os.path.join(dirname, WEIGHTS))
+    vocab_index.write_word_table(dirname, dictionary.word2idx, dictionary.idx2word)
+
+def load(dirname, cuda=False):
+    """ The model and dictionary exported to dirname """
+    import model as model_module
+    with open(os.path.join(dirname, CONFIG)) as infile:
+        config = json.load(infile)
+    state_dict = torch.load(os.path.join(dirname, WEIGHTS), mmap=True, weights_only=True)
+    # no dropout at evaluation time, and no weights to initialize
+    with torch.device('meta'):
+        model = model_module.RNNModel(dropout=0.0, **config)
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    if cuda:
+        model.cuda()
+    return model, MappedDictionary(dirname)
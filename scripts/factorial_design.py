@@ -0,0 +1,129 @@
+"""Declarative factorial designs, expanded lazily into conditions and items.
+
+Instead of writing out every condition's region list by hand, a design
+names its factors and levels and gives one list of region rules; each rule
+says which levels a region appears under. Conditions are generated on
+demand, one cell of the design at a time:
+
+    design = FactorialDesign(
+        factors=[
+            ('construction', ['do', 'po']),
+            ('theme_length', ['theme-short', 'theme-long']),
+        ],
+        regions=[
+            'Subject', 'Verb',
+            Region('Recipient', construction='do'),
+            'Theme',
+            Region('Theme Modifier', theme_length='theme-long'),
+            Region('To', construction='po'),
+            Region('Recipient', construction='po'),
+        ],
+    )
+    design.conditions()  # {'do_theme-short': ['Subject', 'Verb', 'Recipient', 'Theme'], ...}
+
+A condition's name is its levels joined with "_", in the order the factors
+are listed. `vary` gives the order in which cells are enumerated, from the
+slowest-changing factor to the fastest (default: the listed order).
+
+stream_items and write_items_tsv expand items in chunks of conditions, so
+designs with thousands of cells go to items.tsv without the whole token
+table in memory at once. Each chunk can also be scored as it comes, e.g.
+with run_models.score_with_daemon(model, run_models.sentences(chunk['word'])).
+"""
+import itertools
+
+import item_expansion
+
+
+class Region(object):
+    """ A region that appears only under the given factor levels.
+
+    Each keyword names a factor and gives a level, or a list of levels, that
+    the condition must have for the region to be included.
+    """
+    def __init__(self, name, **levels):
+        self.name = name
+        self.levels = {
+            factor: [level] if isinstance(level, str) else list(level)
+            for factor, level in levels.items()
+        }
+
+    def applies(self, cell):
+        return all(cell[factor] in levels for factor, levels in self.levels.items())
+
+
+class FactorialDesign(object):
+    def __init__(self, factors, regions, vary=None):
+        self.factors = [(name, list(levels)) for name, levels in factors]
+        self.regions = [Region(r) if isinstance(r, str) else r for r in regions]
+        self.vary = list(vary) if vary else [name for name, _ in self.factors]
+        names = {name for name, _ in self.factors}
+        if sorted(self.vary) != sorted(names):
+            raise ValueError("vary must list each factor once: %s" % self.vary)
+        for region in self.regions:
+            unknown = set(region.levels) - names
+            if unknown:
+                raise ValueError("Region %r refers to unknown factors %s" % (region.name, sorted(unknown)))
+
+    def __len__(self):
+        n = 1
+        for _, levels in self.factors:
+            n *= len(levels)
+        return n
+
+    def cells(self):
+        """ Generate each cell as a dict from factor name to level """
+        levels = dict(self.factors)
+        for combination in itertools.product(*(levels[name] for name in self.vary)):
+            yield dict(zip(self.vary, combination))
+
+    def condition_name(self, cell):
+        return "_".join(cell[name] for name, _ in self.factors)
+
+    def condition_regions(self, cell):
+        return [region.name for region in self.regions if region.applies(cell)]
+
+    def iter_conditions(self):
+        """ Generate (condition name, region list) for each cell """
+        for cell in self.cells():
+            yield self.condition_name(cell), self.condition_regions(cell)
+
+    def conditions(self):
+        """ The whole condition mapping, as expand_items.py scripts use """
+        return dict(self.iter_conditions())
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def stream_items(df, conditions, chunk_conditions=64, **kwds):
+    """ Generate the token table for df in every condition, a chunk of
+    conditions at a time.
+
+    conditions is a FactorialDesign or any (name, regions) iterable or
+    mapping. Concatenating the chunks gives item_expansion.expand_items(df,
+    conditions); keyword arguments are passed on to it.
+    """
+    if isinstance(conditions, FactorialDesign):
+        conditions = conditions.iter_conditions()
+    elif isinstance(conditions, dict):
+        conditions = conditions.items()
+    for chunk in chunked(conditions, chunk_conditions):
+        yield item_expansion.expand_items(df, dict(chunk), **kwds)
+
+def write_items_tsv(chunks, filename):
+    """ Write token table chunks to one items.tsv, in the same format as
+    DataFrame.to_csv(filename, sep="\\t") on the whole table. Returns the
+    number of rows written. """
+    n = 0
+    with open(filename, 'w') as outfile:
+        for chunk in chunks:
+            chunk.index = range(n, n + len(chunk))
+            chunk.to_csv(outfile, sep="\t", header=(n == 0))
+            n += len(chunk)
+    return n
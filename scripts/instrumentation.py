@@ -0,0 +1,184 @@
+"""Per-stage timing events, shared by the scorers and run_models.
+
+When the environment variable RNN_SOFT_CONSTRAINTS_EVENTS names a file,
+every stage of a run appends one JSON line to it:
+
+    {"event": "stage", "stage": "forward", "model": "gulordava",
+     "process": "evaluate_target_word_test.py", "pid": 1234, "time": ...,
+     "wall": 12.3, "cpu": 11.9, "calls": 5120, "tokens": 14246,
+     "rss_mb": 812.4, "peak_rss_mb": 830.1}
+
+and long loops append "progress" events (done, total, unit) about once a
+second. run_models sets the variable for the scorers it launches, along with
+RNN_SOFT_CONSTRAINTS_MODEL, shows their progress, and sums the stages into
+profile.csv. With the variable unset, nothing is recorded and a stage costs
+one check on entry.
+
+Hot stages can also be profiled, by setting RNN_SOFT_CONSTRAINTS_PROFILE to
+"cprofile" (a .prof file per stage, for pstats or snakeviz) or "py-spy"
+(a flame graph per stage, if py-spy is installed). The files go to
+RNN_SOFT_CONSTRAINTS_PROFILE_DIR, or next to the events file.
+
+    with instrumentation.stage("model_load"):        # timed once
+        model = ...
+    forward = instrumentation.Stage("forward", profile=True)
+    for batch in batches:                            # timed in total
+        with forward:
+            output = model(batch)
+    forward.emit(tokens=n)
+"""
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import resource
+import subprocess
+
+EVENTS_VAR = "RNN_SOFT_CONSTRAINTS_EVENTS"
+MODEL_VAR = "RNN_SOFT_CONSTRAINTS_MODEL"
+PROFILE_VAR = "RNN_SOFT_CONSTRAINTS_PROFILE"
+PROFILE_DIR_VAR = "RNN_SOFT_CONSTRAINTS_PROFILE_DIR"
+PROGRESS_INTERVAL = 1.0
+
+
+def events_filename():
+    return os.environ.get(EVENTS_VAR, "")
+
+def process_name():
+    return os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+
+def rss_mb():
+    """ Current and peak resident set size of this process, in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as infile:
+            pages = int(infile.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20, peak
+    except (IOError, ValueError):
+        return peak, peak
+
+def emit(event, **fields):
+    """ Append an event to the events file, if there is one """
+    filename = events_filename()
+    if not filename:
+        return
+    record = {
+        'event': event,
+        'time': time.time(),
+        'pid': os.getpid(),
+        'process': process_name(),
+        'model': os.environ.get(MODEL_VAR, ""),
+    }
+    record.update(fields)
+    with open(filename, 'a') as outfile:
+        outfile.write(json.dumps(record) + "\n")
+
+
+class Stage(object):
+    """ Wall and CPU time spent inside `with stage:` blocks, summed over
+    any number of them until emit() """
+    def __init__(self, name, profile=False, **fields):
+        self.name = name
+        self.fields = fields
+        self.enabled = bool(events_filename())
+        self.profile = profile and self.enabled and os.environ.get(PROFILE_VAR, "")
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self.profiler = None
+
+    def __enter__(self):
+        if self.enabled:
+            if self.profile:
+                self.start_profiler()
+            self.started = (time.perf_counter(), time.process_time())
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            wall, cpu = self.started
+            self.wall += time.perf_counter() - wall
+            self.cpu += time.process_time() - cpu
+            self.calls += 1
+            if self.profile == "cprofile":
+                self.profiler.disable()
+
+    def profile_filename(self, extension):
+        directory = os.environ.get(PROFILE_DIR_VAR) or os.path.dirname(os.path.abspath(events_filename()))
+        name = "-".join(part for part in [os.environ.get(MODEL_VAR, ""), process_name(), self.name, str(os.getpid())] if part)
+        return os.path.join(directory, name.replace("/", "_") + extension)
+
+    def start_profiler(self):
+        if self.profile == "cprofile":
+            if self.profiler is None:
+                import cProfile
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == "py-spy" and self.profiler is None:
+            if not shutil.which("py-spy"):
+                print("py-spy is not installed; not profiling %s" % self.name, file=sys.stderr)
+                self.profile = ""
+                return
+            # samples from the first entry to emit()
+            self.profiler = subprocess.Popen([
+                "py-spy", "record", "--nonblocking", "--pid", str(os.getpid()),
+                "--output", self.profile_filename(".svg"),
+            ])
+
+    def stop_profiler(self):
+        if self.profiler is None:
+            return
+        if self.profile == "cprofile":
+            self.profiler.dump_stats(self.profile_filename(".prof"))
+        else:
+            # py-spy writes its output when interrupted
+            self.profiler.send_signal(signal.SIGINT)
+            self.profiler.wait()
+        self.profiler = None
+
+    def emit(self, **fields):
+        if not self.enabled:
+            return
+        self.stop_profiler()
+        rss, peak_rss = rss_mb()
+        record = dict(self.fields, stage=self.name, wall=self.wall, cpu=self.cpu, calls=self.calls,
+                      rss_mb=rss, peak_rss_mb=peak_rss)
+        record.update(fields)
+        emit('stage', **record)
+
+
+class SingleStage(Stage):
+    """ A Stage that emits when its one `with` block ends; fields (such as
+    tokens) can be added to it inside the block with set() """
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __exit__(self, *exc):
+        Stage.__exit__(self, *exc)
+        if exc[0] is None:
+            self.emit()
+
+
+def stage(name, profile=False, **fields):
+    return SingleStage(name, profile, **fields)
+
+
+class Progress(object):
+    """ Progress of a loop over total units, reported about once a second """
+    def __init__(self, total, unit="sentences", stage=""):
+        self.total = total
+        self.unit = unit
+        self.stage = stage
+        self.done = 0
+        self.enabled = bool(events_filename())
+        self.last = 0.0
+
+    def update(self, n=1):
+        self.done += n
+        if self.enabled:
+            now = time.time()
+            if now - self.last >= PROGRESS_INTERVAL or self.done >= self.total:
+                self.last = now
+                emit('progress', stage=self.stage, done=self.done, total=self.total, unit=self.unit)
@@ -0,0 +1,71 @@
+"""Expand an item spreadsheet into the per-token table scored by the models.
+
+Shared by each experiment's expand_items.py. An experiment gives a mapping
+from condition name to the list of spreadsheet columns (regions) that make
+up a sentence in that condition, in order. Every item is expanded in every
+condition into rows of
+
+    sent_index, word_index, word, region, condition
+
+ordered by condition, then item, then word. The work is done column-wise
+with pandas instead of row by row: regions are split into words and
+exploded, word_index is a running count per sentence, and capitalization
+and the end region are applied to whole columns.
+"""
+import pandas as pd
+
+COLUMNS = ['sent_index', 'word_index', 'word', 'region', 'condition']
+
+
+def expand_items(df, conditions, autocaps=True, add_end_region=True):
+    """ Token table for every item (row of df) in every condition.
+
+    With autocaps, the first word of each sentence is title-cased. With
+    add_end_region, each sentence gets "." and "<eos>" in an "End" region;
+    their word_index skips one past the last word, as it always has.
+    """
+    parts = []
+    for condition_order, (condition, regions) in enumerate(conditions.items()):
+        for region_order, region in enumerate(regions):
+            parts.append(pd.DataFrame({
+                'condition_order': condition_order,
+                'sent_index': df.index,
+                'region_order': region_order,
+                'word': df[region].str.split().to_numpy(),
+                'region': region,
+                'condition': condition,
+            }))
+    words = (
+        pd.concat(parts, ignore_index=True)
+        .sort_values(['condition_order', 'sent_index', 'region_order'], kind='stable')
+        .explode('word')
+        .dropna(subset=['word'])
+    )
+    words['word_index'] = words.groupby(['condition_order', 'sent_index']).cumcount()
+    if autocaps:
+        first = words['word_index'] == 0
+        words.loc[first, 'word'] = words.loc[first, 'word'].str.title()
+
+    if add_end_region:
+        sentences = pd.MultiIndex.from_product(
+            [range(len(conditions)), df.index],
+            names=['condition_order', 'sent_index']
+        )
+        lengths = (
+            words.groupby(['condition_order', 'sent_index']).size()
+            .reindex(sentences, fill_value=0)
+            .reset_index(name='length')
+        )
+        lengths['condition'] = pd.Series(list(conditions)).take(lengths['condition_order']).to_numpy()
+        ends = [
+            lengths.assign(word=word, region="End", word_index=lengths['length'] + offset)
+            for word, offset in [(".", 1), ("<eos>", 2)]
+        ]
+        words = pd.concat([words] + ends, ignore_index=True)
+
+    return (
+        words
+        .sort_values(['condition_order', 'sent_index', 'word_index'], kind='stable')
+        [COLUMNS]
+        .reset_index(drop=True)
+    )
@@ -0,0 +1,236 @@
+"""Back-off n-gram baseline scored in process, in place of kenlm's query.
+
+Loads an ARPA language model, or the compact .npz form that --save writes
+from one, and scores sentences the way
+
+    sed "s/ <eos>//g" | query lm | python postprocess_kenlm.py
+
+did: each sentence is scored in context (after <s>, with a final </s> in
+place of <eos>), surprisals are in bits, and out-of-vocabulary words are
+written as <UNK>.
+
+Usage, like the LSTM scorers:
+    python ngram_model.py --lm 1b.arpa --save 1b.npz
+    python ngram_model.py --lm 1b.npz --input_file input.txt --output_file output.tsv
+    python ngram_model.py --lm 1b.npz --serve /tmp/rnn_soft_constraints-ngram.sock
+"""
+from __future__ import print_function
+import sys
+import math
+import struct
+import zipfile
+import argparse
+
+import numpy as np
+
+import instrumentation
+import scoring_daemon
+
+BOS = "<s>"
+EOS = "</s>"
+UNK = "<unk>"
+# kenlm's log10 probability for words when the model has no <unk> entry
+UNK_LOGPROB = -100.0
+
+
+def load_npz(filename):
+    """ The arrays of an uncompressed .npz, as np.savez writes it, memory-mapped
+
+    np.load reads every member of an .npz into memory; the members of an
+    uncompressed one are plain .npy files, so each is mapped from its offset
+    in the archive instead.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as infile:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("%s is compressed; write it with np.savez" % filename)
+            # the member's local header: 30 bytes, then its name and extra field
+            infile.seek(info.header_offset)
+            header = infile.read(30)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            infile.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(infile)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(infile)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(infile)
+            name = info.filename[:-len(".npy")]
+            if not shape or 0 in shape:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                                         order='F' if fortran_order else 'C', offset=infile.tell())
+    return arrays
+
+
+class NgramModel(object):
+    """ ARPA back-off model held as sorted per-order arrays.
+
+    vocab is the sorted array of the UTF-8 encoded words, and a word's id is
+    its position there. An n-gram of order k > 1 is keyed by
+    row * len(vocab) + the id of its last word, where row is the position of
+    its first k-1 words in keys[k-2]; a unigram's key is its id. keys[k-1]
+    holds the order-k keys sorted, with the logprobs and backoffs (log10) in
+    the same order, so words and n-grams are found with np.searchsorted and
+    a saved model is used straight from the memory-mapped file.
+    """
+    def __init__(self, vocab, keys, logprobs, backoffs):
+        self.vocab = vocab
+        self.keys = keys
+        self.logprobs = logprobs
+        self.backoffs = backoffs
+        self.order = len(keys)
+        self.size = len(vocab)
+        self.unk, self.bos = self.word_ids([UNK, BOS])
+
+    @classmethod
+    def from_arpa(cls, filename):
+        ngrams = []
+        n = 0
+        with open(filename, encoding="utf-8") as infile:
+            for line in infile:
+                line = line.strip()
+                if not line or line.startswith("ngram ") or line == "\\data\\":
+                    continue
+                if line == "\\end\\":
+                    break
+                if line.startswith("\\") and line.endswith("-grams:"):
+                    n = int(line[1:line.index("-")])
+                    ngrams.append(([], [], []))
+                    continue
+                fields = line.split()
+                order_words, order_logprobs, order_backoffs = ngrams[n - 1]
+                order_words.append(fields[1:1 + n])
+                order_logprobs.append(float(fields[0]))
+                order_backoffs.append(float(fields[1 + n]) if len(fields) > 1 + n else 0.0)
+        vocab = np.array(sorted(words[0].encode("utf-8") for words in ngrams[0][0]), dtype=bytes)
+        word_ids = {word.decode("utf-8"): i for i, word in enumerate(vocab.tolist())}
+        keys, logprobs, backoffs = [], [], []
+        for k, (order_words, order_logprobs, order_backoffs) in enumerate(ngrams, 1):
+            ids = np.array([[word_ids[word] for word in words] for words in order_words], dtype=np.int64).reshape(-1, k)
+            rows = ids[:, 0]
+            for j in range(1, k - 1):
+                rows = cls._find(keys[j], rows * len(vocab) + ids[:, j])
+                if (rows < 0).any():
+                    raise ValueError("%s has %d-grams whose first %d words are not an n-gram" % (filename, k, j + 1))
+            order_keys = rows * len(vocab) + ids[:, -1] if k > 1 else rows
+            permutation = np.argsort(order_keys, kind='stable')
+            keys.append(order_keys[permutation])
+            logprobs.append(np.array(order_logprobs, dtype=np.float32)[permutation])
+            backoffs.append(np.array(order_backoffs, dtype=np.float32)[permutation])
+        return cls(vocab, keys, logprobs, backoffs)
+
+    @classmethod
+    def load(cls, filename):
+        """ Load an .npz written by save, memory-mapped, or an ARPA file """
+        if not filename.endswith(".npz"):
+            return cls.from_arpa(filename)
+        data = load_npz(filename)
+        if 'keys_1' not in data:
+            raise ValueError("%s was saved by an older ngram_model.py; convert the ARPA file again with --save" % filename)
+        order = sum(1 for name in data if name.startswith("keys_"))
+        return cls(
+            data['vocab'],
+            [data['keys_%d' % k] for k in range(1, order + 1)],
+            [data['logprobs_%d' % k] for k in range(1, order + 1)],
+            [data['backoffs_%d' % k] for k in range(1, order + 1)],
+        )
+
+    def save(self, filename):
+        arrays = {'vocab': self.vocab}
+        for k in range(1, self.order + 1):
+            arrays['keys_%d' % k] = self.keys[k - 1]
+            arrays['logprobs_%d' % k] = self.logprobs[k - 1]
+            arrays['backoffs_%d' % k] = self.backoffs[k - 1]
+        np.savez(filename, **arrays)
+
+    @staticmethod
+    def _find(sorted_keys, keys):
+        """ Position of each of keys in sorted_keys, or -1 where it is missing """
+        if not len(sorted_keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[positions] == keys, positions, -1)
+
+    def word_ids(self, words):
+        """ Id of each word, or None for words not in the vocabulary """
+        positions = self._find(self.vocab, np.array([word.encode("utf-8") for word in words], dtype=bytes))
+        return [None if position < 0 else int(position) for position in positions]
+
+    def row(self, ngram):
+        """ Position of an n-gram (a tuple of word ids) in its order's keys, or None """
+        row = ngram[0]
+        for k in range(1, len(ngram)):
+            keys = self.keys[k]
+            key = row * self.size + ngram[k]
+            row = int(np.searchsorted(keys, key))
+            if row == len(keys) or keys[row] != key:
+                return None
+        return row
+
+    def logprob(self, context, word):
+        """ log10 p(word | context), backing off through shorter contexts """
+        if word is None:
+            return UNK_LOGPROB
+        backoff = 0.0
+        for start in range(len(context) + 1):
+            history = context[start:]
+            row = self.row(history + (word,))
+            if row is not None:
+                return backoff + float(self.logprobs[len(history)][row])
+            if history:
+                row = self.row(history)
+                if row is not None:
+                    backoff += float(self.backoffs[len(history) - 1][row])
+        return UNK_LOGPROB
+
+    def sentence_rows(self, sentence):
+        """ Yield (word, surprisal) for each word of sentence and a final </s> """
+        words = [word for word in sentence.split() if word != "<eos>"] + [EOS]
+        context = () if self.bos is None else (self.bos,)
+        for word, word_id in zip(words, self.word_ids(words)):
+            if word_id is None:
+                word_id = self.unk
+            # kenlm gives <unk> itself id 0 too, like any unknown word
+            if word_id is None or word_id == self.unk:
+                word = "<UNK>"
+            logprob = self.logprob(context, word_id)
+            # log10 to bits
+            yield word, -logprob / math.log10(2)
+            context = (context + (word_id,))[max(len(context) + 2 - self.order, 0):]
+
+    def score_sentences(self, sentences):
+        with instrumentation.stage('scoring', profile=True) as stage:
+            rows = [row for sentence in sentences for row in self.sentence_rows(sentence)]
+            stage.set(tokens=len(rows))
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score sentences with a back-off n-gram model')
+    parser.add_argument('--lm', type=str, help='ARPA file, or .npz written by --save')
+    parser.add_argument('--save', type=str, default='', help='write the model in compact .npz form and exit')
+    parser.add_argument('--input_file', type=str, default='', help='file of sentences to be evaluated')
+    parser.add_argument('--output_file', type=str, default='', help='file to dump results')
+    parser.add_argument('--serve', type=str, default='',
+                        help='Unix socket path or host:port; keep the model loaded and score sentences sent there')
+    args = parser.parse_args()
+
+    print("Loading %s" % args.lm, file=sys.stderr)
+    with instrumentation.stage('model_load'):
+        model = NgramModel.load(args.lm)
+    if args.save:
+        model.save(args.save)
+    elif args.serve:
+        scoring_daemon.serve(args.serve, model.score_sentences, scoring_daemon.fingerprint([args.lm]))
+    else:
+        with open(args.input_file) as infile:
+            rows = model.score_sentences(infile)
+        with instrumentation.stage('output', tokens=len(rows)):
+            with open(args.output_file, 'w') as outfile:
+                for word, surprisal in rows:
+                    print(word, surprisal, sep="\t", file=outfile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""Rebuild every experiment's results, redoing only the steps that are out of date.
+
+Each experiment directory (one with an expand_items.py) goes through
+
+    <spreadsheet>.xlsx --expand_items.py--> tests/items.tsv
+        --> tests/input.txt (the sentences)
+        --> tests/<model>_output.tsv, for each model
+        --> tests/combined_results.csv and tests/region_results.csv
+
+Every step records a hash of its inputs in tests/pipeline_state.json: the
+contents of the files it reads (the spreadsheet and the item expansion
+scripts, items.tsv, input.txt, the model outputs) and, for a model, its
+fingerprint (its command or backend settings and the files they name, as
+for the surprisal cache). A step runs only when that hash has changed or
+one of its outputs is missing, so editing one spreadsheet redoes that
+experiment alone, and a new items.tsv with the same sentences is joined
+again without being rescored.
+
+The steps of all the experiments run in worker processes, as many at once
+as fit in --cores. A model's step takes its THREAD_BUDGETS entry in
+run_models, or an even share of the cores between all the model steps;
+the other steps take one core.
+
+Usage:
+    python pipeline.py
+    python pipeline.py particleshift heavy-np-shift --models gulordava kenlm --cores 8
+    python pipeline.py --dry_run
+"""
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+import concurrent.futures
+
+import aggregate_regions
+import backends
+import instrumentation
+import results_store
+import run_models
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(SCRIPTS)
+STATE_FILENAME = "pipeline_state.json"
+# Modules of scripts/ that the experiments' expand_items.py import
+ITEM_SCRIPTS = ['item_expansion.py', 'factorial_design.py']
+
+parser = argparse.ArgumentParser(description="Rebuild the experiments' results, skipping steps that are up to date")
+parser.add_argument('experiments', nargs='*',
+                    help='experiment directories (default: every directory of the repository with an expand_items.py)')
+parser.add_argument('--models', nargs='+', default=None, help='models to score (default: as for run_models.py)')
+parser.add_argument('--cores', type=int, default=os.cpu_count(), help='cores to use at once')
+parser.add_argument('--nocache', action='store_true', help="don't use or fill the surprisal cache")
+parser.add_argument('--columnar', action='store_true', help='write combined_results.npz instead of combined_results.csv')
+parser.add_argument('--force', action='store_true', help='run every step, whether up to date or not')
+parser.add_argument('--dry_run', action='store_true', help='only print the steps that are out of date')
+
+
+def find_experiments(root=REPOSITORY):
+    return sorted(os.path.dirname(filename) for filename in glob.glob(os.path.join(root, "*", "expand_items.py")))
+
+def spreadsheet(directory):
+    filenames = glob.glob(os.path.join(directory, "*.xlsx"))
+    if len(filenames) != 1:
+        raise ValueError("Expected one spreadsheet in %s, found %d" % (directory, len(filenames)))
+    return filenames[0]
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# The steps themselves, run in the worker processes
+
+def expand_items(directory, spreadsheet):
+    # expand_items.py writes tests/items.tsv under the directory it runs in
+    subprocess.run([sys.executable, "expand_items.py", os.path.basename(spreadsheet)], cwd=directory, check=True)
+
+def write_input(path):
+    run_models.write_input(path, run_models.read_items(path))
+
+def score(path, model, threads, cache_path):
+    os.environ[instrumentation.EVENTS_VAR] = os.path.join(path, run_models.EVENTS_FILENAME)
+    try:
+        output_filename = run_models.output_filename(path, model)
+        output_df = run_models.score_model(
+            model, os.path.join(path, "input.txt"), output_filename, threads, cache_path)
+        run_models.write_model_output(output_df, output_filename)
+    finally:
+        del os.environ[instrumentation.EVENTS_VAR]
+
+def combine(path, models, columnar):
+    os.environ[instrumentation.EVENTS_VAR] = os.path.join(path, run_models.EVENTS_FILENAME)
+    try:
+        conditions_df = run_models.read_items(path)
+        outputs = []
+        for model in models:
+            output_df = run_models.read_model_output(model, run_models.output_filename(path, model))
+            if len(output_df) != len(conditions_df):
+                raise ValueError("%s produced %d tokens for %d in items.tsv" % (model, len(output_df), len(conditions_df)))
+            outputs.append((model, output_df))
+        df = run_models.join_outputs(conditions_df, models, outputs)
+        run_models.write_results(path, df, columnar)
+        run_models.write_profile(path)
+    finally:
+        del os.environ[instrumentation.EVENTS_VAR]
+
+
+class Step(object):
+    """ One step of an experiment: fn(*args) makes outputs from files.
+
+    params are the strings besides the files' contents that the outputs
+    depend on, and deps the names of the steps that make those files.
+    """
+    def __init__(self, experiment, label, fn, args, files, outputs, params=(), deps=(), cores=1):
+        self.experiment = experiment
+        self.label = label
+        self.name = "%s: %s" % (os.path.basename(experiment), label)
+        self.fn = fn
+        self.args = args
+        self.files = files
+        self.outputs = outputs
+        self.params = params
+        self.deps = deps
+        self.cores = cores
+        self.key = None
+
+    def inputs_hash(self):
+        """ Hash of the step's params and input files, computed once its
+        dependencies are done """
+        if self.key is None:
+            h = hashlib.sha1()
+            for param in self.params:
+                h.update(param.encode("utf-8") + b"\0")
+            for filename in self.files:
+                h.update(("%s:%s\0" % (os.path.relpath(filename, self.experiment), file_hash(filename))).encode("utf-8"))
+            self.key = h.hexdigest()
+        return self.key
+
+    def up_to_date(self, state):
+        return state.get(self.label) == self.inputs_hash() and all(os.path.exists(output) for output in self.outputs)
+
+
+def experiment_steps(directory, models, cores, cache_path=None, columnar=False):
+    """ The steps for one experiment directory, dependencies first """
+    path = os.path.join(directory, "tests")
+    items = os.path.join(path, "items.tsv")
+    input_filename = os.path.join(path, "input.txt")
+    xlsx = spreadsheet(directory)
+    steps = [
+        Step(directory, "items", expand_items, (directory, xlsx),
+             [xlsx, os.path.join(directory, "expand_items.py")] + [os.path.join(SCRIPTS, name) for name in ITEM_SCRIPTS],
+             [items]),
+        Step(directory, "input", write_input, (path,), [items], [input_filename], deps=["items"]),
+    ]
+    config = backends.read_config()
+    for model in models:
+        steps.append(Step(
+            directory, "score %s" % model, score, (path, model, cores[model], cache_path),
+            [input_filename], [run_models.output_filename(path, model)],
+            params=[model, run_models.model_fingerprint(model, config.get(model))],
+            deps=["input"], cores=cores[model],
+        ))
+    results = os.path.join(path, results_store.FILENAME if columnar else "combined_results.csv")
+    steps.append(Step(
+        directory, "combine", combine, (path, models, columnar),
+        [items] + [run_models.output_filename(path, model) for model in models],
+        [results, os.path.join(path, aggregate_regions.FILENAME)],
+        params=models + [str(columnar)], deps=["score %s" % model for model in models],
+    ))
+    for step in steps:
+        step.deps = ["%s: %s" % (os.path.basename(directory), dep) for dep in step.deps]
+    return steps
+
+def read_state(directory):
+    filename = os.path.join(directory, "tests", STATE_FILENAME)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as infile:
+        return json.load(infile)
+
+def write_state(directory, state):
+    filename = os.path.join(directory, "tests", STATE_FILENAME)
+    with open(filename + ".tmp", 'w') as outfile:
+        json.dump(state, outfile, indent=2, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+def run(steps, cores, force=False, dry_run=False):
+    """ Run the steps that are out of date, each once its dependencies are
+    done, as many at a time as fit in cores. Return the names of the steps
+    that failed or were not run because a dependency failed. """
+    states = {step.experiment: read_state(step.experiment) for step in steps}
+    pending = list(steps)
+    done = set()
+    ran = set()
+    started = set()
+    failed = []
+    running = {}
+    free = cores
+    with concurrent.futures.ProcessPoolExecutor(max_workers=cores) as pool:
+        while pending or running:
+            for step in list(pending):
+                if any(dep in failed for dep in step.deps):
+                    pending.remove(step)
+                    failed.append(step.name)
+                    continue
+                if not all(dep in done for dep in step.deps):
+                    continue
+                # a dry run can't hash the outputs of steps it didn't run
+                stale = force or (dry_run and any(dep in ran for dep in step.deps))
+                if not stale and step.up_to_date(states[step.experiment]):
+                    print("%s is up to date" % step.name, file=sys.stderr)
+                    pending.remove(step)
+                    done.add(step.name)
+                elif dry_run:
+                    print("%s would run" % step.name, file=sys.stderr)
+                    pending.remove(step)
+                    done.add(step.name)
+                    ran.add(step.name)
+                elif step.cores <= free or not running:
+                    if step.experiment not in started:
+                        # the experiment's events are for this run only
+                        started.add(step.experiment)
+                        os.makedirs(os.path.join(step.experiment, "tests"), exist_ok=True)
+                        open(os.path.join(step.experiment, "tests", run_models.EVENTS_FILENAME), 'w').close()
+                    print("Running %s on %d cores" % (step.name, step.cores), file=sys.stderr)
+                    step.inputs_hash()
+                    running[pool.submit(step.fn, *step.args)] = (step, time.time())
+                    pending.remove(step)
+                    free -= step.cores
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                step, start = running.pop(future)
+                free += step.cores
+                try:
+                    future.result()
+                except Exception as e:
+                    print("%s failed: %s" % (step.name, e), file=sys.stderr)
+                    failed.append(step.name)
+                    continue
+                print("Finished %s in %.1fs" % (step.name, time.time() - start), file=sys.stderr)
+                state = states[step.experiment]
+                state[step.label] = step.key
+                write_state(step.experiment, state)
+                done.add(step.name)
+                ran.add(step.name)
+    return failed
+
+def main(args):
+    directories = [os.path.abspath(directory) for directory in args.experiments] or find_experiments()
+    models = args.models or run_models.default_models()
+    budgets = {
+        model: min(run_models.THREAD_BUDGETS.get(model, max(1, args.cores // (len(models) * len(directories)))), args.cores)
+        for model in models
+    }
+    cache_path = None if args.nocache else run_models.CACHE_PATH
+    steps = [
+        step for directory in directories
+        for step in experiment_steps(directory, models, budgets, cache_path, args.columnar)
+    ]
+    failed = run(steps, args.cores, args.force, args.dry_run)
+    if failed:
+        print("Failed or skipped: %s" % ", ".join(failed), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
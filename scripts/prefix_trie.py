@@ -0,0 +1,79 @@
+"""Score sentences that share prefixes without rerunning the shared part.
+
+The sentences of an experiment are the same items in many conditions, so
+they often start with the same words. Here they are put in a trie of their
+tokens and the model is run once per trie node, in depth-first order; the
+state after a prefix is handed to every branch that continues it.
+
+A model is plugged in through a step function
+
+    step(state, token, next_tokens) -> (new_state, log2_probs)
+
+which feeds token in state and returns the state after it together with the
+base-2 log-probabilities of each of next_tokens at the following position.
+step must not modify the state it is given, since branches share it.
+With distributions=True, step returns a third value describing the model's
+next-word distribution at that position (e.g. its entropy and best
+candidates), which is handed back with each surprisal.
+"""
+
+
+class _Node(object):
+    __slots__ = ('children', 'surprisal', 'distribution')
+
+    def __init__(self):
+        self.children = {}
+        self.surprisal = 0.0
+        self.distribution = None
+
+
+def build_trie(sentences):
+    """ Trie over sequences of tokens (ids, or words); the root is the empty
+    prefix. """
+    root = _Node()
+    for sentence in sentences:
+        node = root
+        for token in sentence:
+            node = node.children.setdefault(token, _Node())
+    return root
+
+def count_steps(sentences):
+    """ Model steps needed with the trie: one per prefix that is continued. """
+    def count(node):
+        return sum(bool(child.children) + count(child) for child in node.children.values())
+    return count(build_trie(sentences))
+
+def trie_surprisals(sentences, initial_state, step, distributions=False):
+    """ Surprisal of every token after the first, for each sentence.
+
+    sentences is a list of sequences of hashable tokens. Returns a list with one
+    list of surprisals per sentence, for tokens 1 to the end, or of
+    (surprisal, distribution) pairs with distributions.
+    """
+    root = build_trie(sentences)
+    stack = [(token, node, initial_state) for token, node in root.children.items()]
+    while stack:
+        token, node, state = stack.pop()
+        if not node.children:
+            continue
+        next_tokens = list(node.children)
+        if distributions:
+            state, log2_probs, distribution = step(state, token, next_tokens)
+        else:
+            state, log2_probs = step(state, token, next_tokens)
+            distribution = None
+        for next_token, log2_prob in zip(next_tokens, log2_probs):
+            child = node.children[next_token]
+            child.surprisal = -float(log2_prob)
+            child.distribution = distribution
+            stack.append((next_token, child, state))
+
+    result = []
+    for sentence in sentences:
+        node = root.children[sentence[0]] if sentence else root
+        surprisals = []
+        for token in sentence[1:]:
+            node = node.children[token]
+            surprisals.append((node.surprisal, node.distribution) if distributions else node.surprisal)
+        result.append(surprisals)
+    return result
@@ -0,0 +1,116 @@
+"""Accuracy of the Gulordava LSTM's --quantize mode against fp32.
+
+Scores the items.tsv of each experiment with the model as it is and with
+dynamic int8 quantization, and reports per experiment:
+* the max and mean absolute deviation of per-token surprisal (bits)
+* for every pair of conditions and every region they share, the contrast
+  in summed region surprisal per item (as aggregate_regions.contrast), how
+  many of those change sign under quantization, and the largest fp32
+  contrast that does; contrasts that are zero in fp32 (e.g. over identical
+  prefixes) are left out
+* the same for the contrasts averaged over items
+* the scoring time of each model
+
+Runs next to evaluate_target_word_test.py, taking the same model flags:
+    python language_models/quantization_report.py --checkpoint hidden650_batch128_dropout0.2_lr20.0.pt --data ../data/lm/English ~/src/rnn_soft_constraints
+"""
+import os
+import sys
+import time
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+import torch
+
+import aggregate_regions
+import dictionary_corpus
+import evaluate_target_word_test
+import exported_model
+import run_models
+
+# fp32 contrasts smaller than this (bits) count as zero
+ZERO_CONTRAST = 1e-4
+EXPERIMENTS = ['dative-alternation', 'genitive-alternation', 'heavy-np-shift', 'particleshift']
+
+parser = argparse.ArgumentParser(description='Compare quantized and fp32 surprisals on the experiment items')
+parser.add_argument('repository', type=str, help='rnn_soft_constraints checkout with the experiment directories')
+parser.add_argument('--checkpoint', type=str, help='model checkpoint to use')
+parser.add_argument('--data', type=str, help='location of the data corpus')
+parser.add_argument('--exported', type=str, default='', help='directory written by --export, in place of --checkpoint and --data')
+parser.add_argument('--batchtokens', type=int, default=0, help='as for evaluate_target_word_test.py')
+parser.add_argument('--output', type=str, default='', help='also write the report to this CSV file')
+
+
+def score(model, dictionary, conditions_df, batchtokens=0):
+    """ Per-token surprisals of items.tsv, and the seconds it took """
+    sentences = [
+        evaluate_target_word_test.tokenize_sentence(dictionary, sentence)
+        for sentence in run_models.sentences(conditions_df['word'])
+    ]
+    start = time.time()
+    rows = evaluate_target_word_test.score_sentences(model, dictionary, sentences, 1.0, torch.device("cpu"), batchtokens=batchtokens)
+    seconds = time.time() - start
+    if len(rows) != len(conditions_df):
+        raise ValueError("%d tokens scored for %d in items.tsv" % (len(rows), len(conditions_df)))
+    return np.array([surprisal for _, surprisal in rows]), seconds
+
+def contrasts(conditions_df, surprisal):
+    """ Region contrasts between every pair of conditions, per item """
+    df = conditions_df.assign(model='', surprisal=surprisal)
+    cube = aggregate_regions.aggregate(df)
+    regions = cube.groupby('region')['condition'].unique()
+    dfs = []
+    for region, conditions in regions.items():
+        pairs = list(itertools.combinations(sorted(conditions), 2))
+        if pairs:
+            dfs.append(aggregate_regions.contrast(cube, pairs, region).assign(region=region))
+    # conditions that share a region only for some items leave gaps
+    return pd.concat(dfs, ignore_index=True).dropna(subset=['difference'])
+
+def compare(conditions_df, baseline, quantized):
+    deviation = np.abs(quantized - baseline)
+    keys = ['sent_index', 'region', 'condition_a', 'condition_b']
+    item_contrasts = contrasts(conditions_df, baseline).merge(
+        contrasts(conditions_df, quantized), on=keys + ['model'], suffixes=('_fp32', '_int8'))
+    mean_contrasts = item_contrasts.groupby(keys[1:])[['difference_fp32', 'difference_int8']].mean()
+    result = {
+        'tokens': len(deviation),
+        'max_abs_deviation': deviation.max(),
+        'mean_abs_deviation': deviation.mean(),
+    }
+    for name, d in [('item', item_contrasts), ('mean', mean_contrasts)]:
+        d = d[d['difference_fp32'].abs() >= ZERO_CONTRAST]
+        flipped = np.sign(d['difference_fp32']) != np.sign(d['difference_int8'])
+        result[name + '_contrasts'] = len(d)
+        result[name + '_sign_flips'] = int(flipped.sum())
+        result[name + '_largest_flipped'] = d.loc[flipped, 'difference_fp32'].abs().max() if flipped.any() else 0.0
+    return result
+
+def main(args):
+    if args.exported:
+        model, dictionary = exported_model.load(args.exported)
+    else:
+        model = evaluate_target_word_test.load_model(args.checkpoint, False)
+        dictionary = dictionary_corpus.Dictionary(args.data)
+    quantized = evaluate_target_word_test.quantize(model)
+
+    results = []
+    for experiment in EXPERIMENTS:
+        print(experiment, file=sys.stderr)
+        conditions_df = pd.read_csv(os.path.join(args.repository, experiment, "tests", "items.tsv"), sep="\t")
+        baseline, fp32_seconds = score(model, dictionary, conditions_df, args.batchtokens)
+        int8, int8_seconds = score(quantized, dictionary, conditions_df, args.batchtokens)
+        result = {'experiment': experiment}
+        result.update(compare(conditions_df, baseline, int8))
+        result.update(fp32_seconds=fp32_seconds, int8_seconds=int8_seconds)
+        results.append(result)
+
+    report = pd.DataFrame(results)
+    print(report.to_string(index=False))
+    if args.output:
+        report.to_csv(args.output, index=False)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,116 @@
+"""Columnar binary store for combined results, in place of the CSV.
+
+A results table is saved as one .npz archive with an array (or two) per
+column:
+* string columns (condition, region, model, word, model_word) are
+  dictionary-encoded: `<col>.codes` holds the smallest integer codes that
+  fit, with -1 for missing values, `<col>.categories` the distinct values
+* surprisal is float32
+* boolean columns (unk, final) are bitmaps: `<col>.bits` from np.packbits
+* other numeric columns are stored as they are
+
+Reading back decodes only the columns asked for; np.load reads archive
+members lazily, so the others are never touched. Pandas index columns that
+leak into the CSVs ("Unnamed: 0") are not stored.
+
+    write_results(df, "dative-alternation/tests/combined_results.npz")
+    df = read_results(["dative-alternation", "genitive-alternation"],
+                      columns=["model", "condition", "region", "surprisal"])
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+FILENAME = "combined_results.npz"
+CATEGORICAL = "categorical"
+BOOLEAN = "boolean"
+NUMERIC = "numeric"
+
+
+def column_kind(series):
+    if series.dtype == bool:
+        return BOOLEAN
+    if pd.api.types.is_numeric_dtype(series):
+        return NUMERIC
+    return CATEGORICAL
+
+def smallest_int_dtype(n):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def write_results(df, filename):
+    """ Write a results DataFrame to filename in the columnar format """
+    columns = [column for column in df.columns if not column.startswith("Unnamed:")]
+    arrays = {
+        '__columns__': np.array(columns),
+        '__kinds__': np.array([column_kind(df[column]) for column in columns]),
+        '__rows__': np.array(len(df)),
+    }
+    for column in columns:
+        values = df[column]
+        kind = column_kind(values)
+        if kind == CATEGORICAL:
+            # missing values get code -1, which from_codes reads back as NaN
+            codes, categories = pd.factorize(values.map(str, na_action='ignore'), sort=True)
+            arrays[column + '.codes'] = codes.astype(smallest_int_dtype(len(categories)))
+            arrays[column + '.categories'] = np.array(categories, dtype=str)
+        elif kind == BOOLEAN:
+            arrays[column + '.bits'] = np.packbits(values.to_numpy())
+        elif column == 'surprisal' or pd.api.types.is_float_dtype(values):
+            arrays[column] = values.to_numpy(dtype=np.float32)
+        else:
+            arrays[column] = values.to_numpy(dtype=smallest_int_dtype(values.abs().max() if len(values) else 0))
+    np.savez_compressed(filename, **arrays)
+
+def read_columns(filename, columns=None):
+    """ Read a columnar results file, decoding only the given columns """
+    with np.load(filename) as data:
+        stored = data['__columns__'].tolist()
+        kinds = dict(zip(stored, data['__kinds__'].tolist()))
+        n = int(data['__rows__'])
+        result = {}
+        for column in (stored if columns is None else columns):
+            if column not in kinds:
+                raise KeyError("%s has no column %r" % (filename, column))
+            if kinds[column] == CATEGORICAL:
+                result[column] = pd.Categorical.from_codes(
+                    data[column + '.codes'].astype(np.int64),
+                    data[column + '.categories']
+                )
+            elif kinds[column] == BOOLEAN:
+                result[column] = np.unpackbits(data[column + '.bits'], count=n).astype(bool)
+            else:
+                result[column] = data[column]
+    return pd.DataFrame(result)
+
+def results_filename(path):
+    """ The results file for an experiment directory, its tests directory, or the file itself """
+    if os.path.isfile(path):
+        return path
+    for candidate in (os.path.join(path, FILENAME), os.path.join(path, "tests", FILENAME)):
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError("No %s under %s" % (FILENAME, path))
+
+def read_results(paths, columns=None):
+    """ Read and stack the results of one or more experiments.
+
+    paths is an experiment directory (or results file), or a list of them;
+    for a list, an `experiment` column names each row's directory.
+    """
+    if isinstance(paths, str):
+        return read_columns(results_filename(paths), columns)
+    dfs = []
+    for path in paths:
+        df = read_columns(results_filename(path), columns)
+        df.insert(0, 'experiment', os.path.basename(os.path.normpath(path)))
+        dfs.append(df)
+    # categories differ between experiments; concat falls back to object, so re-encode
+    df = pd.concat(dfs, ignore_index=True)
+    for column in df.columns:
+        if column_kind(df[column]) == CATEGORICAL and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
@@ -2,12 +2,30 @@
 from __future__ import print_function
 import os
 import sys
+import csv
 import glob
-import functools
+import json
+import time
+import shlex
+import hashlib
+import subprocess
+import concurrent.futures
 
 #import rfutils
+import numpy as np
 import pandas as pd
 
+import aggregate_regions
+import backends
+import distributions
+import instrumentation
+import results_store
+import scoring_daemon
+import surprisal_cache
+
+EVENTS_FILENAME = "events.jsonl"
+PROFILE_FILENAME = "profile.csv"
+
 UNK_TOKENS = {"<unk>", "<UNK>", "UNK-LC", "UNK-LC-er", "UNK-LC-ed", "UNK-LC-s" }
 FINAL_TOKENS = {"<eos>", "</S>", "</s>"}
 
@@ -21,17 +39,18 @@ FINAL_TOKENS = {"<eos>", "</S>", "</s>"}
         "python ~/src/colorlessgreenRNNs/src/language_models/evaluate_target_word_test.py --checkpoint ~/src/colorlessgreenRNNs/src/hidden650_batch128_dropout0.2_lr20.0.pt --surprisalmode True --data ~/src/colorlessgreenRNNs/data/lm/English --prefixfile {input_path} --outf {output_path}",
     ],
     'kenlm': [
-        'cat {input_path} | sed "s/ <eos>//g" | ~/src/kenlm/build/bin/query ~/src/kenlm/build/1b.mmap | python postprocess_kenlm.py > {output_path}',
+        "python ngram_model.py --lm ~/src/kenlm/build/1b.npz --input_file {input_path} --output_file {output_path}",
     ],
 }"""
 
-# For running on Jenova
+# For running on Jenova. A model that is also in the backends config file
+# (see backends.py and models.example.json) is scored in process instead.
 MODELS = {
     'google': [
-        "python ~/code/lm_1b/lm_1b/eval_test_google.py --pbtxt ~/code/lm_1b/data/graph-2016-09-10.pbtxt --ckpt '../../../code/lm_1b/data/ckpt-*' --vocab_file ~/code/lm_1b/data/vocab-2016-09-10.txt --output_file {output_path} --input_file {input_path}",
+        "python ~/code/lm_1b/lm_1b/eval_test_google.py --pbtxt ~/code/lm_1b/data/graph-2016-09-10.pbtxt --ckpt '../../../code/lm_1b/data/ckpt-*' --vocab_file ~/code/lm_1b/data/vocab-2016-09-10.txt --prefix_trie --num_threads {threads} --output_file {output_path} --input_file {input_path}",
     ],
     'gulordava': [
-        "python ~/src/colorlessgreenRNNs/src/language_models/evaluate_target_word_test.py --checkpoint ~/src/colorlessgreenRNNs/src/hidden650_batch128_dropout0.2_lr20.0.pt --surprisalmode True --data ~/src/colorlessgreenRNNs/data/lm/English --prefixfile {input_path} --outf {output_path}",
+        "python ~/src/colorlessgreenRNNs/src/language_models/evaluate_target_word_test.py --checkpoint ~/src/colorlessgreenRNNs/src/hidden650_batch128_dropout0.2_lr20.0.pt --surprisalmode True --prefixtrie --shards {shards} --data ~/src/colorlessgreenRNNs/data/lm/English --prefixfile {input_path} --outf {output_path}",
     ]
 }
 
@@ -71,19 +90,206 @@ MODELS = {
     ],
 }"""
 
+# Scoring daemons, started by running a scorer above with `--serve ADDRESS`
+# in place of its input/output flags. While a model's daemon is up, run_model
+# sends it the sentences instead of running the command in MODELS, so the
+# model is only loaded once across runs.
+DAEMONS = {
+    'google': "/tmp/rnn_soft_constraints-google.sock",
+    'gulordava': "/tmp/rnn_soft_constraints-gulordava.sock",
+    'kenlm': "/tmp/rnn_soft_constraints-ngram.sock",
+}
+
+# A daemon is only used if the fingerprint it reports (see
+# scoring_daemon.fingerprint) is that of the model its command in MODELS
+# loads: the files named by these flags of the last command, and the
+# settings of these flags (with their defaults) that change the surprisals.
+DAEMON_FILE_FLAGS = {
+    'google': ['--pbtxt', '--ckpt', '--vocab_file', '--vocab_index'],
+    'gulordava': ['--checkpoint', '--data', '--exported'],
+    'kenlm': ['--lm'],
+}
+DAEMON_SETTING_FLAGS = {
+    'gulordava': {'quantize': ('--quantize', False), 'temperature': ('--temperature', 1.0)},
+}
+
+# CPU threads each model may use when models run in parallel. Models not
+# listed here split the cores left over by the ones that are. The budget is
+# passed to commands as {threads} and set in their THREAD_ENV_VARS, which
+# torch and the BLAS libraries read at startup; in-process backends get it
+# through torch.set_num_threads or their TensorFlow session config instead.
+THREAD_BUDGETS = {}
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+# Number of processes a model's scorer splits input.txt between, passed to
+# commands as {shards}. The workers are forked after the model is loaded and
+# share its weights. Only the Gulordava scorer supports this: a TensorFlow
+# session does not survive a fork.
+SHARDS = {
+    'gulordava': 1,
+}
+
+# Surprisals already computed are kept here and reused for sentences whose
+# text, model command and model files are unchanged. Pass `--nocache` to
+# main to score everything afresh.
+CACHE_PATH = os.path.expanduser("~/.cache/rnn_soft_constraints/surprisals.sqlite")
+CACHE_MAX_BYTES = 2 * 2**30
+
+# With `--distributions`, the flag added to the last command of each model
+# that can also write the entropy and top CANDIDATES words at every position
+# (see distributions.py). Those runs bypass the cache and the daemons, which
+# keep surprisals only; models not listed get empty columns.
+CANDIDATES = 10
+CANDIDATE_FLAGS = {
+    'google': "--candidates {candidates}",
+    'gulordava': "--candidates {candidates}",
+}
+DISTRIBUTION_COLUMNS = ['entropy', 'candidates', 'candidate_surprisals']
 
     
-def do_system_calls(cmds):
+def do_system_calls(cmds, model="", threads=0):
+    env = dict(os.environ, **{instrumentation.MODEL_VAR: model})
+    if threads:
+        env.update((var, str(threads)) for var in THREAD_ENV_VARS)
     for cmd in cmds:
         # We're making calls for effect; redirect stdout to stdout
         print("Running command: %s" % cmd, file=sys.stderr)
-        os.system(cmd)
+        with instrumentation.stage('command', model=model):
+            wait_with_progress(subprocess.Popen(cmd, shell=True, env=env), model)
         #print(rfutils.system_call(cmd))
 
-def run_model(model_name, input_path, output_path):
+def read_events(filename, offset=0):
+    """ Events appended to filename since offset, and the offset to read
+    from next time """
+    if not filename or not os.path.exists(filename):
+        return [], offset
+    with open(filename, 'rb') as infile:
+        infile.seek(offset)
+        data = infile.read()
+    # leave a line that is still being written for next time
+    end = data.rfind(b"\n") + 1
+    events = [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line]
+    return events, offset + end
+
+def wait_with_progress(process, model):
+    """ Wait for a scorer, showing the progress it reports and an ETA """
+    filename = instrumentation.events_filename()
+    _, offset = read_events(filename, os.path.getsize(filename) if filename and os.path.exists(filename) else 0)
+    latest = {}
+    first = None
+    while True:
+        try:
+            process.wait(timeout=instrumentation.PROGRESS_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        events, offset = read_events(filename, offset)
+        for event in events:
+            if event['event'] == 'progress' and event['model'] == model:
+                # sharded scorers report from several processes
+                latest[event['pid'], event['stage']] = event
+                if first is None:
+                    first = (event['time'], event['done'])
+        if latest and first:
+            done = sum(event['done'] for event in latest.values())
+            total = sum(event['total'] for event in latest.values())
+            unit = next(iter(latest.values()))['unit']
+            rate = (done - first[1]) / max(time.time() - first[0], 1e-9)
+            eta = "%ds left" % ((total - done) / rate) if rate > 0 else "?"
+            print("\r%s: %d/%d %s, %s   " % (model, done, total, unit, eta), end="", file=sys.stderr)
+    if latest:
+        print(file=sys.stderr)
+    return process.returncode
+
+def profile(filename):
+    """ The stage events in filename summed per model, process and stage """
+    events, _ = read_events(filename)
+    stages = pd.DataFrame([event for event in events if event['event'] == 'stage'])
+    if stages.empty:
+        return stages
+    for column in ['tokens', 'calls']:
+        if column not in stages:
+            stages[column] = 0
+    df = stages.groupby(['model', 'process', 'stage'], sort=False).agg(
+        wall=('wall', 'sum'),
+        cpu=('cpu', 'sum'),
+        calls=('calls', 'sum'),
+        tokens=('tokens', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'),
+    ).reset_index()
+    df['tokens'] = df['tokens'].fillna(0).astype(int)
+    df['tokens_per_second'] = (df['tokens'] / df['wall']).where(df['tokens'] > 0)
+    return df
+
+def score_with_daemon(model_name, sentences):
+    """ Score an iterable of sentence strings with a running daemon.
+
+    Returns a DataFrame with columns model_word and surprisal, one row per
+    token, as run_models reads back from a model's output file.
+    """
+    rows = scoring_daemon.score(DAEMONS[model_name], sentences)
+    return pd.DataFrame(rows, columns=['model_word', 'surprisal'])
+
+def command_flags(cmd):
+    """ The --flags of a command line and their values (True for a flag
+    without one) """
+    tokens = shlex.split(cmd)
+    flags = {}
+    for i, token in enumerate(tokens):
+        if token.startswith("--"):
+            flag, equals, value = token.partition("=")
+            if not equals:
+                value = tokens[i + 1] if i + 1 < len(tokens) and not tokens[i + 1].startswith("--") else True
+            flags[flag] = value
+    return flags
+
+def command_fingerprint(model_name):
+    """ The fingerprint a daemon serving the model that MODELS[model_name]
+    loads would report, or None if DAEMON_FILE_FLAGS doesn't say """
+    if model_name not in DAEMON_FILE_FLAGS or model_name not in MODELS:
+        return None
+    flags = command_flags(MODELS[model_name][-1])
+    files = [flags[flag] for flag in DAEMON_FILE_FLAGS[model_name] if isinstance(flags.get(flag), str)]
+    settings = {
+        name: (flag in flags) if isinstance(default, bool) else type(default)(flags.get(flag, default))
+        for name, (flag, default) in DAEMON_SETTING_FLAGS.get(model_name, {}).items()
+    }
+    return scoring_daemon.fingerprint(files, **settings)
+
+def daemon_address(model_name):
+    """ The address of a running daemon that has the model of
+    MODELS[model_name] loaded, or None """
+    address = DAEMONS.get(model_name)
+    if not address or not scoring_daemon.is_running(address):
+        return None
+    expected = command_fingerprint(model_name)
+    try:
+        identity = scoring_daemon.identify(address)
+    except (OSError, ValueError):
+        return None
+    if expected is None or identity != expected:
+        print("The daemon at %s does not have the %s model of MODELS loaded; running its command instead"
+              % (address, model_name), file=sys.stderr)
+        return None
+    return address
+
+def run_model(model_name, input_path, output_path, threads=0, candidates=0):
+    address = None if candidates else daemon_address(model_name)
+    if address:
+        print("Scoring with daemon at %s" % address, file=sys.stderr)
+        with open(input_path) as infile:
+            sentences = [line.strip() for line in infile]
+        output_df = score_with_daemon(model_name, sentences)
+        output_df.to_csv(output_path, sep="\t", header=False, index=False)
+        return
+    cmds = list(MODELS[model_name])
+    if candidates and model_name in CANDIDATE_FLAGS:
+        cmds[-1] += " " + CANDIDATE_FLAGS[model_name]
     return do_system_calls(
-        cmd.format(input_path=input_path, output_path=output_path)
-        for cmd in MODELS[model_name]
+        (cmd.format(input_path=input_path, output_path=output_path, threads=threads,
+                    shards=SHARDS.get(model_name, 1), candidates=candidates)
+         for cmd in cmds),
+        model_name, threads
     )
 
 def sentences(words):
@@ -102,53 +308,369 @@ def is_unk(w):
 def is_final(w):
     return w in FINAL_TOKENS
 
-def run_models(path, conditions_df, models):
-    # Write sentences to a txt file to be fed to the LSTMs
+def thread_budgets(models, cores=None):
+    """ Split the machine's cores (or cores of them) between models,
+    honoring THREAD_BUDGETS """
+    budgets = {model: THREAD_BUDGETS[model] for model in models if model in THREAD_BUDGETS}
+    rest = [model for model in models if model not in budgets]
+    if rest:
+        spare = max((cores or os.cpu_count()) - sum(budgets.values()), len(rest))
+        budgets.update((model, spare // len(rest)) for model in rest)
+    return budgets
+
+def read_model_output(model, output_filename, candidates=0):
+    """ A model's output file as a DataFrame; with candidates, plus the
+    DISTRIBUTION_COLUMNS from its sidecar, if it wrote one """
+    output_df = pd.read_csv(
+        output_filename,
+        sep="\t",
+        header=None,
+        index_col=None,
+        names=['model_word', 'surprisal']
+    )
+    output_df['model'] = model
+    sidecar = distributions.sidecar_filename(output_filename)
+    if candidates and os.path.exists(sidecar):
+        columns = distributions.columns(sidecar)
+        if len(columns) != len(output_df):
+            raise ValueError("%s has %d rows for %d in %s" % (sidecar, len(columns), len(output_df), output_filename))
+        for column in DISTRIBUTION_COLUMNS:
+            output_df[column] = columns[column].to_numpy()
+    return output_df
+
+def write_model_output(output_df, output_filename):
+    """ Write a model's output DataFrame in the scorers' format """
+    output_df[['model_word', 'surprisal']].to_csv(
+        output_filename, sep="\t", header=False, index=False, quoting=csv.QUOTE_NONE)
+
+def model_fingerprint(model_name, settings=None):
+    """ Hash of a model's commands (or backend settings) and the size and
+    mtime of every file they mention (or that are in a directory they
+    mention), so that changing a checkpoint or vocabulary changes it """
+    if settings is None:
+        texts = MODELS[model_name]
+    else:
+        texts = [json.dumps(settings, sort_keys=True)] + [value for value in settings.values() if isinstance(value, str)]
+    h = hashlib.sha1()
+    for text in texts:
+        h.update(text.encode("utf-8"))
+        for token in text.split():
+            pattern = os.path.expanduser(token.strip("'\""))
+            for filename in sorted(glob.glob(pattern)):
+                if os.path.isdir(filename):
+                    filenames = sorted(os.path.join(filename, name) for name in os.listdir(filename))
+                else:
+                    filenames = [filename]
+                for filename in filenames:
+                    if os.path.isfile(filename):
+                        stat = os.stat(filename)
+                        h.update(("%s:%d:%d" % (filename, stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+    return h.hexdigest()
+
+def read_rows(filename):
+    with open(filename, newline='') as infile:
+        return [(word, float(surprisal)) for word, surprisal in csv.reader(infile, delimiter="\t", quoting=csv.QUOTE_NONE)]
+
+def cached_rows(model, fingerprint, sents, score, cache_path=CACHE_PATH):
+    """ Rows for every token of sents, from the cache where it has them;
+    score takes a list of the other sentences and returns their rows """
+    with surprisal_cache.SurprisalCache(cache_path, CACHE_MAX_BYTES) as cache:
+        cached = cache.get_many(model, fingerprint, sents)
+        misses = [sent for sent in dict.fromkeys(sents) if sent not in cached]
+        print("%s: %d of %d sentences cached" % (model, len(sents) - len(misses), len(sents)), file=sys.stderr)
+        if misses:
+            rows = score(misses)
+            # Each model writes one row per input token
+            lengths = [len(sent.split()) for sent in misses]
+            if len(rows) != sum(lengths):
+                raise ValueError("%s wrote %d rows for %d tokens" % (model, len(rows), sum(lengths)))
+            scored = []
+            start = 0
+            for sent, length in zip(misses, lengths):
+                scored.append((sent, rows[start:start + length]))
+                start += length
+            cache.put_many(model, fingerprint, scored)
+            cached.update(scored)
+    return [row for sent in sents for row in cached[sent]]
+
+def run_model_cached(model, input_filename, output_filename, threads=0, cache_path=CACHE_PATH):
+    """ Like run_model, but only sentences missing from the cache are scored """
+    with open(input_filename) as infile:
+        sents = [line.strip() for line in infile]
+
+    def score(misses):
+        misses_input = output_filename + ".misses.txt"
+        misses_output = output_filename + ".misses.tsv"
+        with open(misses_input, 'wt') as outfile:
+            for sent in misses:
+                print(sent, file=outfile)
+        run_model(model, misses_input, misses_output, threads)
+        rows = read_rows(misses_output)
+        os.remove(misses_input)
+        os.remove(misses_output)
+        return rows
+
+    rows = cached_rows(model, model_fingerprint(model), sents, score, cache_path)
+    with open(output_filename, 'wt', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter="\t", quoting=csv.QUOTE_NONE, lineterminator="\n")
+        writer.writerows(rows)
+
+def score_in_process(model, settings, input_filename, threads=0, cache_path=None, candidates=0):
+    """ Score input_filename with the model's backend (see backends.py),
+    loaded in this process, straight into an output DataFrame """
+    with open(input_filename) as infile:
+        sents = [line.strip() for line in infile]
+    with instrumentation.stage('model_load', model=model):
+        backend = backends.load(model, settings, threads)
+    candidates = candidates if backend.has_distributions else 0
+
+    def score(sentences):
+        return [row for result in backend.score(sentences, candidates) for row in zip(*result)]
+
+    # tag the backend's own stages with the model, as for a command
+    previous = os.environ.get(instrumentation.MODEL_VAR)
+    os.environ[instrumentation.MODEL_VAR] = model
+    try:
+        if cache_path and not candidates:
+            rows = cached_rows(model, model_fingerprint(model, settings), sents, score, cache_path)
+        else:
+            rows = score(sents)
+    finally:
+        if previous is None:
+            del os.environ[instrumentation.MODEL_VAR]
+        else:
+            os.environ[instrumentation.MODEL_VAR] = previous
+    output_df = pd.DataFrame([row[:2] for row in rows], columns=['model_word', 'surprisal'])
+    output_df['model'] = model
+    if candidates:
+        columns = distributions.frame(distributions.encode([row[2] for row in rows], backend.id_to_word))
+        for column in DISTRIBUTION_COLUMNS:
+            output_df[column] = columns[column].to_numpy()
+    return output_df
+
+def score_model(model, input_filename, output_filename, threads=0, cache_path=None, candidates=0):
+    """ Run one model over input_filename and return its output DataFrame.
+
+    With a thread budget, the model is limited to that many threads.
+    With a cache path, only sentences not already in the cache are scored.
+    With candidates, the model also writes its distributions sidecar, if it
+    can. Models in the backends config file are scored in the calling
+    process instead of by their command: in the main process when models
+    run one after another, in a worker with --parallel.
+    """
+    settings = backends.read_config().get(model)
+    if settings is not None:
+        with instrumentation.stage('score', model=model, in_process=True) as stage:
+            output_df = score_in_process(model, settings, input_filename, threads, cache_path, candidates)
+            stage.set(tokens=len(output_df))
+        return output_df
+    with instrumentation.stage('score', model=model):
+        if cache_path and not candidates:
+            run_model_cached(model, input_filename, output_filename, threads, cache_path)
+        else:
+            run_model(model, input_filename, output_filename, threads, candidates)
+    with instrumentation.stage('read_output', model=model) as stage:
+        output_df = read_model_output(model, output_filename, candidates)
+        stage.set(tokens=len(output_df))
+    return output_df
+
+def write_input(path, conditions_df):
+    """ Write the sentences of conditions_df to input.txt in path, one per
+    line, to be fed to the models; return its filename """
     input_filename = os.path.join(path, "input.txt")
     with open(input_filename, 'wt') as outfile:
         for sentence in sentences(conditions_df['word']):
             print(sentence, file=outfile)
-            
+    return input_filename
+
+def output_filename(path, model):
+    return os.path.join(path, "%s_output.tsv" % model)
+
+def model_outputs(path, conditions_df, models, parallel=False, cache_path=None, candidates=0):
+    """ Score conditions_df with each model; generate (model, output DataFrame)
+    pairs in the order of models """
+    input_filename = write_input(path, conditions_df)
+
     # Run the LSTMs by command line invocation
     def output_dfs():
         for model in models:
-            output_filename = os.path.join(path, "%s_output.tsv" % model)
-            print(output_filename)
-            run_model(model, input_filename, output_filename)
-            output_df = pd.read_csv(
-                os.path.join(output_filename),
-                sep="\t",
-                header=None,
-                index_col=None,
-                names=['model_word', 'surprisal']
-            )
-            output_df['model'] = model
-            yield pd.concat([conditions_df, output_df], axis=1)
-
-    # Combine results with conditions
-    df = functools.reduce(pd.DataFrame.append, output_dfs())
-
-    # Do some checking
-    assert df.shape == (conditions_df.shape[0] * len(models), conditions_df.shape[1] + 3)
-    df['unk'] = df['model_word'].map(is_unk)
-    df['final'] = df['model_word'].map(is_final)
-    print(df[(df['model_word'] != df['word']) & ~df['unk'] & ~df['final']])
-    assert ((df['model_word'] == df['word']) | df['unk'] | df['final']).all()
-    
+            print(output_filename(path, model))
+            yield model, score_model(model, input_filename, output_filename(path, model), cache_path=cache_path, candidates=candidates)
+
+    # Run all the LSTMs at once, each in its own process with its own share
+    # of the cores, collecting their outputs as they finish
+    def parallel_output_dfs():
+        budgets = thread_budgets(models)
+        results = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(models)) as pool:
+            futures = {
+                pool.submit(score_model, model, input_filename, output_filename(path, model), budgets[model], cache_path, candidates): model
+                for model in models
+            }
+            for future in concurrent.futures.as_completed(futures):
+                model = futures[future]
+                results[model] = future.result()
+                print("Finished %s (%d/%d)" % (model, len(results), len(models)), file=sys.stderr)
+        for model in models:
+            yield model, results[model]
+
+    for model, output_df in (parallel_output_dfs() if parallel else output_dfs()):
+        if len(output_df) != len(conditions_df):
+            raise ValueError("%s produced %d tokens for %d in items.tsv" % (model, len(output_df), len(conditions_df)))
+        yield model, output_df
+
+def add_flags(df):
+    df['unk'] = df['model_word'].isin(UNK_TOKENS)
+    df['final'] = df['model_word'].isin(FINAL_TOKENS)
+
+def check_alignment(df):
+    """ Make sure every model word is the item word, UNK or end of sentence,
+    printing the tokens that are not """
+    bad = (df['model_word'] != df['word']) & ~df['unk'] & ~df['final']
+    if bad.any():
+        diff = df.loc[bad, ['model', 'sent_index', 'condition', 'word_index', 'word', 'model_word']]
+        print("%d tokens do not line up with items.tsv:" % len(diff), file=sys.stderr)
+        print(diff.to_string(max_rows=20), file=sys.stderr)
+    assert not bad.any()
+
+def align_output(conditions_df, model, output_df, candidates=0):
+    """ conditions_df joined with one model's output, flagged and checked """
+    df = conditions_df.copy()
+    df['model_word'] = output_df['model_word'].to_numpy()
+    df['surprisal'] = output_df['surprisal'].to_numpy()
+    df['model'] = model
+    if candidates:
+        for column in DISTRIBUTION_COLUMNS:
+            df[column] = output_df[column].to_numpy() if column in output_df else empty_column(column, len(df))
+    add_flags(df)
+    check_alignment(df)
+    return df
+
+def empty_column(column, n):
+    """ A distribution column for a model that has none """
+    if column == 'entropy':
+        return np.full(n, np.nan)
+    return np.full(n, "", dtype=object)
+
+def run_models(path, conditions_df, models, parallel=False, cache_path=None, candidates=0):
+    outputs = model_outputs(path, conditions_df, models, parallel, cache_path, candidates)
+    return join_outputs(conditions_df, models, outputs, candidates)
+
+def join_outputs(conditions_df, models, outputs, candidates=0):
+    """ conditions_df once per model, with the surprisals of the (model,
+    output DataFrame) pairs in outputs, which come in the order of models """
+    n = len(conditions_df)
+    join = instrumentation.Stage('join')
+    with join:
+        # One block of rows per model, in order, each a copy of conditions_df
+        df = conditions_df.iloc[np.tile(np.arange(n), len(models))].copy()
+        model_word = np.empty(n * len(models), dtype=object)
+        surprisal = np.empty(n * len(models), dtype=np.float64)
+        model_column = np.repeat(np.array(models, dtype=object), n)
+        extra = {column: empty_column(column, n * len(models)) for column in DISTRIBUTION_COLUMNS} if candidates else {}
+    for i, (model, output_df) in enumerate(outputs):
+        with join:
+            model_word[i * n:(i + 1) * n] = output_df['model_word'].to_numpy()
+            surprisal[i * n:(i + 1) * n] = output_df['surprisal'].to_numpy()
+            for column, values in extra.items():
+                if column in output_df:
+                    values[i * n:(i + 1) * n] = output_df[column].to_numpy()
+    with join:
+        df['model_word'] = model_word
+        df['surprisal'] = surprisal
+        df['model'] = model_column
+        for column, values in extra.items():
+            df[column] = values
+
+        # Do some checking
+        add_flags(df)
+        check_alignment(df)
+    join.emit(tokens=len(df))
+
     return df
 
+def stream_models(path, conditions_df, models, filename, parallel=False, cache_path=None, candidates=0):
+    """ Like run_models, but append each model's results to the CSV filename
+    as they come instead of holding them all. Returns the region aggregates. """
+    cubes = []
+    with open(filename, 'w') as outfile:
+        for i, (model, output_df) in enumerate(model_outputs(path, conditions_df, models, parallel, cache_path, candidates)):
+            df = align_output(conditions_df, model, output_df, candidates)
+            df.to_csv(outfile, header=(i == 0))
+            cubes.append(aggregate_regions.aggregate(df))
+    return pd.concat(cubes, ignore_index=True)
+
 
 def main(path, *models):
-    if not models:
-        models = MODELS
+    # `--parallel` anywhere among the models runs them all at once;
+    # `--nocache` ignores and doesn't fill the surprisal cache;
+    # `--columnar` writes combined_results.npz (see results_store) instead
+    # of combined_results.csv;
+    # `--stream` writes combined_results.csv one model at a time;
+    # `--distributions` adds the DISTRIBUTION_COLUMNS to the results
+    options = {"--parallel", "--nocache", "--columnar", "--stream", "--distributions"}
+    parallel = "--parallel" in models
+    cache_path = None if "--nocache" in models else CACHE_PATH
+    columnar = "--columnar" in models
+    stream = "--stream" in models
+    candidates = CANDIDATES if "--distributions" in models else 0
+    if stream and columnar:
+        # combined_results.npz is written whole, from all the models' results
+        raise ValueError("--stream writes combined_results.csv; it can't be combined with --columnar")
+    models = [model for model in models if model not in options] or default_models()
     path = os.path.abspath(path)
+    # Every stage of this run, here and in the scorers, goes to events.jsonl
+    # (or wherever RNN_SOFT_CONSTRAINTS_EVENTS already points)
+    if instrumentation.events_filename():
+        return run_experiment(path, models, parallel, cache_path, columnar, stream, candidates)
+    os.environ[instrumentation.EVENTS_VAR] = os.path.join(path, EVENTS_FILENAME)
+    open(os.environ[instrumentation.EVENTS_VAR], 'w').close()
+    try:
+        return run_experiment(path, models, parallel, cache_path, columnar, stream, candidates)
+    finally:
+        del os.environ[instrumentation.EVENTS_VAR]
+
+def default_models():
+    """ The models in the backends config file, if there is one, or else
+    those in MODELS """
+    return list(backends.read_config() or MODELS)
+
+def read_items(path):
+    with instrumentation.stage('read_items'):
+        return pd.read_csv(
+            os.path.join(path, "items.tsv"),
+            sep="\t",
+        )
+
+def write_results(path, df, columnar=False):
+    """ Write the joined results and their region aggregates to path """
+    with instrumentation.stage('write_results'):
+        if columnar:
+            results_store.write_results(df, os.path.join(path, results_store.FILENAME))
+        else:
+            df.to_csv(os.path.join(path, "combined_results.csv"))
+    with instrumentation.stage('aggregate_regions'):
+        cube = aggregate_regions.aggregate(df)
+    cube.to_csv(os.path.join(path, aggregate_regions.FILENAME), index=False)
+
+def write_profile(path):
+    """ Sum the run's events into profile.csv in path, and print it """
+    profile_df = profile(instrumentation.events_filename())
+    if not profile_df.empty:
+        profile_df.to_csv(os.path.join(path, PROFILE_FILENAME), index=False)
+        print(profile_df.to_string(index=False), file=sys.stderr)
+
+def run_experiment(path, models, parallel, cache_path, columnar, stream, candidates=0):
     # Read in the data
-    conditions_df = pd.read_csv(
-        os.path.join(path, "items.tsv"),
-        sep="\t",
-    )
-    df = run_models(path, conditions_df, models)
-    df.to_csv(os.path.join(path, "combined_results.csv"))
+    conditions_df = read_items(path)
+    if stream:
+        filename = os.path.join(path, "combined_results.csv")
+        cube = stream_models(path, conditions_df, models, filename, parallel=parallel, cache_path=cache_path, candidates=candidates)
+        cube.to_csv(os.path.join(path, aggregate_regions.FILENAME), index=False)
+    else:
+        df = run_models(path, conditions_df, models, parallel=parallel, cache_path=cache_path, candidates=candidates)
+        write_results(path, df, columnar)
+    write_profile(path)
 
 if __name__ == "__main__":
     main(*sys.argv[1:])
@@ -0,0 +1,131 @@
+"""Keep a language model resident and score sentences sent over a socket.
+
+A scorer started with `--serve ADDRESS` loads its model once and then answers
+requests until it is killed. ADDRESS is either a filesystem path (a Unix
+socket) or `host:port` (a localhost TCP port).
+
+The protocol is one JSON object per line in each direction:
+
+    request:  {"sentences": ["The man gave a dog a bone . <eos>", ...]}
+    response: {"rows": [["The", 0.0], ["man", 19.79], ...]}
+
+    request:  {"identify": true}
+    response: {"fingerprint": "3f2a..."}
+
+`rows` has exactly the (model_word, surprisal) lines the scorer would have
+written to its output TSV for the same sentences, in the same order.
+`fingerprint` identifies the model the daemon has loaded (see fingerprint()),
+so that run_models only uses a daemon serving the model it is configured
+with.
+"""
+from __future__ import print_function
+import os
+import sys
+import glob
+import json
+import hashlib
+import socket
+import socketserver
+
+
+def parse_address(address):
+    if os.sep not in address and ":" in address:
+        host, port = address.rsplit(":", 1)
+        return socket.AF_INET, (host or "localhost", int(port))
+    return socket.AF_UNIX, address
+
+def fingerprint(files, **settings):
+    """ Identity of a loaded model: the real path, size and mtime of each of
+    its files (with glob patterns and directories expanded), and the
+    settings that change its surprisals """
+    stats = []
+    for pattern in files:
+        for filename in sorted(glob.glob(os.path.expanduser(pattern))):
+            if os.path.isdir(filename):
+                filenames = [os.path.join(filename, name) for name in os.listdir(filename)]
+            else:
+                filenames = [filename]
+            for filename in filenames:
+                if os.path.isfile(filename):
+                    stat = os.stat(filename)
+                    stats.append([os.path.realpath(filename), stat.st_size, stat.st_mtime_ns])
+    text = json.dumps({'files': sorted(stats), 'settings': settings}, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def serve(address, score_sentences, identity=""):
+    """ Answer scoring requests on address forever.
+
+    score_sentences takes a list of sentence strings and returns a list of
+    (word, surprisal) pairs; identity is the model's fingerprint(). Requests
+    are handled one at a time, since the models are not safe to call
+    concurrently.
+    """
+    family, sockaddr = parse_address(address)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    if request.get('identify'):
+                        self.respond({'fingerprint': identity})
+                        continue
+                    rows = [
+                        (word, float(surprisal))
+                        for word, surprisal in score_sentences(request['sentences'])
+                    ]
+                    response = {'rows': rows}
+                except Exception as e:
+                    response = {'error': "%s: %s" % (type(e).__name__, e)}
+                self.respond(response)
+
+        def respond(self, response):
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+    if family == socket.AF_UNIX:
+        if os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+        server = socketserver.UnixStreamServer(sockaddr, Handler)
+    else:
+        socketserver.TCPServer.allow_reuse_address = True
+        server = socketserver.TCPServer(sockaddr, Handler)
+    print("Serving on %s" % address, file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+
+def connect(address, timeout=None):
+    family, sockaddr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(sockaddr)
+    return sock
+
+def is_running(address):
+    try:
+        connect(address, timeout=1).close()
+        return True
+    except (OSError, ValueError):
+        return False
+
+def request(address, message):
+    with connect(address) as sock:
+        sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode("utf-8"))
+
+def identify(address):
+    """ The fingerprint of the model loaded by the daemon at address, or None
+    if it doesn't report one """
+    return request(address, {'identify': True}).get('fingerprint') or None
+
+def score(address, sentences):
+    """ Send sentences to the daemon at address; return (word, surprisal) pairs. """
+    response = request(address, {'sentences': list(sentences)})
+    if 'error' in response:
+        raise RuntimeError("Scoring daemon at %s failed: %s" % (address, response['error']))
+    return [(word, surprisal) for word, surprisal in response['rows']]
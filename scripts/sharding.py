@@ -0,0 +1,47 @@
+"""Score one list of sentences in several processes sharing a loaded model.
+
+The workers are forked after the model is loaded, so its weights are shared
+copy-on-write between them instead of being loaded again in each. Every
+worker scores one contiguous shard of the sentences, and the shards' rows
+are put back together in sentence order, so the output does not depend on
+the number of shards.
+"""
+import multiprocessing
+
+# Set just before forking; the workers inherit them
+_score = None
+_shards = None
+
+
+def split_shards(items, nshards):
+    """ Split items into nshards contiguous runs of nearly equal length """
+    size, extra = divmod(len(items), nshards)
+    result = []
+    start = 0
+    for i in range(nshards):
+        stop = start + size + (i < extra)
+        result.append(items[start:stop])
+        start = stop
+    return result
+
+def _score_shard(i):
+    return list(_score(_shards[i]))
+
+def score_sharded(score, sentences, nshards, initializer=None):
+    """ Score sentences in nshards forked workers.
+
+    score takes a list of sentences and returns a list of rows; the result
+    is the rows for all sentences, in order. initializer runs in each worker
+    before it scores, e.g. to cap its threads.
+    """
+    global _score, _shards
+    nshards = min(nshards, len(sentences))
+    if nshards <= 1:
+        return list(score(sentences))
+    _score, _shards = score, split_shards(sentences, nshards)
+    try:
+        with multiprocessing.get_context('fork').Pool(nshards, initializer) as pool:
+            results = pool.map(_score_shard, range(nshards))
+    finally:
+        _score, _shards = None, None
+    return [row for rows in results for row in rows]
@@ -0,0 +1,154 @@
+"""Tiny randomly initialized stand-ins for the scoring backends.
+
+Each make_* function writes files that the corresponding scorer loads
+exactly as it loads the real model, so benchmark.py (or anyone) can run the
+whole pipeline without the multi-GB checkpoints:
+
+* make_google: a graph .pbtxt with the tensor names eval_test_google.py
+  imports, a checkpoint restorable with save/restore_all, and a vocabulary
+  file for data_utils.CharsVocabulary
+* make_gulordava: a pickled colorlessgreenRNNs RNNModel and a data
+  directory with vocab.txt for dictionary_corpus.Dictionary
+* make_ngram: an ARPA file for ngram_model.py
+
+The vocabulary is the words of the given items plus filler words up to
+vocab_size, so that the softmax has a realistic share of the cost. Weights
+are random; the surprisals mean nothing.
+"""
+import os
+import random
+
+import numpy as np
+
+SPECIAL_WORDS = ["<unk>", "<eos>"]
+
+
+def vocabulary(words, vocab_size, seed=0):
+    """ The distinct words, then filler words up to vocab_size """
+    vocab = list(dict.fromkeys(list(SPECIAL_WORDS) + list(words)))
+    rng = random.Random(seed)
+    while len(vocab) < vocab_size:
+        vocab.append("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 10))))
+        vocab = list(dict.fromkeys(vocab))
+    return vocab
+
+def make_google(dirname, vocab, dim=32, max_word_length=50, seed=0):
+    """ Write graph.pbtxt, ckpt and vocab.txt to dirname; return their paths.
+
+    The graph has the interface of lm_1b's graph-2016-09-10.pbtxt: [1, 1]
+    inputs, LSTM state kept in variables that states_init zeroes, a char-CNN-less word
+    embedding plus a mean char embedding, and a full softmax.
+    """
+    import tensorflow as tf
+
+    os.makedirs(dirname, exist_ok=True)
+    # lm_1b marks the sentence boundaries with <S> and </S>, and UNK as <UNK>
+    words = ["<S>", "</S>", "<UNK>"] + [word for word in vocab if word not in SPECIAL_WORDS]
+    vocab_file = os.path.join(dirname, "vocab.txt")
+    with open(vocab_file, "w") as outfile:
+        for word in words:
+            print(word, file=outfile)
+    vocab_size = len(words)
+
+    with tf.Graph().as_default() as graph:
+        tf.set_random_seed(seed)
+        softmax_weights = tf.get_variable("softmax/w", [vocab_size, dim])
+        tf.reshape(softmax_weights, [vocab_size, dim], name="Reshape_3")
+        softmax_bias = tf.get_variable("softmax/b", [vocab_size], initializer=tf.zeros_initializer())
+        global_step = tf.get_variable("global_step", [], tf.int64, initializer=tf.zeros_initializer(), trainable=False)
+
+        inputs = tf.placeholder(tf.int32, [1, 1], name="inputs_in")
+        char_inputs = tf.placeholder(tf.int32, [1, 1, max_word_length], name="char_inputs_in")
+        targets = tf.placeholder(tf.int32, [1, 1], name="targets_in")
+        target_weights = tf.placeholder(tf.float32, [1, 1], name="target_weights_in")
+
+        embeddings = tf.get_variable("emb", [vocab_size, dim])
+        tf.identity(embeddings, name="all_embs_out")
+        # CharsVocabulary's char ids are code points, so words outside
+        # Latin-1 have ids past 255
+        num_chars = max([257] + [ord(char) + 1 for word in words for char in word])
+        char_embeddings = tf.get_variable("char_emb", [num_chars, dim])
+        x = (tf.nn.embedding_lookup(embeddings, inputs) +
+             tf.reduce_mean(tf.nn.embedding_lookup(char_embeddings, char_inputs), axis=2))
+
+        states = []
+        with tf.variable_scope("lstm"):
+            for layer in range(2):
+                with tf.variable_scope("lstm_%d" % layer):
+                    c = tf.get_variable("c", [1, dim], initializer=tf.zeros_initializer(), trainable=False)
+                    h = tf.get_variable("h", [1, dim], initializer=tf.zeros_initializer(), trainable=False)
+                    w = tf.get_variable("w", [2 * dim, 4 * dim])
+                    states.extend([c, h])
+                    gates = tf.matmul(tf.concat([x[:, 0], h], 1), w)
+                    i, j, f, o = tf.split(gates, 4, axis=1)
+                    new_c = tf.sigmoid(f) * c + tf.sigmoid(i) * tf.tanh(j)
+                    new_h = tf.sigmoid(o) * tf.tanh(new_c)
+                    with tf.control_dependencies([tf.assign(c, new_c), tf.assign(h, new_h)]):
+                        x = tf.identity(tf.expand_dims(new_h, 1), name="control_dependency")
+
+        with tf.name_scope("softmax"):
+            logits = tf.matmul(tf.reshape(x, [-1, dim]), softmax_weights, transpose_b=True) + softmax_bias
+            flat_targets = tf.reshape(targets, [-1])
+            losses = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=flat_targets, logits=logits)
+            flat_weights = tf.reshape(target_weights, [-1])
+        tf.nn.softmax(logits, name="softmax_out")
+        tf.identity(flat_targets, name="class_ids_out")
+        tf.identity(flat_weights, name="class_weights_out")
+        tf.divide(tf.reduce_sum(losses * flat_weights), tf.maximum(tf.reduce_sum(flat_weights), 1.0),
+                  name="log_perplexity_out")
+        tf.group(*[tf.assign(state, tf.zeros_like(state)) for state in states], name="states_init")
+
+        saver = tf.train.Saver()
+        graph_file = os.path.join(dirname, "graph.pbtxt")
+        tf.train.write_graph(graph.as_graph_def(), dirname, "graph.pbtxt", as_text=True)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            ckpt = saver.save(sess, os.path.join(dirname, "ckpt"), write_meta_graph=False)
+    return graph_file, ckpt, vocab_file
+
+def make_gulordava(dirname, vocab, dim=32, nlayers=2, seed=0):
+    """ Write model.pt and data/vocab.txt to dirname; return their paths.
+
+    Needs colorlessgreenRNNs' language_models directory on sys.path, for
+    model.RNNModel, which the pickle refers to.
+    """
+    import torch
+    import model as model_module
+
+    os.makedirs(os.path.join(dirname, "data"), exist_ok=True)
+    data = os.path.join(dirname, "data")
+    with open(os.path.join(data, "vocab.txt"), "w") as outfile:
+        for word in vocab:
+            print(word, file=outfile)
+    torch.manual_seed(seed)
+    model = model_module.RNNModel("LSTM", len(vocab), dim, dim, nlayers, 0.0)
+    checkpoint = os.path.join(dirname, "model.pt")
+    with open(checkpoint, "wb") as outfile:
+        torch.save(model, outfile)
+    return checkpoint, data
+
+def make_ngram(dirname, vocab, sentences, seed=0):
+    """ Write model.arpa to dirname, with every unigram in vocab and the
+    bigrams seen in sentences; return its path """
+    os.makedirs(dirname, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    unigrams = ["<s>", "</s>"] + [word for word in vocab if word != "<eos>"]
+    bigrams = sorted({
+        pair
+        for sentence in sentences
+        for pair in zip(["<s>"] + sentence.split()[:-1], sentence.split()[:-1] + ["</s>"])
+    })
+    bigrams = [(a, b) for a, b in bigrams if a in unigrams and b in unigrams]
+    arpa = os.path.join(dirname, "model.arpa")
+    with open(arpa, "w") as outfile:
+        print("\\data\\", file=outfile)
+        print("ngram 1=%d" % len(unigrams), file=outfile)
+        print("ngram 2=%d" % len(bigrams), file=outfile)
+        print("\n\\1-grams:", file=outfile)
+        for word in unigrams:
+            print("%.6f\t%s\t%.6f" % (-rng.uniform(2, 6), word, -rng.uniform(0, 1)), file=outfile)
+        print("\n\\2-grams:", file=outfile)
+        for a, b in bigrams:
+            print("%.6f\t%s %s" % (-rng.uniform(0.5, 3), a, b), file=outfile)
+        print("\n\\end\\", file=outfile)
+    return arpa
@@ -0,0 +1,109 @@
+"""On-disk cache of per-token surprisals, keyed by model and sentence.
+
+Entries are keyed by (model name, model fingerprint, sentence text) and hold
+the (model_word, surprisal) rows the model produced for that sentence. The
+fingerprint identifies the checkpoint and vocabulary, so retraining a model
+or swapping its files simply stops matching the old entries, which then age
+out. The store is a single SQLite file; its total size is tracked and the
+least recently used entries are evicted past a byte limit.
+"""
+import os
+import json
+import time
+import sqlite3
+
+
+class SurprisalCache(object):
+    def __init__(self, path, max_bytes=2**30):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS surprisals (
+                model TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                sentence TEXT NOT NULL,
+                rows TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, fingerprint, sentence)
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS lru ON surprisals (last_used)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_many(self, model, fingerprint, sentences):
+        """ Return {sentence: rows} for the sentences that are cached """
+        found = {}
+        now = time.time()
+        unique = list(dict.fromkeys(sentences))
+        # stay under SQLite's limit on query parameters
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            query = (
+                "SELECT sentence, rows FROM surprisals "
+                "WHERE model = ? AND fingerprint = ? AND sentence IN (%s)"
+                % ",".join("?" * len(chunk))
+            )
+            for sentence, rows in self.db.execute(query, [model, fingerprint] + chunk):
+                found[sentence] = [tuple(row) for row in json.loads(rows)]
+            self.db.executemany(
+                "UPDATE surprisals SET last_used = ? "
+                "WHERE model = ? AND fingerprint = ? AND sentence = ?",
+                [(now, model, fingerprint, sentence) for sentence in chunk if sentence in found]
+            )
+        self.db.commit()
+        return found
+
+    def put_many(self, model, fingerprint, sentence_rows):
+        """ Store rows for each (sentence, rows) pair, then evict if too big """
+        now = time.time()
+        entries = []
+        for sentence, rows in sentence_rows:
+            encoded = json.dumps([list(row) for row in rows])
+            size = len(encoded) + len(sentence)
+            entries.append((model, fingerprint, sentence, encoded, size, now))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO surprisals VALUES (?, ?, ?, ?, ?, ?)",
+            entries
+        )
+        self.db.commit()
+        self.evict()
+
+    def size(self):
+        """ Total bytes of sentence and row data held """
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM surprisals").fetchone()[0]
+
+    def evict(self):
+        """ Drop least recently used entries until size() <= max_bytes """
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        evicted = 0
+        freed = 0
+        cursor = self.db.execute(
+            "SELECT model, fingerprint, sentence, size FROM surprisals ORDER BY last_used"
+        )
+        doomed = []
+        for model, fingerprint, sentence, size in cursor:
+            if freed >= excess:
+                break
+            doomed.append((model, fingerprint, sentence))
+            freed += size
+            evicted += 1
+        self.db.executemany(
+            "DELETE FROM surprisals WHERE model = ? AND fingerprint = ? AND sentence = ?",
+            doomed
+        )
+        self.db.commit()
+        return evicted
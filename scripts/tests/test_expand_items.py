@@ -0,0 +1,28 @@
+"""Each experiment's expand_items.py reproduces its checked-in tests/items.tsv.
+
+expand_items.py writes tests/items.tsv under the directory it runs in, so
+it is run from a temporary directory and what it writes there is compared
+byte for byte with the experiment's own.
+"""
+import os
+import sys
+import glob
+import subprocess
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(os.path.dirname(HERE))
+EXPERIMENTS = sorted(os.path.dirname(filename) for filename in glob.glob(os.path.join(REPOSITORY, "*", "expand_items.py")))
+
+
+@pytest.mark.parametrize("experiment", EXPERIMENTS, ids=os.path.basename)
+def test_items_match_checked_in(experiment, tmp_path):
+    pytest.importorskip("openpyxl")
+    spreadsheet, = glob.glob(os.path.join(experiment, "*.xlsx"))
+    subprocess.run([sys.executable, os.path.join(experiment, "expand_items.py"), spreadsheet],
+                   cwd=str(tmp_path), check=True)
+    with open(str(tmp_path / "tests" / "items.tsv"), "rb") as infile:
+        expanded = infile.read()
+    with open(os.path.join(experiment, "tests", "items.tsv"), "rb") as infile:
+        assert expanded == infile.read()
@@ -0,0 +1,66 @@
+"""eval_test_google.py --prefix_trie against scoring each sentence in full.
+
+Needs TensorFlow with the 1.x API as `tensorflow` and lm_1b's data_utils.py
+on the path; runs on a stand-in graph from standin_models.py.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import data_utils
+    import eval_test_google
+except (ImportError, AttributeError):
+    pytest.skip("needs TensorFlow 1.x and lm_1b's data_utils.py", allow_module_level=True)
+import standin_models
+
+# Sentences sharing prefixes, with different out-of-vocabulary words at the
+# same place and after a shared one, and a word with char ids past 255
+SENTENCES = [
+    "The man gave a book to the woman . <eos>",
+    "The man gave the woman a book . <eos>",
+    "The zorblax ran away . <eos>",
+    "The quuxify ran away . <eos>",
+    "The zorblax gave a book to the quuxify . <eos>",
+    "The zorblax gave a book to the woman . <eos>",
+    "The man gave the woman an œuvre . <eos>",
+]
+VOCAB = ["The", "man", "gave", "a", "an", "book", "œuvre", "to", "the", "woman", ".", "ran", "away"]
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    pbtxt, ckpt, vocab_file = standin_models.make_google(
+        str(tmp_path_factory.mktemp("google")), standin_models.vocabulary(VOCAB, 50))
+    sess, t = eval_test_google._LoadModel(pbtxt, ckpt)
+    vocab = data_utils.CharsVocabulary(vocab_file, eval_test_google.MAX_WORD_LEN)
+    return sess, t, vocab
+
+def test_trie_matches_full_scoring(model):
+    sess, t, vocab = model
+    full = eval_test_google._ScoreSents(sess, t, vocab, SENTENCES)
+    trie = eval_test_google._ScoreSentsTrie(sess, t, vocab, SENTENCES)
+    assert [word for word, _ in trie] == [word for word, _ in full]
+    np.testing.assert_allclose([s for _, s in trie], [s for _, s in full], atol=1e-4)
+
+def test_trie_tells_unknown_words_apart(model):
+    sess, t, vocab = model
+    rows = eval_test_google._ScoreSentsTrie(sess, t, vocab, SENTENCES[2:4])
+    first, second = rows[:len(rows) // 2], rows[len(rows) // 2:]
+    assert [word for word, _ in first] == [word for word, _ in second]
+    # the stand-in reads the characters, so what follows the unknown words differs
+    assert first[2][1] != pytest.approx(second[2][1])
+
+def test_trie_candidates_match_full_scoring(model):
+    sess, t, vocab = model
+    full = eval_test_google._ScoreSents(sess, t, vocab, SENTENCES, candidates=3)
+    trie = eval_test_google._ScoreSentsTrie(sess, t, vocab, SENTENCES, candidates=3)
+    for (_, _, full_dist), (_, _, trie_dist) in zip(full, trie):
+        if full_dist is None:
+            assert trie_dist is None
+        else:
+            np.testing.assert_allclose(trie_dist[0], full_dist[0], atol=1e-4)
+            np.testing.assert_allclose(trie_dist[2], full_dist[2], atol=1e-3)
@@ -0,0 +1,61 @@
+"""Sharded Gulordava scoring against scoring in one process.
+
+score_sentences with shards > 1 forks workers that each score a slice of
+the sentences; the rows they return, put back together, should be the
+unsharded rows in the same order. Uses the stand-in model of
+standin_models.py, and skips without torch or colorlessgreenRNNs'
+language_models modules (model, dictionary_corpus, utils) on the path.
+"""
+import os
+import sys
+import math
+import random
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+torch = pytest.importorskip("torch")
+try:
+    import dictionary_corpus
+    import evaluate_target_word_test
+except ImportError:
+    pytest.skip("colorlessgreenRNNs' language_models modules are not on the path", allow_module_level=True)
+import standin_models
+
+VOCAB = ["<unk>", "<eos>", "the", "a", "man", "dog", "book", "gave", "saw", "to"]
+
+
+@pytest.fixture(scope="module")
+def scorer(tmp_path_factory):
+    vocab = standin_models.vocabulary(VOCAB, 60)
+    checkpoint, data = standin_models.make_gulordava(str(tmp_path_factory.mktemp("gulordava")), vocab)
+    model = evaluate_target_word_test.load_model(checkpoint, False)
+    dictionary = dictionary_corpus.Dictionary(data)
+    rng = random.Random(0)
+    # uneven lengths, repeated prefixes and a word outside the vocabulary
+    words = [word for word in vocab if word != "<eos>"] + ["zzyzx"]
+    sentences = [" ".join(["the", "man"][:rng.randint(0, 2)] + [rng.choice(words) for _ in range(rng.randint(1, 9))] + ["<eos>"])
+                 for _ in range(25)]
+    tokenized = [evaluate_target_word_test.tokenize_sentence(dictionary, sentence) for sentence in sentences]
+
+    def score(**options):
+        return evaluate_target_word_test.score_sentences(
+            model, dictionary, tokenized, 1.0, torch.device("cpu"), **options)
+    return score
+
+def assert_rows_equal(rows, expected):
+    assert [row[0] for row in rows] == [row[0] for row in expected]
+    for row, expected_row in zip(rows, expected):
+        # the workers run on one thread each, which can change the last bits
+        assert math.isclose(row[1], expected_row[1], rel_tol=1e-5, abs_tol=1e-5)
+
+
+@pytest.mark.parametrize("shards", [2, 3])
+@pytest.mark.parametrize("prefixtrie", [False, True])
+def test_sharded_matches_unsharded(scorer, shards, prefixtrie):
+    expected = scorer(prefixtrie=prefixtrie)
+    assert_rows_equal(scorer(prefixtrie=prefixtrie, shards=shards), expected)
+
+def test_more_shards_than_sentences(scorer):
+    assert_rows_equal(scorer(shards=40), scorer())
@@ -0,0 +1,82 @@
+"""ngram_model.py against kenlm's query and postprocess_kenlm.py.
+
+tiny_kenlm_rows.tsv holds what kenlm gave for tiny_sentences.txt with the
+trigram model tiny.arpa, piped through postprocess_kenlm.py;
+test_fixture_is_kenlms_output checks it against kenlm when the kenlm
+module is installed.
+"""
+import os
+import sys
+import math
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import ngram_model
+import postprocess_kenlm
+
+ARPA = os.path.join(HERE, "tiny.arpa")
+SENTENCES = os.path.join(HERE, "tiny_sentences.txt")
+EXPECTED = os.path.join(HERE, "tiny_kenlm_rows.tsv")
+
+
+def read_sentences():
+    with open(SENTENCES) as infile:
+        return [line.strip() for line in infile]
+
+def read_expected():
+    with open(EXPECTED) as infile:
+        return [(word, float(surprisal)) for word, surprisal in (line.rstrip("\n").split("\t") for line in infile)]
+
+def kenlm_rows(sentences):
+    """ What `sed "s/ <eos>//g" | query tiny.arpa | python postprocess_kenlm.py`
+    writes for sentences, through kenlm's Python module """
+    import kenlm
+    model = kenlm.Model(ARPA)
+    lines = []
+    for sentence in sentences:
+        sentence = sentence.replace(" <eos>", "")
+        words = sentence.split() + ["</s>"]
+        scores = list(model.full_scores(sentence))
+        # query writes word=id; postprocess_kenlm only looks at whether the id is 0
+        tokens = ["%s=%d %d %s" % (word, 0 if oov else 1, length, logprob)
+                  for word, (logprob, length, oov) in zip(words, scores)]
+        total = "Total: %s OOV: %d" % (sum(score[0] for score in scores), sum(score[2] for score in scores))
+        lines.append("\t".join(tokens + [total]))
+    return list(postprocess_kenlm.process_lines(lines))
+
+def assert_rows_equal(rows, expected):
+    assert [word for word, _ in rows] == [word for word, _ in expected]
+    for (_, surprisal), (_, expected_surprisal) in zip(rows, expected):
+        # query prints log10 probabilities as float32
+        assert math.isclose(surprisal, expected_surprisal, abs_tol=1e-4)
+
+
+def test_matches_kenlm_query():
+    model = ngram_model.NgramModel.load(ARPA)
+    assert_rows_equal(model.score_sentences(read_sentences()), read_expected())
+
+def test_saved_model_matches_kenlm_query(tmp_path):
+    filename = str(tmp_path / "tiny.npz")
+    ngram_model.NgramModel.load(ARPA).save(filename)
+    model = ngram_model.NgramModel.load(filename)
+    assert_rows_equal(model.score_sentences(read_sentences()), read_expected())
+
+def test_saved_model_is_memory_mapped(tmp_path):
+    filename = str(tmp_path / "tiny.npz")
+    ngram_model.NgramModel.load(ARPA).save(filename)
+    model = ngram_model.NgramModel.load(filename)
+    arrays = [model.vocab] + model.keys + model.logprobs + model.backoffs
+    assert all(isinstance(array, np.memmap) for array in arrays)
+    assert not any(isinstance(value, dict) for value in vars(model).values())
+
+def test_literal_unk_is_written_as_UNK():
+    model = ngram_model.NgramModel.load(ARPA)
+    words = [word for word, _ in model.score_sentences(["<unk> man gave <unk> a book <eos>"])]
+    assert words == ["<UNK>", "man", "gave", "<UNK>", "a", "book", "</s>"]
+
+def test_fixture_is_kenlms_output():
+    pytest.importorskip("kenlm")
+    assert_rows_equal(kenlm_rows(read_sentences()), read_expected())
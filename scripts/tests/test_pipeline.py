@@ -0,0 +1,105 @@
+"""pipeline.py reruns only what is out of date.
+
+The experiment is a copy of particleshift (its spreadsheet and
+expand_items.py, next to a link to scripts/) scored by two in-process
+kenlm models, kenlm and kenlm2, each its own copy of tiny.arpa. Which steps
+ran is read from pipeline.run's messages and from tests/pipeline_state.json.
+"""
+import os
+import sys
+import json
+import shutil
+
+import pandas as pd
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = os.path.dirname(HERE)
+sys.path.insert(0, SCRIPTS)
+import backends
+import pipeline
+
+EXPERIMENT = os.path.join(os.path.dirname(SCRIPTS), "particleshift")
+ARPA = os.path.join(HERE, "tiny.arpa")
+MODELS = ["kenlm", "kenlm2"]
+STEPS = ["items", "input", "score kenlm", "score kenlm2", "combine"]
+
+
+@pytest.fixture
+def experiment(tmp_path, monkeypatch):
+    pytest.importorskip("openpyxl")
+    os.symlink(SCRIPTS, str(tmp_path / "scripts"))
+    directory = tmp_path / "particleshift"
+    directory.mkdir()
+    for name in ["particle-shift.xlsx", "expand_items.py"]:
+        shutil.copy(os.path.join(EXPERIMENT, name), str(directory / name))
+    config = {}
+    for model in MODELS:
+        lm = str(tmp_path / ("%s.arpa" % model))
+        shutil.copy(ARPA, lm)
+        config[model] = {"backend": "kenlm", "lm": lm}
+    with open(str(tmp_path / "models.json"), "w") as outfile:
+        json.dump(config, outfile)
+    monkeypatch.setenv(backends.CONFIG_VAR, str(tmp_path / "models.json"))
+    return str(directory)
+
+def run(directory, capfd):
+    """ Run the experiment's steps; return the names of those that ran """
+    steps = pipeline.experiment_steps(directory, MODELS, {model: 1 for model in MODELS})
+    capfd.readouterr()
+    assert pipeline.run(steps, 2) == []
+    err = capfd.readouterr().err
+    return [step.label for step in steps if "Running %s on" % step.name in err]
+
+def touch(filename):
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_unchanged_inputs_skip_every_step(experiment, capfd):
+    assert run(experiment, capfd) == STEPS
+    state = pipeline.read_state(experiment)
+    assert sorted(state) == sorted(STEPS)
+    outputs = os.path.join(experiment, "tests")
+    mtimes = {name: os.stat(os.path.join(outputs, name)).st_mtime_ns for name in os.listdir(outputs)}
+
+    assert run(experiment, capfd) == []
+    assert pipeline.read_state(experiment) == state
+    for name, mtime in mtimes.items():
+        if name not in ("events.jsonl", pipeline.STATE_FILENAME):
+            assert os.stat(os.path.join(outputs, name)).st_mtime_ns == mtime, name
+
+def test_changed_model_reruns_its_score_and_combine(experiment, capfd):
+    run(experiment, capfd)
+    state = pipeline.read_state(experiment)
+    lm = backends.read_config()["kenlm2"]["lm"]
+    with open(lm) as infile:
+        arpa = infile.read()
+    # a different probability for </s>, which ends every sentence
+    with open(lm, "w") as outfile:
+        outfile.write(arpa.replace("\t</s>", "5\t</s>", 1))
+    assert run(experiment, capfd) == ["score kenlm2", "combine"]
+    new_state = pipeline.read_state(experiment)
+    assert [step for step in STEPS if new_state[step] != state[step]] == ["score kenlm2", "combine"]
+
+def test_touched_model_with_same_output_reruns_only_its_score(experiment, capfd):
+    run(experiment, capfd)
+    touch(backends.read_config()["kenlm2"]["lm"])
+    assert run(experiment, capfd) == ["score kenlm2"]
+
+def test_changed_script_with_same_items_reruns_only_items(experiment, capfd):
+    run(experiment, capfd)
+    state = pipeline.read_state(experiment)
+    with open(os.path.join(experiment, "expand_items.py"), "a") as outfile:
+        outfile.write("\n# expands the same items\n")
+    assert run(experiment, capfd) == ["items"]
+    new_state = pipeline.read_state(experiment)
+    assert [step for step in STEPS if new_state[step] != state[step]] == ["items"]
+
+def test_changed_spreadsheet_reruns_everything_downstream(experiment, capfd):
+    run(experiment, capfd)
+    spreadsheet = os.path.join(experiment, "particle-shift.xlsx")
+    df = pd.read_excel(spreadsheet)
+    df = df.iloc[:len(df) // 2]
+    df.to_excel(spreadsheet, index=False)
+    assert run(experiment, capfd) == STEPS
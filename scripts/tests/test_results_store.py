@@ -0,0 +1,47 @@
+"""results_store.py: a results table read back is the table written."""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import results_store
+
+
+def results_frame():
+    return pd.DataFrame({
+        'Unnamed: 0': [0, 1, 2, 3],
+        'sent_index': [0, 0, 1, 1],
+        'word': ["the", "nan", "NA", "<eos>"],
+        'region': ["Subject NP", np.nan, "Verb", np.nan],
+        'condition': ["a", "a", "b", "b"],
+        'model': ["kenlm"] * 4,
+        'surprisal': [0.0, 2.5, np.nan, 0.125],
+        'entropy': [np.nan] * 4,
+        'candidates': [np.nan] * 4,
+        'unk': [False, True, False, False],
+        'final': [False, False, False, True],
+    })
+
+def test_round_trip(tmp_path):
+    df = results_frame()
+    filename = str(tmp_path / results_store.FILENAME)
+    results_store.write_results(df, filename)
+    read = results_store.read_columns(filename)
+    assert all(isinstance(read[column].dtype, pd.CategoricalDtype)
+               for column in ['word', 'region', 'condition', 'model'])
+    for column in read.columns:
+        if isinstance(read[column].dtype, pd.CategoricalDtype):
+            read[column] = read[column].astype(object)
+    pd.testing.assert_frame_equal(read, df.drop(columns=['Unnamed: 0']), check_dtype=False)
+
+def test_missing_values_stay_missing(tmp_path):
+    filename = str(tmp_path / results_store.FILENAME)
+    results_store.write_results(results_frame(), filename)
+    read = results_store.read_results(filename, columns=['word', 'region'])
+    assert read['region'].isna().tolist() == [False, True, False, True]
+    assert "nan" not in read['region'].cat.categories
+    # a word spelled "nan" is not a missing value
+    assert read['word'].tolist() == ["the", "nan", "NA", "<eos>"]
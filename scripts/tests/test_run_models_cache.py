@@ -0,0 +1,105 @@
+"""run_models.main with the surprisal cache, on the kenlm baseline.
+
+The model is ngram_model.py with tiny.arpa, run as a command or as an
+in-process backend. A second run on the same items should take every
+sentence from the cache and write the same results; changing the command,
+its model file or the backend settings should score everything again.
+"""
+import os
+import sys
+import shutil
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = os.path.dirname(HERE)
+sys.path.insert(0, SCRIPTS)
+import backends
+import instrumentation
+import run_models
+
+ARPA = os.path.join(HERE, "tiny.arpa")
+SENTENCES = os.path.join(HERE, "tiny_sentences.txt")
+COMMAND = '"%s" "%s" --lm "%s" --input_file {input_path} --output_file {output_path}'
+
+
+@pytest.fixture
+def experiment(tmp_path, monkeypatch):
+    """ A tests directory with items.tsv, and run_models pointed at a
+    private cache, no daemons and no backends config """
+    path = tmp_path / "tests"
+    path.mkdir()
+    with open(SENTENCES) as infile, open(str(path / "items.tsv"), "w") as outfile:
+        print("\tsent_index\tword_index\tword\tregion\tcondition", file=outfile)
+        row = 0
+        for sent_index, line in enumerate(infile):
+            if line.split()[-1] != "<eos>":
+                continue
+            for word_index, word in enumerate(line.split()):
+                print(row, sent_index, word_index, word, "r%d" % word_index, "c", sep="\t", file=outfile)
+                row += 1
+    lm = str(tmp_path / "tiny.arpa")
+    shutil.copy(ARPA, lm)
+    monkeypatch.setenv(backends.CONFIG_VAR, str(tmp_path / "models.json"))
+    monkeypatch.delenv(instrumentation.EVENTS_VAR, raising=False)
+    monkeypatch.setattr(run_models, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(run_models, "DAEMONS", {})
+    monkeypatch.setattr(run_models, "MODELS", {
+        'kenlm': [COMMAND % (sys.executable, os.path.join(SCRIPTS, "ngram_model.py"), lm)],
+    })
+    return str(path), lm
+
+def run(path, capfd):
+    """ Run kenlm over path; return combined_results.csv and what the run
+    said about the cache """
+    capfd.readouterr()
+    run_models.main(path, "kenlm")
+    err = capfd.readouterr().err
+    with open(os.path.join(path, "combined_results.csv"), "rb") as infile:
+        results = infile.read()
+    cached = [line for line in err.splitlines() if "sentences cached" in line]
+    return results, cached, "Running command" in err
+
+def write_config(lm):
+    with open(os.environ[backends.CONFIG_VAR], "w") as outfile:
+        outfile.write('{"kenlm": {"backend": "kenlm", "lm": "%s"}}' % lm)
+
+
+def test_second_run_is_all_cached(experiment, capfd):
+    path, _ = experiment
+    results, cached, ran = run(path, capfd)
+    assert cached == ["kenlm: 0 of 4 sentences cached"] and ran
+    again, cached, ran = run(path, capfd)
+    assert cached == ["kenlm: 4 of 4 sentences cached"] and not ran
+    assert again == results
+
+def test_changed_command_is_scored_again(experiment, capfd):
+    path, lm = experiment
+    results, _, _ = run(path, capfd)
+    run_models.MODELS['kenlm'] = [run_models.MODELS['kenlm'][0].replace('" "', '" -u "', 1)]
+    again, cached, ran = run(path, capfd)
+    assert cached == ["kenlm: 0 of 4 sentences cached"] and ran
+    assert again == results
+
+def test_changed_model_file_is_scored_again(experiment, capfd):
+    path, lm = experiment
+    run(path, capfd)
+    stat = os.stat(lm)
+    os.utime(lm, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    _, cached, ran = run(path, capfd)
+    assert cached == ["kenlm: 0 of 4 sentences cached"] and ran
+
+def test_changed_backend_settings_are_scored_again(experiment, capfd, tmp_path):
+    path, lm = experiment
+    write_config(lm)
+    results, cached, _ = run(path, capfd)
+    assert cached == ["kenlm: 0 of 4 sentences cached"]
+    again, cached, _ = run(path, capfd)
+    assert cached == ["kenlm: 4 of 4 sentences cached"]
+    assert again == results
+    other = str(tmp_path / "other.arpa")
+    shutil.copy(ARPA, other)
+    write_config(other)
+    again, cached, _ = run(path, capfd)
+    assert cached == ["kenlm: 0 of 4 sentences cached"]
+    assert again == results
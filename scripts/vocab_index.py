@@ -0,0 +1,152 @@
+"""Compiled vocabulary index for eval_test_google.py.
+
+data_utils.CharsVocabulary rebuilds a dict and a char-id matrix from the
+800k-line vocabulary file every time the scorer starts. This compiles that
+once into a directory of .npy files that the scorer memory-maps instead:
+
+* words.npy: the words, UTF-8 encoded and sorted, as a fixed-width array
+* ids.npy: the id of each word in words.npy
+* ranks.npy: the position in words.npy of each id, for id_to_word
+* char_ids.npy: the [num_words, max_word_length] char-id matrix, by id
+* meta.json: max_word_length, the bos/eos/unk ids and the special chars
+
+Words are looked up a whole list at a time with np.searchsorted, and their
+char ids are taken from the matrix by fancy indexing. Only words outside the
+vocabulary get their char ids computed, the way CharsVocabulary does.
+
+Usage, from the directory with data_utils.py:
+    python vocab_index.py --vocab_file ../data/vocab-2016-09-10.txt --output ../data/vocab-2016-09-10.index
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+META = "meta.json"
+SPECIAL_CHARS = ['bos_char', 'eos_char', 'bow_char', 'eow_char', 'pad_char']
+
+
+def write_word_table(dirname, word_to_id, id_to_word):
+    """ Write words.npy, ids.npy and ranks.npy for a word -> id mapping and
+    the id -> word list it came from (which may repeat words) """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    items = sorted((word.encode('utf-8'), word_id) for word, word_id in word_to_id.items())
+    words = np.array([word for word, _ in items], dtype=bytes)
+    ids = np.array([word_id for _, word_id in items], dtype=np.int32)
+    positions = {word: position for position, (word, _) in enumerate(items)}
+    ranks = np.array([positions[word.encode('utf-8')] for word in id_to_word], dtype=np.int32)
+    np.save(os.path.join(dirname, "words.npy"), words)
+    np.save(os.path.join(dirname, "ids.npy"), ids)
+    np.save(os.path.join(dirname, "ranks.npy"), ranks)
+
+def compile_vocab(vocab, dirname):
+    """ Write the index for a data_utils.CharsVocabulary to dirname """
+    write_word_table(dirname, vocab._word_to_id, vocab._id_to_word)
+    char_ids = vocab._word_char_ids
+    if char_ids.max() < 256:
+        char_ids = char_ids.astype(np.uint8)
+    np.save(os.path.join(dirname, "char_ids.npy"), char_ids)
+    meta = {
+        'max_word_length': vocab.max_word_length,
+        'bos': vocab.bos,
+        'eos': vocab.eos,
+        'unk': vocab.unk,
+    }
+    meta.update((name, getattr(vocab, name)) for name in SPECIAL_CHARS)
+    with open(os.path.join(dirname, META), 'w') as outfile:
+        json.dump(meta, outfile)
+
+
+class WordTable(object):
+    """ The words.npy, ids.npy and ranks.npy in dirname, memory-mapped """
+    def __init__(self, dirname):
+        self.words = np.load(os.path.join(dirname, "words.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(dirname, "ids.npy"), mmap_mode='r')
+        self.ranks = np.load(os.path.join(dirname, "ranks.npy"), mmap_mode='r')
+
+    @property
+    def size(self):
+        return len(self.ranks)
+
+    def positions(self, words):
+        """ Row of each word in words.npy, or -1 for words not in it """
+        keys = np.array([word.encode('utf-8') for word in words], dtype=bytes)
+        if not len(keys):
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.words, keys), len(self.words) - 1)
+        return np.where(self.words[positions] == keys, positions, -1)
+
+    def word_ids(self, words, default):
+        """ Id of each word, or default for words not in the table """
+        positions = self.positions(words)
+        found = positions >= 0
+        ids = np.full(len(words), default, dtype=np.int32)
+        ids[found] = self.ids[positions[found]]
+        return ids, found
+
+    def id_to_word(self, cur_id):
+        return self.words[self.ranks[cur_id]].decode('utf-8')
+
+
+class VocabIndex(WordTable):
+    """ A compiled CharsVocabulary, memory-mapped from dirname.
+
+    Has the CharsVocabulary methods the scorer uses, plus lookup() for a
+    whole list of words at once.
+    """
+    def __init__(self, dirname):
+        super(VocabIndex, self).__init__(dirname)
+        with open(os.path.join(dirname, META)) as infile:
+            meta = json.load(infile)
+        self.max_word_length = meta['max_word_length']
+        self.bos = meta['bos']
+        self.eos = meta['eos']
+        self.unk = meta['unk']
+        for name in SPECIAL_CHARS:
+            setattr(self, name, meta[name])
+        self.char_ids = np.load(os.path.join(dirname, "char_ids.npy"), mmap_mode='r')
+
+    def _convert_word_to_char_ids(self, word):
+        code = np.zeros([self.max_word_length], dtype=np.int32)
+        code[:] = ord(self.pad_char)
+        if len(word) > self.max_word_length - 2:
+            word = word[:self.max_word_length - 2]
+        cur_word = self.bow_char + word + self.eow_char
+        for j in range(len(cur_word)):
+            code[j] = ord(cur_word[j])
+        return code
+
+    def lookup(self, words):
+        """ Word ids [n] and char ids [n, max_word_length] for a list of words """
+        ids, found = self.word_ids(words, self.unk)
+        char_ids = np.empty([len(words), self.max_word_length], dtype=np.int32)
+        char_ids[found] = self.char_ids[ids[found]]
+        for i in np.flatnonzero(~found):
+            char_ids[i] = self._convert_word_to_char_ids(words[i])
+        return ids, char_ids
+
+    def word_to_id(self, word):
+        return int(self.lookup([word])[0][0])
+
+    def word_to_char_ids(self, word):
+        return self.lookup([word])[1][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile a vocabulary file for eval_test_google.py')
+    parser.add_argument('--vocab_file', type=str, help='vocabulary file, e.g. vocab-2016-09-10.txt')
+    parser.add_argument('--max_word_length', type=int, default=50, help='MAX_WORD_LEN of the scorer')
+    parser.add_argument('--output', type=str, help='directory to write the index to')
+    args = parser.parse_args()
+
+    import data_utils
+    print("Loading %s" % args.vocab_file, file=sys.stderr)
+    vocab = data_utils.CharsVocabulary(args.vocab_file, args.max_word_length)
+    compile_vocab(vocab, args.output)
+
+if __name__ == '__main__':
+    main()